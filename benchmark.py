@@ -0,0 +1,446 @@
+"""Benchmarks do sistema da Mecânica Goelzer.
+
+Gera uma base sintética determinística (mesma semente, mesmos dados), mede os
+métodos principais de MecanicaGoelzer e dispara requisições HTTP contra o
+Flask (test client) ou contra um servidor já rodando. O resultado é gravado
+em JSON para comparar execuções:
+
+    python3 benchmark.py --registros 1000 100000 --saida resultado.json
+    python3 benchmark.py --registros 100000 --comparar resultado.json
+    python3 benchmark.py --registros 100000 --url http://localhost:5000 --sem-micro
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+# Datas fixas para que a mesma semente gere sempre os mesmos dados
+DATA_FINAL = date(2025, 12, 31)
+DIAS_HISTORICO = 3 * 365
+
+# Proporção de cada entidade no total de registros pedido
+PROPORCOES = {
+    'clientes': 0.10,
+    'veiculos': 0.12,
+    'ordens': 0.25,
+    'movimentacoes': 0.30,
+    'logs': 0.15,
+    'contas_a_receber': 0.05,
+    'despesasGerais': 0.03,
+}
+
+NOMES = ['Ana', 'Bruno', 'Carla', 'Diego', 'Eduarda', 'Fábio', 'Gustavo', 'Helena', 'Ícaro', 'Júlia',
+         'Lucas', 'Marina', 'Nícolas', 'Otávio', 'Paula', 'Rafael', 'Sônia', 'Tiago', 'Vitória', 'João']
+SOBRENOMES = ['Silva', 'Souza', 'Oliveira', 'Pereira', 'Lima', 'Goelzer', 'Schmitt', 'Müller',
+              'Conceição', 'Araújo', 'Gonçalves', 'Ribeiro', 'Fagundes', 'Becker']
+MODELOS = [('VW', 'Gol'), ('Fiat', 'Uno'), ('Chevrolet', 'Onix'), ('Ford', 'Ka'), ('Toyota', 'Corolla'),
+           ('Honda', 'Civic'), ('Renault', 'Sandero'), ('Hyundai', 'HB20'), ('Fiat', 'Strada')]
+CORES = ['Branco', 'Prata', 'Preto', 'Vermelho', 'Cinza', 'Azul']
+CATEGORIAS_SERVICO = ['Manutenção', 'Suspensão', 'Freios', 'Motor', 'Elétrica', 'Injeção']
+ITENS_PECA = ['Óleo', 'Filtro de Óleo', 'Filtro de Ar', 'Pastilha de Freio', 'Disco de Freio',
+              'Amortecedor', 'Vela', 'Correia Dentada', 'Bateria', 'Lâmpada']
+STATUS_ORDEM = ['Aberta', 'Em Execução', 'Concluída', 'Concluída', 'Concluída', 'Cancelada']
+FORMAS_PAGAMENTO = ['Dinheiro', 'PIX', 'Cartão de Crédito', 'A prazo']
+
+
+# --- Gerador de Dados --- #
+def _data_aleatoria(rnd):
+    return (DATA_FINAL - timedelta(days=rnd.randrange(DIAS_HISTORICO))).isoformat()
+
+def gerar_dados(total_registros, semente=42):
+    rnd = random.Random(semente)
+    quantidades = {nome: max(1, int(total_registros * proporcao)) for nome, proporcao in PROPORCOES.items()}
+    total_servicos = max(5, min(200, total_registros // 1000))
+    total_pecas = max(4, min(5000, total_registros // 100))
+
+    data = {nome: [] for nome in ['clientes', 'veiculos', 'servicos', 'pecas', 'ferramentas', 'agendamentos',
+                                  'ordens', 'compras', 'movimentacoes', 'despesasGerais', 'orcamentos',
+                                  'movimentacoes_estoque', 'logs', 'contas_a_receber']}
+
+    for i in range(1, total_servicos + 1):
+        data['servicos'].append({
+            'id': i,
+            'descricao': f"{rnd.choice(['Troca de', 'Revisão de', 'Reparo de'])} {rnd.choice(ITENS_PECA)} {i}",
+            'categoria': rnd.choice(CATEGORIAS_SERVICO),
+            'valorMaoObra': round(rnd.uniform(40, 400), 2),
+            'tempoEstimado': f"{rnd.randint(1, 6) * 30} min"
+        })
+
+    for i in range(1, total_pecas + 1):
+        custo = round(rnd.uniform(5, 600), 2)
+        data['pecas'].append({
+            'id': i,
+            'codigo': f"P{i:05d}",
+            'descricao': f"{rnd.choice(ITENS_PECA)} {rnd.choice(MODELOS)[1]}",
+            'fornecedor': rnd.choice(['Petrobras', 'Bosch', 'Mahle', 'Cofap', 'Fras-le', 'Moura']),
+            'custoUnitario': custo,
+            'precoVenda': round(custo * rnd.uniform(1.3, 2.2), 2),
+            'quantidadeEstoque': rnd.randint(0, 200),
+            'estoqueMinimo': rnd.randint(2, 20)
+        })
+
+    for i in range(1, quantidades['clientes'] + 1):
+        data['clientes'].append({
+            'id': i,
+            'nome': f"{rnd.choice(NOMES)} {rnd.choice(SOBRENOMES)} {rnd.choice(SOBRENOMES)}",
+            'cpfCnpj': f"{rnd.randrange(1000):03d}.{rnd.randrange(1000):03d}.{rnd.randrange(1000):03d}-{rnd.randrange(100):02d}",
+            'telefone': f"(51) 9{rnd.randrange(10000):04d}-{rnd.randrange(10000):04d}",
+            'email': f"cliente{i}@exemplo.com.br",
+            'endereco': f"Rua {rnd.choice(SOBRENOMES)}, {rnd.randint(1, 3000)}"
+        })
+
+    total_clientes = quantidades['clientes']
+    for i in range(1, quantidades['veiculos'] + 1):
+        marca, modelo = rnd.choice(MODELOS)
+        letras = ''.join(rnd.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(3))
+        data['veiculos'].append({
+            'id': i,
+            'cliente_id': rnd.randint(1, total_clientes),
+            'placa': f"{letras}-{rnd.randrange(10)}{rnd.choice('ABCDEFGHIJ')}{rnd.randrange(100):02d}",
+            'marca': marca,
+            'modelo': modelo,
+            'ano': rnd.randint(2000, 2025),
+            'cor': rnd.choice(CORES)
+        })
+
+    pecas_por_id = {peca['id']: peca for peca in data['pecas']}
+    servicos_por_id = {servico['id']: servico for servico in data['servicos']}
+    for i in range(1, quantidades['ordens'] + 1):
+        veiculo = data['veiculos'][rnd.randrange(len(data['veiculos']))]
+        abertura = _data_aleatoria(rnd)
+        servicos_ids = rnd.sample(range(1, total_servicos + 1), rnd.randint(1, min(3, total_servicos)))
+        pecas_usadas = [{'peca_id': peca_id, 'quantidade': rnd.randint(1, 4)}
+                        for peca_id in rnd.sample(range(1, total_pecas + 1), rnd.randint(0, min(4, total_pecas)))]
+        desconto = rnd.choice([0.0, 0.0, 0.0, 10.0, 25.0])
+        valor_total = sum(servicos_por_id[s]['valorMaoObra'] for s in servicos_ids)
+        valor_total += sum(pecas_por_id[p['peca_id']]['precoVenda'] * p['quantidade'] for p in pecas_usadas)
+        status = rnd.choice(STATUS_ORDEM)
+        ordem = {
+            'id': i,
+            'numero': f"{abertura[:4]}-{i:06d}",
+            'cliente_id': veiculo['cliente_id'],
+            'veiculo_id': veiculo['id'],
+            'data_abertura': abertura,
+            'status': status,
+            'servicos_ids': servicos_ids,
+            'pecas_usadas': pecas_usadas,
+            'desconto': desconto,
+            'valor_total': round(max(0.0, valor_total - desconto), 2),
+            'forma_pagamento': rnd.choice(FORMAS_PAGAMENTO)
+        }
+        if status == 'Concluída':
+            ordem['data_fechamento'] = abertura
+        data['ordens'].append(ordem)
+
+    total_ordens = quantidades['ordens']
+    for i in range(1, quantidades['movimentacoes'] + 1):
+        tipo = 'receita' if rnd.random() < 0.6 else 'despesa'
+        data['movimentacoes'].append({
+            'id': i,
+            'tipo': tipo,
+            'descricao': f"Movimentação {i}",
+            'valor': round(rnd.uniform(20, 3000), 2),
+            'categoria': 'Serviços' if tipo == 'receita' else 'Peças',
+            'data': _data_aleatoria(rnd),
+            'ordem_id': rnd.randint(1, total_ordens)
+        })
+
+    for i in range(1, quantidades['despesasGerais'] + 1):
+        data['despesasGerais'].append({
+            'id': i,
+            'descricao': rnd.choice(['Aluguel', 'Energia', 'Água', 'Internet', 'Ferramentas']),
+            'valor': round(rnd.uniform(50, 5000), 2),
+            'data': _data_aleatoria(rnd)
+        })
+
+    for i in range(1, quantidades['logs'] + 1):
+        data['logs'].append({
+            'id': i,
+            'timestamp': f"{_data_aleatoria(rnd)}T{rnd.randrange(24):02d}:{rnd.randrange(60):02d}:00",
+            'acao': rnd.choice(['Fechamento de OS', 'Cadastro de cliente', 'Atualização de estoque']),
+            'detalhes': {'ordem_id': rnd.randint(1, total_ordens)}
+        })
+
+    for i in range(1, quantidades['contas_a_receber'] + 1):
+        ordem = data['ordens'][rnd.randrange(total_ordens)]
+        pago = round(ordem['valor_total'] * rnd.choice([0, 0.5, 1]), 2)
+        data['contas_a_receber'].append({
+            'id': i,
+            'ordem_id': ordem['id'],
+            'cliente_id': ordem['cliente_id'],
+            'descricao': f"OS {ordem['id']}",
+            'valor_total': ordem['valor_total'],
+            'valor_pago': pago,
+            'data_vencimento': _data_aleatoria(rnd),
+            'status': 'Pago' if pago >= ordem['valor_total'] else ('Parcial' if pago else 'Pendente'),
+            'parcelas': [{'valor': pago, 'data': ordem['data_abertura'], 'forma_pagamento': 'PIX'}] if pago else []
+        })
+
+    return data
+
+
+# --- Medição --- #
+def resumir(tempos):
+    # Tempos em segundos -> estatísticas em milissegundos
+    ordenados = sorted(tempos)
+    def percentil(p):
+        return ordenados[min(len(ordenados) - 1, int(round(p * (len(ordenados) - 1))))] * 1000
+    return {
+        'amostras': len(ordenados),
+        'min_ms': round(ordenados[0] * 1000, 4),
+        'mediana_ms': round(statistics.median(ordenados) * 1000, 4),
+        'media_ms': round(statistics.fmean(ordenados) * 1000, 4),
+        'p95_ms': round(percentil(0.95), 4),
+        'max_ms': round(ordenados[-1] * 1000, 4),
+    }
+
+def medir(funcao, repeticoes):
+    # Uma chamada de aquecimento fora da conta (índices são criados sob demanda)
+    funcao()
+    tempos = []
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        funcao()
+        tempos.append(time.perf_counter() - inicio)
+    return resumir(tempos)
+
+@contextlib.contextmanager
+def silenciar():
+    # Os métodos do sistema imprimem uma linha a cada gravação
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+def preparar_sistema(main, data):
+    # Grava a base gerada no DATA_FILE configurado e carrega uma instância nova,
+    # que passa a responder às rotas do Flask
+    anterior = main.sistema_mecanica
+    with silenciar():
+        anterior._armazenamento.fechar()
+        anterior.auditoria.fechar()
+    shutil.rmtree(main.LOGS_DIR, ignore_errors=True)
+    # O snapshot também: se sobrar de uma rodada anterior, ele é carregado no
+    # lugar do DATA_FILE recém-gravado
+    for caminho in (main.DATA_FILE, main.SNAPSHOT_FILE, main.JOURNAL_FILE, main.JOURNAL_FILE + '.compactando',
+                    main.SQLITE_FILE, main.SQLITE_FILE + '-wal', main.SQLITE_FILE + '-shm'):
+        if os.path.exists(caminho):
+            os.remove(caminho)
+    with open(main.DATA_FILE, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    if main.MODO_ARMAZENAMENTO == 'sqlite':
+        with silenciar():
+            main.migrar_json_para_sqlite(main.DATA_FILE, main.SQLITE_FILE)
+
+    with silenciar():
+        inicio = time.perf_counter()
+        sistema = main.MecanicaGoelzer()
+        tempo_carga = time.perf_counter() - inicio
+    main.sistema_mecanica = sistema
+    with main._lock_cache_respostas:
+        main._cache_respostas.clear()
+    return sistema, tempo_carga
+
+def micro_benchmarks(main, sistema, repeticoes, semente):
+    rnd = random.Random(semente)
+    ids_ordens = [ordem['id'] for ordem in sistema.data['ordens']]
+    amostra_ordens = [rnd.choice(ids_ordens) for _ in range(1000)]
+    ids_clientes = [cliente['id'] for cliente in sistema.data['clientes']]
+    ano, mes = DATA_FINAL.year, DATA_FINAL.month
+    resultados = {}
+
+    def total_ordens():
+        for ordem_id in amostra_ordens:
+            sistema.calcular_total_ordem(ordem_id)
+    estatisticas = medir(total_ordens, repeticoes)
+    # Tempo por chamada, não por lote de 1000
+    resultados['calcular_total_ordem'] = {chave: round(valor / len(amostra_ordens), 6) if chave.endswith('_ms') else valor
+                                          for chave, valor in estatisticas.items()}
+
+    resultados['atualizar_dashboard'] = medir(sistema.atualizar_dashboard, repeticoes)
+    resultados['gerar_relatorio_financeiro_mensal'] = medir(lambda: sistema.gerar_relatorio_financeiro_mensal(ano, mes), repeticoes)
+    resultados['gerar_relatorio_financeiro_anual'] = medir(lambda: sistema.gerar_relatorio_financeiro_anual(ano), repeticoes)
+    resultados['listar_itens_por_cliente'] = medir(
+        lambda: sistema.listar_itens('ordens', {'cliente_id': rnd.choice(ids_clientes)}), repeticoes)
+    resultados['buscar_texto'] = medir(lambda: sistema.buscar_texto(rnd.choice(SOBRENOMES)[:4]), repeticoes)
+    resultados['analisar_receita_mes'] = medir(lambda: sistema.analisar('receita', ('mes',)), repeticoes)
+    resultados['analisar_faturamento_mes_item'] = medir(lambda: sistema.analisar('faturamento', ('mes', 'item')), repeticoes)
+
+    with silenciar():
+        resultados['adicionar_item'] = medir(lambda: sistema.adicionar_item('agendamentos', {
+            'cliente_id': rnd.choice(ids_clientes), 'data': DATA_FINAL.isoformat(), 'status': 'Agendado'}), repeticoes)
+        resultados['registrar_log'] = medir(lambda: sistema.registrar_log('Benchmark', {}), repeticoes)
+        resultados['_salvar_dados'] = medir(sistema._salvar_dados, max(1, min(repeticoes, 5)))
+    return resultados
+
+
+# --- Carga HTTP --- #
+def montar_requisicoes(sistema, total, semente):
+    rnd = random.Random(semente)
+    ids_ordens = [ordem['id'] for ordem in sistema.data['ordens']]
+    ids_clientes = [cliente['id'] for cliente in sistema.data['clientes']]
+    ano = DATA_FINAL.year
+    modelos = [
+        ('GET /api/clientes?limit=50', lambda: ('GET', f"/api/clientes?limit=50&offset={rnd.randrange(len(ids_clientes))}", None)),
+        ('GET /api/ordens?cliente_id=', lambda: ('GET', f"/api/ordens?cliente_id={rnd.choice(ids_clientes)}", None)),
+        ('GET /api/ordens/<id>', lambda: ('GET', f"/api/ordens/{rnd.choice(ids_ordens)}", None)),
+        ('GET /api/dashboard', lambda: ('GET', '/api/dashboard', None)),
+        ('GET /api/relatorios/financeiro-anual/<ano>', lambda: ('GET', f"/api/relatorios/financeiro-anual/{ano}", None)),
+        ('GET /api/search', lambda: ('GET', f"/api/search?q={urllib.parse.quote(rnd.choice(SOBRENOMES)[:3])}&limit=20", None)),
+        ('POST /api/logs', lambda: ('POST', '/api/logs', {'timestamp': datetime.now().isoformat(), 'acao': 'Benchmark', 'detalhes': {}})),
+    ]
+    # 90% leituras, 10% escritas
+    pesos = [18, 18, 18, 12, 6, 18, 10]
+    return [(nome, *gerar()) for nome, gerar in rnd.choices(modelos, weights=pesos, k=total)]
+
+def carga_http(main, requisicoes, concorrencia, url=None):
+    tempos = {}
+    erros = []
+    lock = threading.Lock()
+    local = threading.local()
+
+    def executar(requisicao):
+        nome, metodo, caminho, corpo = requisicao
+        inicio = time.perf_counter()
+        if url:
+            dados = json.dumps(corpo).encode('utf-8') if corpo is not None else None
+            pedido = urllib.request.Request(url.rstrip('/') + caminho, data=dados, method=metodo,
+                                            headers={'Content-Type': 'application/json'})
+            try:
+                with urllib.request.urlopen(pedido) as resposta:
+                    resposta.read()
+                    status = resposta.status
+            except urllib.error.HTTPError as e:
+                status = e.code
+        else:
+            if not hasattr(local, 'cliente'):
+                local.cliente = main.app.test_client()
+            resposta = local.cliente.open(caminho, method=metodo, json=corpo)
+            status = resposta.status_code
+        duracao = time.perf_counter() - inicio
+        with lock:
+            tempos.setdefault(nome, []).append(duracao)
+            if status >= 400:
+                erros.append({'requisicao': nome, 'status': status})
+
+    inicio = time.perf_counter()
+    with silenciar(), ThreadPoolExecutor(max_workers=concorrencia) as executor:
+        list(executor.map(executar, requisicoes))
+    duracao_total = time.perf_counter() - inicio
+
+    resultado = {nome: resumir(valores) for nome, valores in sorted(tempos.items())}
+    resultado['total'] = dict(resumir([t for valores in tempos.values() for t in valores]),
+                              requisicoes_por_segundo=round(len(requisicoes) / duracao_total, 2),
+                              erros=len(erros), concorrencia=concorrencia)
+    return resultado
+
+
+# --- Comparação --- #
+def comparar(anterior, atual, limite=1.2):
+    # Lista as medianas que pioraram mais que 'limite' vezes em relação à execução anterior
+    regressoes = []
+    por_registros = {r['registros']: r for r in anterior.get('resultados', [])}
+    for resultado in atual['resultados']:
+        base = por_registros.get(resultado['registros'])
+        if not base:
+            continue
+        for grupo in ('micro', 'http'):
+            for nome, estatisticas in resultado.get(grupo, {}).items():
+                antes = base.get(grupo, {}).get(nome, {}).get('mediana_ms')
+                agora = estatisticas.get('mediana_ms')
+                if antes and agora and agora / antes > limite:
+                    regressoes.append({'registros': resultado['registros'], 'grupo': grupo, 'nome': nome,
+                                       'antes_ms': antes, 'agora_ms': agora, 'razao': round(agora / antes, 2)})
+    return regressoes
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description='Benchmarks da Mecânica Goelzer')
+    parser.add_argument('--registros', type=int, nargs='+', default=[1000],
+                        help='total de registros gerados por rodada (ex.: 1000 100000 1000000)')
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--repeticoes', type=int, default=20)
+    parser.add_argument('--armazenamento', choices=['journal', 'json', 'sqlite'], default='journal')
+    parser.add_argument('--requisicoes', type=int, default=500, help='requisições HTTP por rodada (0 desliga)')
+    parser.add_argument('--concorrencia', type=int, default=8)
+    parser.add_argument('--url', help='servidor já rodando (em vez do test client); a base dele não é alterada')
+    parser.add_argument('--sem-micro', action='store_true', help='pula os micro-benchmarks')
+    parser.add_argument('--saida', default='benchmark.json')
+    parser.add_argument('--comparar', help='resultado anterior para apontar regressões')
+    parser.add_argument('--limite-regressao', type=float, default=1.2,
+                        help='razão entre medianas a partir da qual a diferença é apontada')
+    args = parser.parse_args()
+
+    # main.py lê a configuração do ambiente ao ser importado, então os arquivos
+    # de dados ficam em um diretório temporário, longe do data.json real
+    diretorio = tempfile.mkdtemp(prefix='mecanica-benchmark-')
+    os.environ['MECANICA_DATA_FILE'] = os.path.join(diretorio, 'data.json')
+    os.environ['MECANICA_ARMAZENAMENTO'] = args.armazenamento
+    os.environ.pop('MECANICA_SQLITE_FILE', None)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    try:
+        with silenciar():
+            import main
+
+        relatorio = {
+            'versao': 1,
+            'data': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'plataforma': platform.platform(),
+            'semente': args.semente,
+            'armazenamento': args.armazenamento,
+            'resultados': []
+        }
+        for total in args.registros:
+            print(f'⏱️  {total} registros...')
+            inicio = time.perf_counter()
+            data = gerar_dados(total, args.semente)
+            tempo_geracao = time.perf_counter() - inicio
+            sistema, tempo_carga = preparar_sistema(main, data)
+            resultado = {
+                'registros': total,
+                'contagens': {nome: len(itens) for nome, itens in data.items()},
+                'bytes_data_json': os.path.getsize(main.DATA_FILE),
+                'geracao_s': round(tempo_geracao, 3),
+                'carga_s': round(tempo_carga, 3),
+            }
+            del data
+            if not args.sem_micro:
+                resultado['micro'] = micro_benchmarks(main, sistema, args.repeticoes, args.semente)
+            if args.requisicoes:
+                requisicoes = montar_requisicoes(sistema, args.requisicoes, args.semente)
+                resultado['http'] = carga_http(main, requisicoes, args.concorrencia, args.url)
+            relatorio['resultados'].append(resultado)
+            with silenciar():
+                sistema._armazenamento.fechar()
+                sistema.auditoria.fechar()
+
+        if args.comparar:
+            with open(args.comparar, encoding='utf-8') as f:
+                anterior = json.load(f)
+            if anterior.get('armazenamento') != args.armazenamento:
+                print(f"⚠️  A execução anterior usou o armazenamento '{anterior.get('armazenamento')}'")
+            relatorio['regressoes'] = comparar(anterior, relatorio, args.limite_regressao)
+            for regressao in relatorio['regressoes']:
+                print(f"⚠️  {regressao['registros']} registros, {regressao['grupo']}/{regressao['nome']}: "
+                      f"{regressao['antes_ms']} ms -> {regressao['agora_ms']} ms ({regressao['razao']}x)")
+
+        with open(args.saida, 'w', encoding='utf-8') as f:
+            json.dump(relatorio, f, ensure_ascii=False, indent=2)
+        print(f'✅ Resultados gravados em {args.saida}')
+        return 1 if relatorio.get('regressoes') else 0
+    finally:
+        shutil.rmtree(diretorio, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main_benchmark())
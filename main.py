@@ -1,19 +1,2057 @@
 
+import atexit
+import bisect
+import contextlib
+import copy
+import cProfile
+import functools
+import gzip
+import hashlib
+import heapq
+import itertools
 import json
+import mmap
 import os
-from datetime import datetime
-from flask import Flask, request, jsonify, render_template, send_from_directory
+import pickle
+import queue
+import random
+import re
+import shutil
+import sqlite3
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
+import uuid
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from flask import Flask, request, jsonify, render_template, send_from_directory, g
 from flask_cors import CORS
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 # --- Configurações --- #
-DATA_FILE = 'data.json'
+DATA_FILE = os.environ.get('MECANICA_DATA_FILE', 'data.json')
 STATIC_FOLDER = 'static'
 TEMPLATE_FOLDER = 'templates'
 
-app = Flask(__name__, static_folder=STATIC_FOLDER, template_folder=TEMPLATE_FOLDER)
-CORS(app)
+# Scripts e folhas de estilo da página principal, na ordem de carregamento.
+# Com MECANICA_BUNDLES ligado (padrão), são servidos concatenados e minificados
+# em um único arquivo de cada tipo.
+SCRIPTS_PAGINA = [
+    'app.js', 'calculos.js', 'edicao_exclusao.js', 'exportacao.js', 'filtros_busca.js',
+    'graficos.js', 'mascaras.js', 'melhorias.js', 'notificacoes.js', 'paginacao_ordenacao.js',
+    'pdf_profissional.js', 'relatorios_avancados.js', 'seguranca.js', 'testes_seguranca.js',
+    'validacoes.js', 'atualizacao_automatica.js', 'correcoes_completas.js', 'correcoes_final.js',
+    'diagnostico.js'
+]
+ESTILOS_PAGINA = ['styles.css', 'splash.css']
+USAR_BUNDLES = os.environ.get('MECANICA_BUNDLES', '1') != '0'
+
+# Registros serializados (ou, na restauração, gravados) por vez no backup em streaming
+BACKUP_REGISTROS_POR_LOTE = 500
+ENTIDADES_OBRIGATORIAS_BACKUP = ['clientes', 'veiculos', 'servicos', 'pecas', 'ordens']
+
+# Modo de persistência: 'journal' (padrão) grava um registro por alteração em
+# um arquivo de log e compacta periodicamente em DATA_FILE; 'sqlite' grava cada
+# alteração como uma linha em SQLITE_FILE; 'json' mantém o comportamento antigo
+# de regravar o arquivo inteiro a cada alteração.
+MODO_ARMAZENAMENTO = os.environ.get('MECANICA_ARMAZENAMENTO', 'journal')
+JOURNAL_FILE = os.path.splitext(DATA_FILE)[0] + '.journal'
+SQLITE_FILE = os.environ.get('MECANICA_SQLITE_FILE', os.path.splitext(DATA_FILE)[0] + '.db')
+JOURNAL_LIMITE_COMPACTACAO = int(os.environ.get('MECANICA_JOURNAL_LIMITE', '5000'))
+
+# No modo journal, o snapshot é gravado por padrão em formato binário
+# (SNAPSHOT_FILE), com uma seção por entidade decodificada só no primeiro
+# acesso. Com MECANICA_SNAPSHOT=json, o snapshot continua sendo o DATA_FILE.
+FORMATO_SNAPSHOT = os.environ.get('MECANICA_SNAPSHOT', 'binario')
+SNAPSHOT_FILE = os.path.splitext(DATA_FILE)[0] + '.snap'
+
+# Comandos de linha (fim do arquivo): podem rodar com o servidor no ar, então
+# a instância criada ao carregar o módulo não é dona do journal
+COMANDOS_LINHA = ('migrar-sqlite', 'exportar-json', 'importar-json')
+EXECUTANDO_COMANDO = __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] in COMANDOS_LINHA
+
+# Vários processos servindo os mesmos dados (ex.: gunicorn com --workers > 1):
+# as escritas passam por uma trava entre processos (flock em
+# TRAVA_PROCESSOS_FILE) e cada processo aplica o que os outros gravaram no
+# journal antes de atender uma requisição. Só no modo journal e em sistemas
+# com fcntl (Linux, macOS).
+MULTIPROCESSO = os.environ.get('MECANICA_MULTIPROCESSO', '0') == '1'
+TRAVA_PROCESSOS_FILE = os.path.splitext(DATA_FILE)[0] + '.lock'
+
+# Campos que ganham índice secundário (criado no primeiro filtro por eles e
+# mantido a cada alteração). Em 'ordens', 'servico_id' indexa os itens de servicos_ids.
+CAMPOS_INDEXADOS = ('cliente_id', 'veiculo_id', 'ordem_id', 'peca_id', 'status', 'servico_id')
+
+# Logs de auditoria: ficam fora do data.json, em segmentos NDJSON em
+# LOGS_DIR. O segmento ativo é fechado e comprimido (gzip) ao passar de
+# MECANICA_LOGS_SEGMENTO_BYTES ou de MECANICA_LOGS_SEGMENTO_HORAS; segmentos
+# mais antigos que MECANICA_LOGS_RETENCAO_DIAS são apagados (0 mantém tudo).
+LOGS_DIR = os.environ.get('MECANICA_LOGS_DIR', os.path.splitext(DATA_FILE)[0] + '_logs')
+LOGS_SEGMENTO_BYTES = int(os.environ.get('MECANICA_LOGS_SEGMENTO_BYTES', str(4 * 1024 * 1024)))
+LOGS_SEGMENTO_HORAS = float(os.environ.get('MECANICA_LOGS_SEGMENTO_HORAS', '24'))
+LOGS_RETENCAO_DIAS = int(os.environ.get('MECANICA_LOGS_RETENCAO_DIAS', '365'))
+
+# Feed de alterações (/api/changes): quantas alterações recentes ficam em
+# memória para quem se reconectar, e por quanto tempo cada conexão SSE fica
+# aberta antes de o navegador reconectar sozinho
+FEED_LIMITE = int(os.environ.get('MECANICA_FEED_LIMITE', '1000'))
+FEED_DURACAO_CONEXAO = 300
+FEED_INTERVALO_PING = 15
+
+# Threads do servidor (waitress; com gunicorn, use o mesmo valor de --threads).
+# Cada conexão SSE ocupa uma thread, então no máximo MECANICA_FEED_CONEXOES
+# (padrão: metade das threads) ficam abertas ao mesmo tempo; os demais
+# clientes consultam o feed a cada FEED_INTERVALO_CONSULTA segundos.
+THREADS_SERVIDOR = int(os.environ.get('MECANICA_THREADS', '8'))
+FEED_MAX_CONEXOES = int(os.environ.get('MECANICA_FEED_CONEXOES', str(max(1, THREADS_SERVIDOR // 2))))
+FEED_INTERVALO_CONSULTA = 5
+# Com vários processos, de quanto em quanto tempo uma conexão SSE parada
+# verifica se outro processo gravou alguma coisa
+FEED_INTERVALO_PROCESSOS = 1
+
+# Profiler opcional: com MECANICA_PERFIL_MS definido, uma fração
+# (MECANICA_PERFIL_AMOSTRAGEM, padrão 1.0) das requisições é perfilada com
+# cProfile e as que passarem do limite em ms têm as estatísticas gravadas em
+# MECANICA_PERFIL_DIR (abrir com 'python -m pstats', snakeviz ou flameprof)
+PERFIL_LIMITE_MS = float(os.environ['MECANICA_PERFIL_MS']) if os.environ.get('MECANICA_PERFIL_MS') else None
+PERFIL_AMOSTRAGEM = float(os.environ.get('MECANICA_PERFIL_AMOSTRAGEM', '1.0'))
+PERFIL_DIR = os.environ.get('MECANICA_PERFIL_DIR', 'perfis')
+
+# Campos cobertos pela busca textual (/api/search), do mais para o menos
+# relevante na pontuação
+CAMPOS_BUSCA = {
+    'clientes': ['nome', 'cpfCnpj', 'telefone', 'email'],
+    'veiculos': ['placa', 'modelo', 'marca', 'cor'],
+    'pecas': ['codigo', 'descricao', 'fornecedor'],
+    'servicos': ['descricao', 'categoria'],
+}
+
+# Tabelas colunares de /api/analytics: entidades que geram as linhas, campos
+# de catálogo dos quais os valores dependem (se um deles mudar, a tabela é
+# refeita na próxima consulta), dimensões de agrupamento e medidas numéricas
+TABELAS_ANALISE = {
+    'financeiro': {
+        'origens': ('movimentacoes', 'despesasGerais'),
+        'dependencias': {},
+        'dimensoes': ('tipo', 'categoria', 'forma_pagamento', 'origem'),
+        'medidas': ('valor', 'saldo'),
+    },
+    'linhas_ordem': {
+        'origens': ('ordens',),
+        'dependencias': {'servicos': ('valorMaoObra', 'descricao', 'categoria'), 'pecas': ('precoVenda', 'descricao')},
+        'dimensoes': ('linha', 'item', 'categoria', 'status', 'forma_pagamento'),
+        'medidas': ('valor', 'quantidade'),
+    },
+}
+# Métrica -> (tabela, medida somada ou None para contar linhas, filtro fixo)
+METRICAS_ANALISE = {
+    'receita': ('financeiro', 'valor', {'tipo': 'receita'}),
+    'despesa': ('financeiro', 'valor', {'tipo': 'despesa'}),
+    'lucro': ('financeiro', 'saldo', None),
+    'lancamentos': ('financeiro', None, None),
+    'faturamento': ('linhas_ordem', 'valor', None),
+    'servicos': ('linhas_ordem', 'quantidade', {'linha': 'servico'}),
+    'pecas': ('linhas_ordem', 'quantidade', {'linha': 'peca'}),
+}
+AGRUPAMENTOS_TEMPO = ('dia', 'semana', 'mes', 'ano')
+
+# Campo de preço de cada item de catálogo usado no total das ordens
+CAMPOS_PRECO = {'servicos': 'valorMaoObra', 'pecas': 'precoVenda'}
+
+# Livro de estoque: a cada quantas movimentações de uma peça é guardado um
+# checkpoint do saldo acumulado (consultas por data somam no máximo isso)
+PASSO_CHECKPOINT_ESTOQUE = 256
+
+# A rota de estáticos é a static_files, abaixo (com cabeçalhos de cache);
+# por isso a rota padrão do Flask não é registrada
+app = Flask(__name__, static_folder=None, template_folder=TEMPLATE_FOLDER)
+app.static_folder = STATIC_FOLDER
+CORS(app, expose_headers=['X-Total-Count', 'X-Next-Offset', 'X-Next-Cursor'])
+
+# --- Métricas --- #
+class Metricas:
+    # Registro mínimo de métricas no formato texto do Prometheus: contadores,
+    # histogramas (em segundos) e medidores calculados na hora da coleta
+    LIMITES = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._descricoes = {}
+        self._contadores = {}
+        self._histogramas = {}
+        self._medidores = {}
+
+    def descrever(self, nome, tipo, descricao):
+        self._descricoes[nome] = (tipo, descricao)
+
+    def incrementar(self, nome, valor=1, **rotulos):
+        chave = (nome, tuple(sorted(rotulos.items())))
+        with self._lock:
+            self._contadores[chave] = self._contadores.get(chave, 0) + valor
+
+    def observar(self, nome, valor, **rotulos):
+        chave = (nome, tuple(sorted(rotulos.items())))
+        posicao = bisect.bisect_left(self.LIMITES, valor)
+        with self._lock:
+            histograma = self._histogramas.get(chave)
+            if histograma is None:
+                histograma = self._histogramas[chave] = [[0] * (len(self.LIMITES) + 1), 0.0, 0]
+            histograma[0][posicao] += 1
+            histograma[1] += valor
+            histograma[2] += 1
+
+    @contextmanager
+    def cronometrar(self, nome, **rotulos):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(nome, time.perf_counter() - inicio, **rotulos)
+
+    def registrar_medidor(self, nome, funcao):
+        # funcao() devolve uma lista de (rótulos, valor)
+        self._medidores[nome] = funcao
+
+    @staticmethod
+    def _rotulos(rotulos, extra=None):
+        pares = list(rotulos) + ([extra] if extra else [])
+        if not pares:
+            return ''
+        escapar = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{chave}="{escapar(valor)}"' for chave, valor in pares) + '}'
+
+    def texto(self):
+        with self._lock:
+            contadores = dict(self._contadores)
+            histogramas = {chave: (list(h[0]), h[1], h[2]) for chave, h in self._histogramas.items()}
+        series = {}
+        for (nome, rotulos), valor in contadores.items():
+            series.setdefault(nome, []).append(f'{nome}{self._rotulos(rotulos)} {valor}')
+        for (nome, rotulos), (baldes, soma, total) in histogramas.items():
+            linhas = series.setdefault(nome, [])
+            acumulado = 0
+            for limite, quantidade in zip(self.LIMITES + ('+Inf',), baldes):
+                acumulado += quantidade
+                linhas.append(f'{nome}_bucket{self._rotulos(rotulos, ("le", limite))} {acumulado}')
+            linhas.append(f'{nome}_sum{self._rotulos(rotulos)} {soma}')
+            linhas.append(f'{nome}_count{self._rotulos(rotulos)} {total}')
+        for nome, funcao in self._medidores.items():
+            series[nome] = [f'{nome}{self._rotulos(sorted(rotulos.items()))} {valor}' for rotulos, valor in funcao()]
+
+        saida = []
+        for nome in sorted(series):
+            tipo, descricao = self._descricoes.get(nome, ('untyped', nome))
+            saida.append(f'# HELP {nome} {descricao}')
+            saida.append(f'# TYPE {nome} {tipo}')
+            saida.extend(series[nome])
+        return '\n'.join(saida) + '\n'
+
+
+metricas = Metricas()
+metricas.descrever('mecanica_http_requisicoes_total', 'counter', 'Requisições HTTP atendidas, por rota, método e status')
+metricas.descrever('mecanica_http_duracao_segundos', 'histogram', 'Tempo de resposta das requisições HTTP (inclui a espera pela trava)')
+metricas.descrever('mecanica_persistencia_duracao_segundos', 'histogram', 'Tempo das operações de persistência (carregar, salvar, registrar, serializar, gravar, fsync)')
+metricas.descrever('mecanica_persistencia_bytes_total', 'counter', 'Bytes gravados em disco, por destino')
+metricas.descrever('mecanica_trava_espera_segundos', 'histogram', 'Tempo de espera para obter a trava de leitura ou de escrita')
+metricas.descrever('mecanica_entidade_registros', 'gauge', 'Quantidade de registros por entidade')
+metricas.descrever('mecanica_perfis_gravados_total', 'counter', 'Arquivos de perfil (cProfile) gravados para requisições lentas')
+
+# --- Concorrência --- #
+class TravaLeituraEscrita:
+    # Vários leitores ao mesmo tempo ou um único escritor. Escritores na fila
+    # bloqueiam novos leitores, para não ficarem esperando para sempre. É
+    # reentrante na mesma thread: quem escreve também pode ler, e quem lê pode
+    # ler de novo (mas não pode passar de leitura para escrita).
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._leitores = 0
+        self._escritor = None
+        self._profundidade_escrita = 0
+        self._escritores_esperando = 0
+        self._local = threading.local()
+
+    def adquirir_leitura(self):
+        eu = threading.get_ident()
+        if self._escritor == eu:
+            self._local.leituras_do_escritor = getattr(self._local, 'leituras_do_escritor', 0) + 1
+            return
+        leituras = getattr(self._local, 'leituras', 0)
+        if leituras == 0:
+            inicio = time.perf_counter()
+            with self._cond:
+                while self._escritor is not None or self._escritores_esperando:
+                    self._cond.wait()
+                self._leitores += 1
+            metricas.observar('mecanica_trava_espera_segundos', time.perf_counter() - inicio, tipo='leitura')
+        self._local.leituras = leituras + 1
+
+    def liberar_leitura(self):
+        if getattr(self._local, 'leituras_do_escritor', 0):
+            self._local.leituras_do_escritor -= 1
+            return
+        self._local.leituras -= 1
+        if self._local.leituras == 0:
+            with self._cond:
+                self._leitores -= 1
+                if self._leitores == 0:
+                    self._cond.notify_all()
+
+    def adquirir_escrita(self):
+        # Retorna True quando é a escrita mais externa
+        eu = threading.get_ident()
+        if self._escritor == eu:
+            self._profundidade_escrita += 1
+            return False
+        if getattr(self._local, 'leituras', 0):
+            raise RuntimeError('Não é possível passar de leitura para escrita na mesma thread')
+        inicio = time.perf_counter()
+        with self._cond:
+            self._escritores_esperando += 1
+            try:
+                while self._escritor is not None or self._leitores:
+                    self._cond.wait()
+            finally:
+                self._escritores_esperando -= 1
+            self._escritor = eu
+            self._profundidade_escrita = 1
+        metricas.observar('mecanica_trava_espera_segundos', time.perf_counter() - inicio, tipo='escrita')
+        return True
+
+    def liberar_escrita(self):
+        # Retorna True quando a escrita mais externa foi liberada
+        self._profundidade_escrita -= 1
+        if self._profundidade_escrita:
+            return False
+        with self._cond:
+            self._escritor = None
+            self._cond.notify_all()
+        return True
+
+    def escrevendo(self):
+        # Se a thread atual é a dona da trava de escrita
+        return self._escritor == threading.get_ident()
+
+    def escrita_mais_externa(self):
+        # Se a próxima liberação da thread atual solta a trava de escrita
+        return self.escrevendo() and self._profundidade_escrita == 1
+
+    @contextmanager
+    def leitura(self):
+        self.adquirir_leitura()
+        try:
+            yield
+        finally:
+            self.liberar_leitura()
+
+
+class TravaProcessos:
+    # Trava entre processos (flock) em um arquivo compartilhado. O flock vale
+    # por descritor aberto, não por thread: quem usa já precisa estar
+    # serializado dentro do processo. Os descritores não podem ser herdados
+    # de um fork (gunicorn sem --preload).
+    def __init__(self, caminho):
+        if fcntl is None:
+            raise RuntimeError('MECANICA_MULTIPROCESSO requer fcntl (Linux ou macOS)')
+        self.caminho = caminho
+        self._fd = os.open(caminho, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def adquirir(self, compartilhada=False):
+        inicio = time.perf_counter()
+        fcntl.flock(self._fd, fcntl.LOCK_SH if compartilhada else fcntl.LOCK_EX)
+        metricas.observar('mecanica_trava_espera_segundos', time.perf_counter() - inicio, tipo='processos')
+
+    def liberar(self):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @contextmanager
+    def travada(self, compartilhada=False):
+        self.adquirir(compartilhada)
+        try:
+            yield
+        finally:
+            self.liberar()
+
+
+def _com_escrita(metodo):
+    @functools.wraps(metodo)
+    def envoltorio(self, *args, **kwargs):
+        with self.escrita():
+            return metodo(self, *args, **kwargs)
+    return envoltorio
+
+
+def _em_transacao(metodo):
+    # Para operações compostas: tudo ou nada, com uma única gravação
+    @functools.wraps(metodo)
+    def envoltorio(self, *args, **kwargs):
+        with self.transacao():
+            return metodo(self, *args, **kwargs)
+    return envoltorio
+
+
+# --- Persistência --- #
+# Máscara de criação do processo (os.umask só pode ser lida trocando-a)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def _copiar_permissoes(temporario, caminho):
+    # O mkstemp cria o temporário com 0600: antes de substituir, ele recebe
+    # as permissões do arquivo atual ou, se não houver, as de um open() comum
+    try:
+        modo = stat.S_IMODE(os.stat(caminho).st_mode)
+    except FileNotFoundError:
+        modo = 0o666 & ~_UMASK
+    os.chmod(temporario, modo)
+
+
+def _gravar_json_atomico(caminho, data):
+    # Grava em arquivo temporário e renomeia, para nunca deixar o arquivo pela metade
+    fd, temporario = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(caminho)), suffix='.tmp')
+    try:
+        # Serialização e escrita são medidas em separado: o texto é gerado em
+        # pedaços e gravado a cada ~1 MB
+        serializacao = escrita = 0.0
+        gravados = 0
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            pedacos, tamanho = [], 0
+            inicio = time.perf_counter()
+            for pedaco in json.JSONEncoder(indent=4, ensure_ascii=False).iterencode(data):
+                pedacos.append(pedaco)
+                tamanho += len(pedaco)
+                if tamanho >= 1 << 20:
+                    serializacao += time.perf_counter() - inicio
+                    inicio = time.perf_counter()
+                    gravados += f.write(''.join(pedacos))
+                    escrita += time.perf_counter() - inicio
+                    pedacos, tamanho = [], 0
+                    inicio = time.perf_counter()
+            serializacao += time.perf_counter() - inicio
+            inicio = time.perf_counter()
+            gravados += f.write(''.join(pedacos))
+            f.flush()
+            escrita += time.perf_counter() - inicio
+            with metricas.cronometrar('mecanica_persistencia_duracao_segundos', operacao='fsync'):
+                os.fsync(f.fileno())
+            gravados = f.tell()
+        _copiar_permissoes(temporario, caminho)
+        os.replace(temporario, caminho)
+        metricas.observar('mecanica_persistencia_duracao_segundos', serializacao, operacao='serializar')
+        metricas.observar('mecanica_persistencia_duracao_segundos', escrita, operacao='gravar')
+        metricas.incrementar('mecanica_persistencia_bytes_total', gravados, destino='snapshot')
+    except BaseException:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+        raise
+
+
+class ArmazenamentoJSON:
+    # Modo original: cada alteração regrava o arquivo de dados inteiro
+    def __init__(self, caminho):
+        self.caminho = caminho
+
+    def carregar(self):
+        if not os.path.exists(self.caminho):
+            return None
+        with open(self.caminho, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def salvar(self, data):
+        _gravar_json_atomico(self.caminho, data)
+
+    def registrar(self, data, registro, item=None):
+        self.registrar_lote(data, [(registro, item)])
+
+    def registrar_lote(self, data, registros):
+        self.salvar(data)
+
+    def sincronizar_pendentes(self):
+        pass
+
+    def iniciar_restauracao(self):
+        return RestauracaoMemoria()
+
+    def concluir_restauracao(self, restauracao, data):
+        # Chamado com a trava de escrita. Entidades que não vieram no backup
+        # continuam como estão.
+        novo = dict(data.items())
+        novo.update(restauracao.dados)
+        self.salvar(novo)
+        return novo
+
+    def fechar(self):
+        pass
+
+
+class RestauracaoMemoria:
+    # Restauração acumulada em memória, para os modos em que os dados só são
+    # gravados inteiros (JSON): o pico é o backup inteiro mais os dados atuais
+    def __init__(self):
+        self.dados = {}
+
+    def entidades(self):
+        return list(self.dados)
+
+    def adicionar(self, entity_name, itens):
+        self.dados.setdefault(entity_name, []).extend(itens)
+
+    def preparar(self):
+        pass
+
+    def descartar(self):
+        self.dados = {}
+
+
+# Snapshot binário: cabeçalho (assinatura + posição do índice), uma seção
+# pickle (protocolo 5) por entidade e, no fim, o índice com a posição, o
+# tamanho e a quantidade de registros de cada seção
+ASSINATURA_SNAPSHOT = b'MECSNAP1'
+_NAO_DECODIFICADA = object()
+
+
+class SecaoBruta:
+    # Seção do snapshot ainda não decodificada, copiada como bytes
+    __slots__ = ('bruto', 'registros')
+
+    def __init__(self, bruto, registros):
+        self.bruto = bruto
+        self.registros = registros
+
+
+class DadosPreguicosos(dict):
+    # Dicionário de entidades lido do snapshot binário mapeado em memória. As
+    # chaves existem desde o início, mas cada lista só é decodificada no
+    # primeiro acesso. Toda leitura de valor passa por __getitem__, get,
+    # items ou values, que decodificam sob demanda.
+    def __init__(self, mapa, secoes):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._mapa = mapa
+        self._secoes = {}
+        for nome, (posicao, tamanho, registros) in secoes.items():
+            dict.__setitem__(self, nome, _NAO_DECODIFICADA)
+            self._secoes[nome] = (mapa, posicao, tamanho, registros)
+
+    def _decodificar(self, nome):
+        with self._lock:
+            valor = dict.__getitem__(self, nome)
+            if valor is _NAO_DECODIFICADA:
+                with metricas.cronometrar('mecanica_persistencia_duracao_segundos', operacao='decodificar'):
+                    valor = self._ler_secao(nome, self._secoes.pop(nome))
+                dict.__setitem__(self, nome, valor)
+            return valor
+
+    def _ler_secao(self, nome, secao):
+        origem, posicao, tamanho, _ = secao
+        return pickle.loads(origem[posicao:posicao + tamanho])
+
+    def pendente(self, nome):
+        # Se a entidade ainda não foi decodificada
+        return dict.get(self, nome) is _NAO_DECODIFICADA
+
+    def entidades(self):
+        # Nomes das entidades (listas), sem decodificar nada
+        return [nome for nome, valor in dict.items(self) if valor is _NAO_DECODIFICADA or isinstance(valor, list)]
+
+    def __getitem__(self, nome):
+        valor = dict.__getitem__(self, nome)
+        return self._decodificar(nome) if valor is _NAO_DECODIFICADA else valor
+
+    def get(self, nome, padrao=None):
+        return self[nome] if nome in self else padrao
+
+    def __setitem__(self, nome, valor):
+        with self._lock:
+            self._secoes.pop(nome, None)
+            dict.__setitem__(self, nome, valor)
+
+    def __delitem__(self, nome):
+        with self._lock:
+            self._secoes.pop(nome, None)
+            dict.__delitem__(self, nome)
+
+    def update(self, *args, **kwargs):
+        for nome, valor in dict(*args, **kwargs).items():
+            self[nome] = valor
+
+    def setdefault(self, nome, padrao=None):
+        if nome not in self:
+            self[nome] = padrao
+        return self[nome]
+
+    def pop(self, nome, *padrao):
+        if nome not in self:
+            if padrao:
+                return padrao[0]
+            raise KeyError(nome)
+        valor = self[nome]
+        del self[nome]
+        return valor
+
+    def items(self):
+        return [(nome, self[nome]) for nome in list(self)]
+
+    def values(self):
+        return [self[nome] for nome in list(self)]
+
+    def tamanhos(self):
+        # Quantidade de registros por entidade, sem decodificar nada
+        with self._lock:
+            return {nome: self._secoes[nome][3] if valor is _NAO_DECODIFICADA else len(valor)
+                    for nome, valor in dict.items(self) if valor is _NAO_DECODIFICADA or isinstance(valor, list)}
+
+    def copia_rasa(self, copiar=lambda valor: valor):
+        # Para gravar um novo snapshot: o que ainda não foi decodificado vai
+        # como bytes, sem passar pelo pickle de novo
+        with self._lock:
+            copia = {}
+            for nome, valor in dict.items(self):
+                if valor is _NAO_DECODIFICADA:
+                    origem, posicao, tamanho, registros = self._secoes[nome]
+                    copia[nome] = SecaoBruta(origem[posicao:posicao + tamanho], registros)
+                else:
+                    copia[nome] = copiar(valor)
+            return copia
+
+    def desmapear(self):
+        # Traz para a memória as seções pendentes e fecha o mapeamento, para
+        # que o arquivo possa ser substituído (no Windows, um arquivo mapeado
+        # não pode ser trocado)
+        with self._lock:
+            for nome, (origem, posicao, tamanho, registros) in list(self._secoes.items()):
+                self._secoes[nome] = (origem[posicao:posicao + tamanho], 0, tamanho, registros)
+            if self._mapa is not None:
+                self._mapa.close()
+                self._mapa = None
+
+    def remapear(self, mapa, secoes):
+        # Aponta as seções ainda pendentes para o novo snapshot (os bytes são
+        # os mesmos, só mudam as posições)
+        with self._lock:
+            self._mapa = mapa
+            for nome in list(self._secoes):
+                if nome in secoes:
+                    posicao, tamanho, registros = secoes[nome]
+                    self._secoes[nome] = (mapa, posicao, tamanho, registros)
+
+
+class DadosSQLite(DadosPreguicosos):
+    # Entidades do SQLite: cada tabela só é lida inteira no primeiro acesso à
+    # lista. Até lá, buscas por id e filtros pelas colunas indexadas vão
+    # direto ao banco (ArmazenamentoSQLite.buscar e filtrar).
+    def __init__(self, armazenamento, totais):
+        super().__init__(None, {nome: (0, 0, total) for nome, total in totais.items()})
+        self._armazenamento = armazenamento
+
+    def _ler_secao(self, nome, secao):
+        return self._armazenamento.ler_tabela(nome)
+
+
+def _mapear_snapshot(caminho):
+    with open(caminho, 'rb') as f:
+        mapa = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapa[:len(ASSINATURA_SNAPSHOT)] != ASSINATURA_SNAPSHOT:
+        mapa.close()
+        raise ValueError(f'Snapshot inválido: {caminho}')
+    inicio = len(ASSINATURA_SNAPSHOT)
+    (posicao_indice,) = struct.unpack('<Q', mapa[inicio:inicio + 8])
+    indice = pickle.loads(mapa[posicao_indice:])
+    return mapa, indice['secoes']
+
+
+class GravadorSnapshot:
+    # Grava um snapshot binário seção por seção; o índice só vai para o
+    # arquivo (e o arquivo só substitui o atual) em concluir()
+    def __init__(self, caminho):
+        self.caminho = caminho
+        fd, self._temporario = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(caminho)), suffix='.tmp')
+        self._arquivo = os.fdopen(fd, 'wb')
+        self._arquivo.write(ASSINATURA_SNAPSHOT + struct.pack('<Q', 0))
+        self._secoes = {}
+
+    def secao(self, nome, valor):
+        if isinstance(valor, SecaoBruta):
+            bruto, registros = valor.bruto, valor.registros
+        else:
+            bruto = pickle.dumps(valor, protocol=5)
+            registros = len(valor) if isinstance(valor, list) else None
+        self._secoes[nome] = (self._arquivo.tell(), len(bruto), registros)
+        self._arquivo.write(bruto)
+
+    def concluir(self, antes_de_substituir=None):
+        f = self._arquivo
+        posicao_indice = f.tell()
+        f.write(pickle.dumps({'versao': 1, 'secoes': self._secoes}, protocol=5))
+        f.seek(len(ASSINATURA_SNAPSHOT))
+        f.write(struct.pack('<Q', posicao_indice))
+        f.flush()
+        with metricas.cronometrar('mecanica_persistencia_duracao_segundos', operacao='fsync'):
+            os.fsync(f.fileno())
+        gravados = f.seek(0, os.SEEK_END)
+        f.close()
+        _copiar_permissoes(self._temporario, self.caminho)
+        if antes_de_substituir is not None:
+            antes_de_substituir()
+        os.replace(self._temporario, self.caminho)
+        metricas.incrementar('mecanica_persistencia_bytes_total', gravados, destino='snapshot')
+
+    def descartar(self):
+        self._arquivo.close()
+        if os.path.exists(self._temporario):
+            os.remove(self._temporario)
+
+
+def _gravar_snapshot_binario(caminho, data, antes_de_substituir=None):
+    if isinstance(data, DadosPreguicosos):
+        data = data.copia_rasa()
+    gravador = GravadorSnapshot(caminho)
+    try:
+        with metricas.cronometrar('mecanica_persistencia_duracao_segundos', operacao='serializar'):
+            for nome, valor in data.items():
+                gravador.secao(nome, valor)
+        gravador.concluir(antes_de_substituir)
+    except BaseException:
+        gravador.descartar()
+        raise
+
+
+class RestauracaoSnapshot:
+    # Cada lote vai para um arquivo temporário da sua entidade; preparar()
+    # monta o novo snapshot uma entidade por vez, fora da trava de escrita.
+    # Só a maior entidade do backup fica inteira na memória.
+    def __init__(self, caminho_snapshot):
+        self._diretorio = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(caminho_snapshot)),
+                                           suffix='.restaurando')
+        self._arquivos = {}
+        self.gravador = GravadorSnapshot(caminho_snapshot)
+
+    def entidades(self):
+        return list(self._arquivos)
+
+    def adicionar(self, entity_name, itens):
+        arquivo = self._arquivos.get(entity_name)
+        if arquivo is None:
+            caminho = os.path.join(self._diretorio, f'{len(self._arquivos)}.pkl')
+            arquivo = self._arquivos[entity_name] = open(caminho, 'w+b')
+        if itens:
+            pickle.dump(itens, arquivo, protocol=5)
+
+    def preparar(self):
+        with metricas.cronometrar('mecanica_persistencia_duracao_segundos', operacao='serializar'):
+            for entity_name, arquivo in self._arquivos.items():
+                arquivo.seek(0)
+                itens = []
+                while True:
+                    try:
+                        itens.extend(pickle.load(arquivo))
+                    except EOFError:
+                        break
+                self.gravador.secao(entity_name, itens)
+                del itens
+                arquivo.close()
+
+    def descartar(self):
+        for arquivo in self._arquivos.values():
+            arquivo.close()
+        shutil.rmtree(self._diretorio, ignore_errors=True)
+        self.gravador.descartar()
+
+
+class ArmazenamentoJournal(ArmazenamentoJSON):
+    # Cada alteração vira uma linha JSON compacta no journal. O fsync fica para
+    # sincronizar_pendentes(), chamado depois que a trava de escrita é liberada,
+    # e é feito em grupo (quem chega durante um fsync espera o próximo, que
+    # cobre todos). Ao passar do limite de registros, o journal é compactado em
+    # um novo snapshot em segundo plano. Com caminho_snapshot, o snapshot é
+    # binário e o JSON em 'caminho' só é lido enquanto o snapshot não existe
+    # (bases antigas); depois disso, só com 'importar-json'.
+    #
+    # Com multiprocesso, outros processos gravam no mesmo journal (sempre com
+    # a TravaProcessos exclusiva) e este acompanha o que eles gravaram a partir
+    # da última posição lida. Cada journal começa com um cabeçalho que aponta
+    # para o anterior; se a corrente se perde (duas compactações sem leitura
+    # no meio, ou uma restauração), é preciso recarregar tudo.
+    #
+    # Só o dono do journal (o servidor, não os comandos de linha, que podem
+    # rodar com ele no ar) corta uma linha incompleta no fim do arquivo; com
+    # vários processos, só enquanto tem a trava entre processos exclusiva.
+    def __init__(self, caminho, caminho_journal, limite_compactacao, caminho_snapshot=None, multiprocesso=False,
+                 dono=True):
+        super().__init__(caminho)
+        self.dono = dono
+        self.caminho_snapshot = caminho_snapshot
+        self._mapeados = None
+        self.caminho_journal = caminho_journal
+        self.caminho_compactando = caminho_journal + '.compactando'
+        self.limite_compactacao = limite_compactacao
+        self._cond = threading.Condition()
+        self._fd = None
+        self._seq_escrito = 0
+        self._seq_sincronizado = 0
+        self._sincronizando = False
+        self._registros_desde_snapshot = 0
+        self._compactacao = None
+        self._obter_copia = None
+        self._local = threading.local()
+        self.multiprocesso = multiprocesso
+        self._id_journal = None
+        self._leitura = None
+        self._posicao_leitura = 0
+        self._compactacao_pendente = False
+
+    def _carregar_snapshot(self):
+        snapshot = self.caminho_snapshot
+        if snapshot and os.path.exists(snapshot):
+            self._mapeados = DadosPreguicosos(*_mapear_snapshot(snapshot))
+            return self._mapeados
+        return super().carregar()
+
+    def _gravar_snapshot(self, data):
+        if not self.caminho_snapshot:
+            return ArmazenamentoJSON.salvar(self, data)
+        mapeados = self._mapeados
+        _gravar_snapshot_binario(self.caminho_snapshot, data, mapeados.desmapear if mapeados is not None else None)
+        if mapeados is not None:
+            mapeados.remapear(*_mapear_snapshot(self.caminho_snapshot))
+
+    def carregar(self, exclusiva=True):
+        # Também usado para recarregar tudo com vários processos (exclusiva
+        # diz se quem chama tem a trava entre processos exclusiva)
+        cortar = self.dono and (exclusiva or not self.multiprocesso)
+        self._registros_desde_snapshot = 0
+        self._id_journal = None
+        self._mapeados = None
+        data = self._carregar_snapshot()
+        if data is None and not os.path.exists(self.caminho_journal):
+            return None
+        data = data or {}
+        # Um '.compactando' remanescente indica que o processo caiu durante a compactação
+        for caminho in (self.caminho_compactando, self.caminho_journal):
+            self._registros_desde_snapshot += self._reaplicar(data, caminho, cortar)
+        if self.multiprocesso:
+            with self._cond:
+                self._fechar_journal()
+            self._seguir_journal()
+        return data
+
+    def _reaplicar(self, data, caminho, cortar):
+        if not os.path.exists(caminho):
+            return 0
+        mapas = {}
+        total = 0
+        valido_ate = 0
+        with open(caminho, 'rb') as f:
+            for linha in f:
+                try:
+                    registro = json.loads(linha)
+                except ValueError:
+                    # Última linha incompleta (queda durante a escrita, ou o dono
+                    # ainda gravando): descartada. O dono também a corta do arquivo,
+                    # para que os próximos registros não colem nela.
+                    if cortar:
+                        os.truncate(caminho, valido_ate)
+                    break
+                valido_ate += len(linha)
+                if registro['op'] == 'inicio':
+                    # Cabeçalho do modo de vários processos
+                    self._id_journal = registro['journal']
+                    continue
+                entidade = registro['entidade']
+                if entidade not in mapas:
+                    mapas[entidade] = {item.get('id'): item for item in data.get(entidade, [])}
+                mapa = mapas[entidade]
+                if registro['op'] == 'inserir':
+                    mapa[registro['id']] = registro['dados']
+                elif registro['op'] == 'atualizar':
+                    if registro['id'] in mapa:
+                        mapa[registro['id']].update(registro['dados'])
+                elif registro['op'] == 'remover':
+                    mapa.pop(registro['id'], None)
+                total += 1
+        for entidade, mapa in mapas.items():
+            data[entidade] = list(mapa.values())
+        return total
+
+    def _abrir(self):
+        if self._fd is None:
+            self._fd = os.open(self.caminho_journal, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            if self.multiprocesso:
+                self._iniciar_journal()
+
+    # --- Vários processos --- #
+    def _iniciar_journal(self):
+        # Chamado com a trava entre processos, logo depois de abrir o journal
+        # para escrita: até aqui tudo que os outros gravaram já foi lido
+        if os.fstat(self._fd).st_size == 0:
+            novo = uuid.uuid4().hex
+            cabecalho = {'op': 'inicio', 'journal': novo, 'anterior': self._id_journal}
+            os.write(self._fd, (json.dumps(cabecalho, separators=(',', ':')) + '\n').encode('utf-8'))
+            self._id_journal = novo
+        if self._leitura is None or not os.path.samestat(os.fstat(self._leitura), os.fstat(self._fd)):
+            self._seguir_journal()
+
+    def _seguir_journal(self):
+        # Passa a acompanhar o journal atual a partir do fim
+        if self._leitura is not None:
+            os.close(self._leitura)
+            self._leitura = None
+        self._posicao_leitura = 0
+        try:
+            self._leitura = os.open(self.caminho_journal, os.O_RDWR)
+        except FileNotFoundError:
+            return
+        self._posicao_leitura = os.fstat(self._leitura).st_size
+
+    def ha_alteracoes_externas(self):
+        # Verificação barata (dois stat), feita antes de cada requisição
+        try:
+            estado = os.stat(self.caminho_journal)
+        except FileNotFoundError:
+            estado = None
+        if self._leitura is None:
+            return estado is not None
+        atual = os.fstat(self._leitura)
+        if estado is not None and not os.path.samestat(estado, atual):
+            return True
+        return atual.st_size > self._posicao_leitura
+
+    def alteracoes_externas(self, exclusiva=False):
+        # Registros gravados por outros processos desde a última leitura, na
+        # ordem do journal, ou None quando é preciso recarregar tudo. Com a
+        # trava exclusiva ninguém está escrevendo, então uma linha incompleta
+        # no fim é de um processo que caiu e pode ser cortada.
+        registros = []
+        while True:
+            if self._leitura is not None:
+                registros.extend(self._ler_journal(exclusiva))
+            try:
+                fd = os.open(self.caminho_journal, os.O_RDWR)
+            except FileNotFoundError:
+                # Entre a rotação e o primeiro registro do journal novo
+                return registros
+            if self._leitura is not None and os.path.samestat(os.fstat(fd), os.fstat(self._leitura)):
+                os.close(fd)
+                return registros
+            # Outro processo compactou ou o journal acabou de ser criado. O
+            # antigo não muda mais depois da rotação: lê o que ele gravou entre
+            # a leitura acima e a rotação, antes de trocar de arquivo
+            if self._leitura is not None:
+                registros.extend(self._ler_journal(exclusiva))
+            primeira = os.pread(fd, 4096, 0)
+            if b'\n' not in primeira:
+                # Cabeçalho ainda não gravado
+                os.close(fd)
+                return registros
+            primeira = primeira[:primeira.index(b'\n') + 1]
+            cabecalho = json.loads(primeira)
+            if cabecalho.get('op') != 'inicio' or cabecalho.get('anterior') != self._id_journal:
+                os.close(fd)
+                return None
+            if self._leitura is not None:
+                os.close(self._leitura)
+            self._leitura = fd
+            self._posicao_leitura = len(primeira)
+            self._id_journal = cabecalho['journal']
+            # O snapshot do outro processo já cobre o journal antigo
+            self._registros_desde_snapshot = 0
+            self._compactacao_pendente = False
+            with self._cond:
+                # O descritor de escrita ainda aponta para o journal antigo
+                if self._fd is not None and not os.path.samestat(os.fstat(self._fd), os.fstat(fd)):
+                    self._fechar_journal()
+
+    def _ler_journal(self, exclusiva):
+        tamanho = os.fstat(self._leitura).st_size
+        if tamanho <= self._posicao_leitura:
+            return []
+        dados = os.pread(self._leitura, tamanho - self._posicao_leitura, self._posicao_leitura)
+        completos = dados.rfind(b'\n') + 1
+        if exclusiva and completos < len(dados):
+            os.ftruncate(self._leitura, self._posicao_leitura + completos)
+        registros = [registro for registro in map(json.loads, dados[:completos].splitlines())
+                     if registro['op'] != 'inicio']
+        self._posicao_leitura += completos
+        self._registros_desde_snapshot += len(registros)
+        if self._registros_desde_snapshot >= self.limite_compactacao:
+            self.compactar_em_segundo_plano()
+        return registros
+
+    def registrar_lote(self, data, registros):
+        # Um único write para o lote inteiro
+        with metricas.cronometrar('mecanica_persistencia_duracao_segundos', operacao='serializar'):
+            linhas = b''.join(
+                (json.dumps(registro, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+                for registro, _ in registros
+            )
+        with self._cond:
+            self._abrir()
+            with metricas.cronometrar('mecanica_persistencia_duracao_segundos', operacao='gravar'):
+                os.write(self._fd, linhas)
+            if self.multiprocesso:
+                # O que este processo grava não precisa ser lido de volta
+                self._posicao_leitura += len(linhas)
+            self._seq_escrito += 1
+            seq = self._seq_escrito
+            self._registros_desde_snapshot += len(registros)
+            compactar = self._registros_desde_snapshot >= self.limite_compactacao
+        metricas.incrementar('mecanica_persistencia_bytes_total', len(linhas), destino='journal')
+        self._local.pendente = seq
+        if compactar:
+            self.compactar_em_segundo_plano()
+
+    def sincronizar_pendentes(self):
+        seq = getattr(self._local, 'pendente', 0)
+        if seq:
+            self._local.pendente = 0
+            self._sincronizar(seq)
+
+    def _sincronizar(self, seq):
+        with self._cond:
+            while self._seq_sincronizado < seq:
+                if self._sincronizando:
+                    self._cond.wait()
+                    continue
+                self._sincronizando = True
+                alvo = self._seq_escrito
+                fd = self._fd
+                self._cond.release()
+                try:
+                    with metricas.cronometrar('mecanica_persistencia_duracao_segundos', operacao='fsync'):
+                        os.fsync(fd)
+                finally:
+                    self._cond.acquire()
+                    self._sincronizando = False
+                    self._seq_sincronizado = max(self._seq_sincronizado, alvo)
+                    self._cond.notify_all()
+
+    def _rotacionar(self):
+        # Tudo que já está no journal atual também já está na memória, então
+        # o snapshot tirado depois da rotação cobre o journal rotacionado
+        with self._cond:
+            self._fechar_journal()
+            if os.path.exists(self.caminho_journal):
+                os.replace(self.caminho_journal, self.caminho_compactando)
+            self._registros_desde_snapshot = 0
+
+    def _fechar_journal(self):
+        # Chamado com self._cond
+        while self._sincronizando:
+            self._cond.wait()
+        if self._fd is not None:
+            os.fsync(self._fd)
+            os.close(self._fd)
+            self._fd = None
+        self._seq_sincronizado = self._seq_escrito
+
+    def salvar(self, data):
+        self._rotacionar()
+        self._gravar_snapshot(data)
+        self._depois_de_substituir()
+
+    def _depois_de_substituir(self):
+        if os.path.exists(self.caminho_compactando):
+            os.remove(self.caminho_compactando)
+        if self.multiprocesso:
+            # Os dados foram substituídos: o journal novo não continua a
+            # corrente, então os outros processos recarregam tudo
+            self._id_journal = uuid.uuid4().hex
+            with self._cond:
+                self._abrir()
+
+    def iniciar_restauracao(self):
+        if not self.caminho_snapshot:
+            return super().iniciar_restauracao()
+        return RestauracaoSnapshot(self.caminho_snapshot)
+
+    def concluir_restauracao(self, restauracao, data):
+        if not isinstance(restauracao, RestauracaoSnapshot):
+            return super().concluir_restauracao(restauracao, data)
+        # As entidades que não vieram no backup entram no novo snapshot como
+        # estão (as ainda não decodificadas, como bytes)
+        restauradas = set(restauracao.entidades())
+        atuais = data.copia_rasa() if isinstance(data, DadosPreguicosos) else data
+        for entity_name, valor in atuais.items():
+            if entity_name not in restauradas:
+                restauracao.gravador.secao(entity_name, valor)
+        del atuais
+        self._rotacionar()
+        mapeados = self._mapeados
+        restauracao.gravador.concluir(mapeados.desmapear if mapeados is not None else None)
+        self._depois_de_substituir()
+        self._mapeados = DadosPreguicosos(*_mapear_snapshot(self.caminho_snapshot))
+        return self._mapeados
+
+    def compactar_em_segundo_plano(self):
+        if self.multiprocesso:
+            # Só quem tem a trava entre processos pode trocar o journal: a
+            # compactação fica para compactar_pendente()
+            self._compactacao_pendente = True
+            return
+        if self._obter_copia is None or (self._compactacao and self._compactacao.is_alive()):
+            return
+        self._compactacao = threading.Thread(target=self._compactar, daemon=True)
+        self._compactacao.start()
+
+    def _compactar(self):
+        # Reaplicar o journal é idempotente, então não há problema se a cópia
+        # já incluir alterações que também aparecem no journal novo
+        self._rotacionar()
+        self._gravar_snapshot(self._obter_copia())
+        if os.path.exists(self.caminho_compactando):
+            os.remove(self.caminho_compactando)
+        if self.multiprocesso:
+            # Já cria o journal novo, para os outros processos seguirem a corrente
+            with self._cond:
+                self._abrir()
+
+    def compactar_pendente(self):
+        # Com vários processos, chamado por quem está para soltar a trava
+        # entre processos; o snapshot é gravado ali mesmo
+        if not self._compactacao_pendente or self._obter_copia is None:
+            return
+        self._compactacao_pendente = False
+        try:
+            self._compactar()
+        except Exception as e:
+            print(f'❌ Erro ao compactar o journal: {e}')
+
+    def fechar(self):
+        if self._compactacao and self._compactacao.is_alive():
+            self._compactacao.join()
+        with self._cond:
+            if self._fd is not None:
+                os.fsync(self._fd)
+                os.close(self._fd)
+                self._fd = None
+            if self._leitura is not None:
+                os.close(self._leitura)
+                self._leitura = None
+
+
+class ArmazenamentoSQLite:
+    # Uma tabela por entidade: o registro completo vai em 'dados' (JSON) e as
+    # chaves estrangeiras mais usadas ganham colunas indexadas. Cada alteração
+    # é um único comando parametrizado (o sqlite3 reaproveita o statement
+    # preparado), com o banco em modo WAL.
+    COLUNAS = ('cliente_id', 'veiculo_id', 'ordem_id', 'peca_id', 'status')
+    # Tabelas de uma restauração em andamento (ver iniciar_restauracao)
+    PREFIXO_RESTAURACAO = '_restaurando_'
+    _PADRAO_RESTAURACAO = PREFIXO_RESTAURACAO.replace('_', '\\_') + '%'
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(caminho, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._sql = {}
+        self._local = threading.local()
+
+    @staticmethod
+    def _tabela(entity_name):
+        return '"' + entity_name.replace('"', '""') + '"'
+
+    def _tabelas(self):
+        cursor = self._conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' "
+                                    "AND name NOT LIKE ? ESCAPE '\\'", (self._PADRAO_RESTAURACAO,))
+        return [linha[0] for linha in cursor]
+
+    def _preparar(self, entity_name):
+        if entity_name in self._sql:
+            return self._sql[entity_name]
+        tabela = self._tabela(entity_name)
+        colunas = ', '.join(self.COLUNAS)
+        self._conn.execute(f'CREATE TABLE IF NOT EXISTS {tabela} (id INTEGER PRIMARY KEY, {colunas}, dados TEXT NOT NULL)')
+        for coluna in self.COLUNAS:
+            indice = self._tabela(f'idx_{entity_name}_{coluna}')
+            self._conn.execute(f'CREATE INDEX IF NOT EXISTS {indice} ON {tabela} ({coluna})')
+        marcadores = ', '.join('?' for _ in self.COLUNAS)
+        self._sql[entity_name] = {
+            'gravar': f'INSERT OR REPLACE INTO {tabela} (id, {colunas}, dados) VALUES (?, {marcadores}, ?)',
+            'remover': f'DELETE FROM {tabela} WHERE id = ?',
+        }
+        return self._sql[entity_name]
+
+    def _parametros(self, item):
+        colunas = []
+        for coluna in self.COLUNAS:
+            valor = item.get(coluna)
+            colunas.append(valor if isinstance(valor, (int, float, str)) or valor is None else str(valor))
+        dados = json.dumps(item, ensure_ascii=False, separators=(',', ':'))
+        self._local.bytes = getattr(self._local, 'bytes', 0) + len(dados)
+        return (item.get('id'), *colunas, dados)
+
+    def _contabilizar_bytes(self):
+        metricas.incrementar('mecanica_persistencia_bytes_total', getattr(self._local, 'bytes', 0), destino='sqlite')
+        self._local.bytes = 0
+
+    def carregar(self):
+        # Só conta os registros: as tabelas são lidas sob demanda (DadosSQLite)
+        with self._lock:
+            tabelas = self._tabelas()
+            if not tabelas:
+                return None
+            totais = {entity_name: self._conn.execute(f'SELECT COUNT(*) FROM {self._tabela(entity_name)}').fetchone()[0]
+                      for entity_name in tabelas}
+        return DadosSQLite(self, totais)
+
+    def ler_tabela(self, entity_name):
+        with self._lock:
+            cursor = self._conn.execute(f'SELECT dados FROM {self._tabela(entity_name)} ORDER BY id')
+            return [json.loads(linha[0]) for linha in cursor]
+
+    def buscar(self, entity_name, item_id):
+        with self._lock:
+            linha = self._conn.execute(f'SELECT dados FROM {self._tabela(entity_name)} WHERE id = ?',
+                                       (item_id,)).fetchone()
+        return json.loads(linha[0]) if linha else None
+
+    def filtrar(self, entity_name, filtros):
+        # Filtros campo -> valor (texto, como nos índices em memória). Retorna
+        # None se algum campo não tiver coluna própria.
+        condicoes, parametros = [], []
+        for campo, valor in filtros.items():
+            if campo not in self.COLUNAS:
+                return None
+            if valor == 'None':
+                condicoes.append(f'({campo} IS NULL OR {campo} = ?)')
+                parametros.append(valor)
+                continue
+            # Em memória o valor é comparado como texto: '5' também casa com 5
+            candidatos = [valor]
+            if valor.lstrip('-').isdigit() and str(int(valor)) == valor:
+                candidatos.append(int(valor))
+            condicoes.append(f"{campo} IN ({', '.join('?' for _ in candidatos)})")
+            parametros.extend(candidatos)
+        sql = f"SELECT dados FROM {self._tabela(entity_name)} WHERE {' AND '.join(condicoes) or '1'} ORDER BY id"
+        with self._lock:
+            return [json.loads(linha[0]) for linha in self._conn.execute(sql, parametros)]
+
+    def salvar(self, data):
+        # Lido antes de pegar o lock: tabelas ainda não carregadas (DadosSQLite)
+        # são lidas do próprio banco
+        data = {entity_name: itens for entity_name, itens in data.items() if isinstance(itens, list)}
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                for entity_name in self._tabelas():
+                    if entity_name not in data:
+                        self._conn.execute(f'DROP TABLE {self._tabela(entity_name)}')
+                        self._sql.pop(entity_name, None)
+                for entity_name, itens in data.items():
+                    sql = self._preparar(entity_name)
+                    self._conn.execute(f'DELETE FROM {self._tabela(entity_name)}')
+                    self._conn.executemany(sql['gravar'], (self._parametros(item) for item in itens))
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            finally:
+                self._contabilizar_bytes()
+
+    def _descartar_restauracao(self):
+        with self._lock:
+            cursor = self._conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ? ESCAPE '\\'",
+                                        (self._PADRAO_RESTAURACAO,))
+            for (tabela,) in cursor.fetchall():
+                self._conn.execute(f'DROP TABLE {self._tabela(tabela)}')
+
+    def iniciar_restauracao(self):
+        # Os lotes vão para tabelas à parte (sem índices), gravadas à medida
+        # que o backup é lido; concluir_restauracao só troca as tabelas
+        self._descartar_restauracao()
+        return RestauracaoSQLite(self)
+
+    def gravar_restauracao(self, entity_name, itens, criar):
+        tabela = self._tabela(self.PREFIXO_RESTAURACAO + entity_name)
+        colunas = ', '.join(self.COLUNAS)
+        marcadores = ', '.join('?' for _ in self.COLUNAS)
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                if criar:
+                    self._conn.execute(f'CREATE TABLE {tabela} (id INTEGER PRIMARY KEY, {colunas}, dados TEXT NOT NULL)')
+                self._conn.executemany(f'INSERT INTO {tabela} (id, {colunas}, dados) VALUES (?, {marcadores}, ?)',
+                                       (self._parametros(item) for item in itens))
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            finally:
+                self._contabilizar_bytes()
+
+    def concluir_restauracao(self, restauracao, data):
+        # Chamado com a trava de escrita: troca as tabelas restauradas numa só
+        # transação e recria os índices. As demais continuam no banco.
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                for entity_name in restauracao.entidades():
+                    tabela = self._tabela(entity_name)
+                    self._conn.execute(f'DROP TABLE IF EXISTS {tabela}')
+                    self._conn.execute(f'ALTER TABLE {self._tabela(self.PREFIXO_RESTAURACAO + entity_name)} '
+                                       f'RENAME TO {tabela}')
+                    self._sql.pop(entity_name, None)
+                    self._preparar(entity_name)
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return self.carregar()
+
+    def registrar(self, data, registro, item=None):
+        self.registrar_lote(data, [(registro, item)])
+
+    def registrar_lote(self, data, registros):
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                for registro, item in registros:
+                    sql = self._preparar(registro['entidade'])
+                    if registro['op'] == 'remover':
+                        self._conn.execute(sql['remover'], (registro['id'],))
+                    elif item is not None:
+                        self._conn.execute(sql['gravar'], self._parametros(item))
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            finally:
+                self._contabilizar_bytes()
+
+    def sincronizar_pendentes(self):
+        pass
+
+    def fechar(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RestauracaoSQLite:
+    def __init__(self, armazenamento):
+        self._armazenamento = armazenamento
+        self._entidades = []
+
+    def entidades(self):
+        return list(self._entidades)
+
+    def adicionar(self, entity_name, itens):
+        criar = entity_name not in self._entidades
+        if criar:
+            self._entidades.append(entity_name)
+        self._armazenamento.gravar_restauracao(entity_name, itens, criar)
+
+    def preparar(self):
+        pass
+
+    def descartar(self):
+        self._armazenamento._descartar_restauracao()
+
+
+def _armazenamento_journal_de(caminho_json):
+    # Para os comandos de linha: journal e snapshot ao lado de caminho_json
+    base = os.path.splitext(caminho_json)[0]
+    snapshot = base + '.snap' if FORMATO_SNAPSHOT == 'binario' else None
+    return ArmazenamentoJournal(caminho_json, base + '.journal', JOURNAL_LIMITE_COMPACTACAO, snapshot, dono=False)
+
+
+def migrar_json_para_sqlite(caminho_json=DATA_FILE, caminho_db=SQLITE_FILE):
+    # Migração única: lê o data.json ou o data.snap (mais o journal, se houver) e grava tudo no SQLite
+    data = _armazenamento_journal_de(caminho_json).carregar()
+    if data is None:
+        raise FileNotFoundError(f"Arquivo de dados não encontrado: {caminho_json}")
+    destino = ArmazenamentoSQLite(caminho_db)
+    destino.salvar(data)
+    destino.fechar()
+    return {nome: len(itens) for nome, itens in data.items() if isinstance(itens, list)}
+
+
+def exportar_snapshot_json(caminho_destino, caminho_json=DATA_FILE):
+    # Gera um JSON legível a partir do snapshot mais o journal. Para que um
+    # JSON editado passe a valer, use importar_json_para_snapshot.
+    armazenamento = _armazenamento_journal_de(caminho_json)
+    data = armazenamento.carregar()
+    if data is None:
+        raise FileNotFoundError(f"Snapshot não encontrado: {armazenamento.caminho_snapshot or caminho_json}")
+    data = dict(data.items())
+    _gravar_json_atomico(caminho_destino, data)
+    return {nome: len(itens) for nome, itens in data.items() if isinstance(itens, list)}
+
+
+def importar_json_para_snapshot(caminho_origem, caminho_json=DATA_FILE):
+    # Substitui o snapshot pelo conteúdo de um JSON (por exemplo, editado à
+    # mão) e descarta o journal. Deve rodar com o servidor parado.
+    with open(caminho_origem, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError(f"Esperado um objeto JSON com as entidades: {caminho_origem}")
+    armazenamento = _armazenamento_journal_de(caminho_json)
+    armazenamento.salvar(data)
+    armazenamento.fechar()
+    return {nome: len(itens) for nome, itens in data.items() if isinstance(itens, list)}
+
+
+def criar_armazenamento(modo):
+    if modo == 'json':
+        return ArmazenamentoJSON(DATA_FILE)
+    if modo == 'sqlite':
+        return ArmazenamentoSQLite(SQLITE_FILE)
+    if modo == 'journal':
+        snapshot = SNAPSHOT_FILE if FORMATO_SNAPSHOT == 'binario' else None
+        return ArmazenamentoJournal(DATA_FILE, JOURNAL_FILE, JOURNAL_LIMITE_COMPACTACAO, snapshot, MULTIPROCESSO,
+                                    dono=not EXECUTANDO_COMANDO)
+    raise ValueError(f"Modo de armazenamento desconhecido: {modo}")
+
+
+# --- Log de Auditoria --- #
+def _data_compacta(timestamp):
+    # '2026-10-18T14:49:34.123' -> '20261018T144934' (usado nos nomes dos segmentos)
+    return re.sub(r'[-:]', '', timestamp)[:15]
+
+
+class RegistroAuditoria:
+    # Cada log vira uma linha NDJSON no segmento ativo, gravada por uma thread
+    # em segundo plano que junta os logs pendentes em um único write. Segmentos
+    # fechados são comprimidos e nomeados com o intervalo de datas e de ids
+    # ('inicio_fim_primeiro_ultimo.ndjson.gz'), que serve de índice para as
+    # consultas por período.
+    #
+    # Com multiprocesso, os processos dividem o segmento ativo: cada gravação
+    # é feita na hora, com uma trava entre processos, depois de contabilizar o
+    # que os outros gravaram (e é aí que o id é atribuído).
+    ATIVO = 'ativo.ndjson'
+    TRAVA = '.trava'
+    LOTE_MAXIMO = 1000
+
+    def __init__(self, diretorio, limite_bytes, limite_horas, retencao_dias, multiprocesso=False):
+        self.diretorio = diretorio
+        self.limite_bytes = limite_bytes
+        self.limite_horas = limite_horas
+        self.retencao_dias = retencao_dias
+        self.caminho_ativo = os.path.join(diretorio, self.ATIVO)
+        os.makedirs(diretorio, exist_ok=True)
+        self._lock = threading.Lock()
+        self._lock_ids = threading.Lock()
+        self._fila = queue.Queue()
+        # Quantos registros já entraram na fila e quantos a thread já tirou
+        # dela (gravados ou não): a consulta espera só pelos que vieram antes
+        self._enfileirados = 0
+        self._processados = 0
+        self._processou = threading.Condition()
+        self._arquivo = None
+        self._identidade_ativo = None
+        self._processos = TravaProcessos(os.path.join(diretorio, self.TRAVA)) if multiprocesso else None
+        with self._travado():
+            self._segmentos = self._listar_segmentos()
+            self._ativo = self._ler_ativo()
+        self._proximo_id = self._ultimo_id() + 1
+        self._thread = threading.Thread(target=self._gravar_em_segundo_plano, daemon=True)
+        self._thread.start()
+
+    def _listar_segmentos(self):
+        segmentos = []
+        for nome in os.listdir(self.diretorio):
+            partes = nome[:-len('.ndjson.gz')].split('_') if nome.endswith('.ndjson.gz') else []
+            if len(partes) != 4:
+                continue
+            segmentos.append({'inicio': partes[0], 'fim': partes[1], 'primeiro_id': int(partes[2]),
+                              'ultimo_id': int(partes[3]), 'caminho': os.path.join(self.diretorio, nome)})
+        return sorted(segmentos, key=lambda segmento: segmento['primeiro_id'])
+
+    def _ultimo_id(self):
+        return max([segmento['ultimo_id'] for segmento in self._segmentos] + [self._ativo['ultimo_id'] or 0])
+
+    def _travado(self):
+        return self._processos.travada() if self._processos is not None else contextlib.nullcontext()
+
+    def _ler_ativo(self, ativo=None):
+        # Lê o segmento ativo a partir do que 'ativo' já contabilizou
+        if ativo is None:
+            ativo = {'registros': 0, 'bytes': 0, 'inicio': None, 'fim': None, 'primeiro_id': None, 'ultimo_id': None}
+        self._identidade_ativo = None
+        if not os.path.exists(self.caminho_ativo):
+            return ativo
+        with open(self.caminho_ativo, 'rb') as f:
+            estado = os.fstat(f.fileno())
+            self._identidade_ativo = (estado.st_dev, estado.st_ino)
+            f.seek(ativo['bytes'])
+            for linha in f:
+                try:
+                    registro = json.loads(linha)
+                except ValueError:
+                    # Linha incompleta de uma queda durante a escrita
+                    os.truncate(self.caminho_ativo, ativo['bytes'])
+                    break
+                self._contabilizar(ativo, registro, len(linha))
+        if ativo['primeiro_id'] is not None and any(s['primeiro_id'] == ativo['primeiro_id'] for s in self._segmentos):
+            # Queda logo depois de comprimir: o segmento já está completo
+            os.remove(self.caminho_ativo)
+            return self._ler_ativo()
+        return ativo
+
+    @staticmethod
+    def _contabilizar(ativo, registro, tamanho):
+        if ativo['primeiro_id'] is None:
+            ativo['primeiro_id'] = registro['id']
+            ativo['inicio'] = registro['timestamp']
+        ativo['ultimo_id'] = registro['id']
+        ativo['fim'] = registro['timestamp']
+        ativo['registros'] += 1
+        ativo['bytes'] += tamanho
+
+    def _acompanhar_processos(self):
+        # Chamado com self._lock e a trava entre processos: outros processos
+        # podem ter gravado no segmento ativo, fechado ele ou aplicado a retenção
+        self._segmentos = self._listar_segmentos()
+        try:
+            estado = os.stat(self.caminho_ativo)
+            identidade = (estado.st_dev, estado.st_ino)
+        except FileNotFoundError:
+            identidade = None
+        if identidade is not None and identidade == self._identidade_ativo:
+            self._ativo = self._ler_ativo(self._ativo)
+        else:
+            if self._arquivo is not None:
+                self._arquivo.close()
+                self._arquivo = None
+            self._ativo = self._ler_ativo()
+        with self._lock_ids:
+            self._proximo_id = max(self._proximo_id, self._ultimo_id() + 1)
+
+    def registrar(self, registro):
+        if self._processos is not None:
+            # O id só é conhecido com a trava entre processos
+            self._gravar([registro])
+            return registro
+        with self._lock_ids:
+            registro['id'] = self._proximo_id
+            self._proximo_id += 1
+            # Enfileirado junto com a contagem, para a fila seguir a mesma ordem
+            self._enfileirados += 1
+            self._fila.put(registro)
+        return registro
+
+    def importar(self, registros):
+        # Usado na migração dos logs que estavam no data.json: grava na hora,
+        # mantendo os ids originais
+        registros = sorted(registros, key=lambda registro: registro.get('id', 0))
+        for registro in registros:
+            registro.setdefault('timestamp', datetime.now().isoformat())
+        with self._lock_ids:
+            self._proximo_id = max([self._proximo_id] + [registro.get('id', 0) + 1 for registro in registros])
+        for inicio in range(0, len(registros), self.LOTE_MAXIMO):
+            self._gravar(registros[inicio:inicio + self.LOTE_MAXIMO])
+
+    def _gravar_em_segundo_plano(self):
+        while True:
+            lote = [self._fila.get()]
+            while len(lote) < self.LOTE_MAXIMO:
+                try:
+                    lote.append(self._fila.get_nowait())
+                except queue.Empty:
+                    break
+            registros = [registro for registro in lote if registro is not None]
+            try:
+                if registros:
+                    self._gravar(registros)
+            except Exception as e:
+                print(f'❌ Erro ao gravar logs de auditoria: {e}')
+            finally:
+                with self._processou:
+                    self._processados += len(registros)
+                    if len(registros) < len(lote):
+                        # Encerrando: ninguém deve ficar esperando por esta thread
+                        self._processados = float('inf')
+                    self._processou.notify_all()
+            if len(registros) < len(lote):
+                return
+
+    def _gravar(self, registros):
+        with self._lock, self._travado():
+            if self._processos is not None:
+                self._acompanhar_processos()
+                with self._lock_ids:
+                    for registro in registros:
+                        if registro.get('id') is None:
+                            registro['id'] = self._proximo_id
+                            self._proximo_id += 1
+            if self._ativo['inicio'] and self.limite_horas:
+                inicio = datetime.fromisoformat(self._ativo['inicio'])
+                if datetime.now() - inicio >= timedelta(hours=self.limite_horas):
+                    self._rotacionar()
+            linhas = [(json.dumps(registro, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+                      for registro in registros]
+            if self._arquivo is None:
+                self._arquivo = open(self.caminho_ativo, 'ab')
+                estado = os.fstat(self._arquivo.fileno())
+                self._identidade_ativo = (estado.st_dev, estado.st_ino)
+            self._arquivo.write(b''.join(linhas))
+            self._arquivo.flush()
+            os.fsync(self._arquivo.fileno())
+            for registro, linha in zip(registros, linhas):
+                self._contabilizar(self._ativo, registro, len(linha))
+            metricas.incrementar('mecanica_persistencia_bytes_total', sum(map(len, linhas)), destino='logs')
+            if self._ativo['bytes'] >= self.limite_bytes:
+                self._rotacionar()
+
+    def _rotacionar(self):
+        # Chamado com self._lock: comprime o segmento ativo e aplica a retenção
+        if self._arquivo is not None:
+            self._arquivo.close()
+            self._arquivo = None
+        ativo = self._ativo
+        if ativo['registros']:
+            nome = (f"{_data_compacta(ativo['inicio'])}_{_data_compacta(ativo['fim'])}_"
+                    f"{ativo['primeiro_id']}_{ativo['ultimo_id']}.ndjson.gz")
+            caminho = os.path.join(self.diretorio, nome)
+            with open(self.caminho_ativo, 'rb') as origem, gzip.open(caminho + '.tmp', 'wb') as destino:
+                shutil.copyfileobj(origem, destino)
+            os.replace(caminho + '.tmp', caminho)
+            os.remove(self.caminho_ativo)
+            self._identidade_ativo = None
+            self._segmentos.append({'inicio': _data_compacta(ativo['inicio']), 'fim': _data_compacta(ativo['fim']),
+                                    'primeiro_id': ativo['primeiro_id'], 'ultimo_id': ativo['ultimo_id'],
+                                    'caminho': caminho})
+        self._ativo = {'registros': 0, 'bytes': 0, 'inicio': None, 'fim': None, 'primeiro_id': None, 'ultimo_id': None}
+
+        if self.retencao_dias:
+            limite = _data_compacta((datetime.now() - timedelta(days=self.retencao_dias)).isoformat())
+            for segmento in [segmento for segmento in self._segmentos if segmento['fim'] < limite]:
+                os.remove(segmento['caminho'])
+                self._segmentos.remove(segmento)
+
+    def consultar(self, desde=None, ate=None, acao=None, limite=100, crescente=False):
+        # Espera os logs que já estavam na fila, para que a consulta veja o que
+        # foi registrado antes dela; os que chegarem depois não a seguram
+        with self._lock_ids:
+            alvo = self._enfileirados
+        with self._processou:
+            self._processou.wait_for(lambda: self._processados >= alvo)
+        if ate and len(ate) == 10:
+            ate += 'T23:59:59.999999'
+        with self._lock, self._travado():
+            if self._processos is not None:
+                self._acompanhar_processos()
+            segmentos = [segmento for segmento in self._segmentos
+                         if (not ate or segmento['inicio'] <= _data_compacta(ate))
+                         and (not desde or segmento['fim'] >= _data_compacta(desde))]
+            with open(self.caminho_ativo, 'rb') if self._ativo['registros'] else contextlib.nullcontext([]) as f:
+                linhas_ativo = list(f)
+
+        def ler(segmento):
+            try:
+                with gzip.open(segmento['caminho'], 'rb') as f:
+                    return list(f)
+            except FileNotFoundError:
+                # Removido pela retenção durante a consulta
+                return []
+
+        fontes = [functools.partial(ler, segmento) for segmento in segmentos] + [lambda: linhas_ativo]
+        if not crescente:
+            fontes.reverse()
+        resultado = []
+        for fonte in fontes:
+            linhas = fonte()
+            if not crescente:
+                linhas.reverse()
+            for linha in linhas:
+                registro = json.loads(linha)
+                timestamp = registro.get('timestamp', '')
+                if (desde and timestamp < desde) or (ate and timestamp > ate):
+                    continue
+                if acao and registro.get('acao') != acao:
+                    continue
+                resultado.append(registro)
+                if len(resultado) >= limite:
+                    return resultado
+        return resultado
+
+    def fechar(self):
+        if self._thread.is_alive():
+            self._fila.put(None)
+            self._thread.join()
+        with self._lock:
+            if self._arquivo is not None:
+                self._arquivo.close()
+                self._arquivo = None
+
+
+# --- Feed de Alterações --- #
+class FeedAlteracoes:
+    # Últimas alterações (inserir, atualizar, remover) em um buffer limitado,
+    # numeradas por uma versão global. Quem acompanha o feed pede o que veio
+    # depois da última versão que viu; se ela já saiu do buffer (ou é de outra
+    # execução do servidor, identificada pela época), precisa recarregar tudo.
+    def __init__(self, limite):
+        self.epoca = uuid.uuid4().hex[:8]
+        self._eventos = deque(maxlen=limite)
+        self._versao = 0
+        self._cond = threading.Condition()
+
+    @property
+    def versao(self):
+        return self._versao
+
+    def publicar(self, registros):
+        # O evento é serializado na hora, porque o registro em memória pode
+        # mudar depois
+        with self._cond:
+            for registro in registros:
+                self._versao += 1
+                evento = {'versao': self._versao, 'op': registro['op'], 'entidade': registro.get('entidade'),
+                          'id': registro.get('id')}
+                if registro.get('dados') is not None:
+                    evento['dados'] = registro['dados']
+                self._eventos.append((self._versao, json.dumps(evento, ensure_ascii=False)))
+            self._cond.notify_all()
+
+    def _desde(self, versao):
+        # (eventos, completo, versão atual); completo=False pede recarga total
+        if versao > self._versao:
+            return [], False, self._versao
+        if versao == self._versao:
+            return [], True, self._versao
+        primeira = self._eventos[0][0] if self._eventos else self._versao + 1
+        if versao < primeira - 1:
+            return [], False, self._versao
+        return list(itertools.islice(self._eventos, versao - primeira + 1, None)), True, self._versao
+
+    def desde(self, versao):
+        with self._cond:
+            return self._desde(versao)
+
+    def aguardar(self, versao, timeout):
+        with self._cond:
+            if versao == self._versao:
+                self._cond.wait(timeout)
+            return self._desde(versao)
+
+
+# --- Busca Textual --- #
+def normalizar_texto(texto):
+    # 'Óleo', 'óleo' e 'oleo' viram o mesmo termo
+    decomposto = unicodedata.normalize('NFKD', str(texto))
+    return ''.join(c for c in decomposto if not unicodedata.combining(c)).casefold()
+
+def termos_texto(texto, compactar=False):
+    termos = re.findall(r'[^\W_]+', normalizar_texto(texto))
+    # CPF, telefone, placa e códigos também são encontrados sem a pontuação
+    # ('abc1234' acha 'ABC-1234')
+    if compactar and len(termos) > 1 and any(c.isdigit() for termo in termos for c in termo):
+        termos.append(''.join(termos))
+    return termos
+
+# --- Livro de Estoque --- #
+def _delta_estoque(movimentacao):
+    # 'saida' baixa o estoque, 'entrada' repõe; outros tipos (ajustes) usam a
+    # quantidade com o sinal informado
+    try:
+        quantidade = float(movimentacao.get('quantidade') or 0)
+    except (TypeError, ValueError):
+        return 0.0
+    tipo = movimentacao.get('tipo')
+    if tipo == 'saida':
+        return -abs(quantidade)
+    if tipo == 'entrada':
+        return abs(quantidade)
+    return quantidade
+
+
+class PosicoesLista:
+    # Posição de cada registro na lista de uma entidade, para remover sem
+    # percorrer a lista e sem mudar a ordem. Cada registro recebe uma vaga ao
+    # entrar (a posição que teria sem remoções); as vagas removidas ficam
+    # marcadas numa árvore de Fenwick, e a posição atual é a vaga menos as
+    # vagas removidas antes dela. Quando há mais vagas removidas que
+    # registros, tudo é renumerado a partir da lista.
+    def __init__(self, itens):
+        self.renumerar(itens)
+
+    def renumerar(self, itens):
+        self._vagas = {item.get('id'): vaga for vaga, item in enumerate(itens)}
+        self._arvore = [0] * (len(itens) + 1)
+        self.removidas = 0
+
+    def _removidas_antes(self, vaga):
+        total = 0
+        while vaga > 0:
+            total += self._arvore[vaga]
+            vaga -= vaga & -vaga
+        return total
+
+    def anexar(self, item_id):
+        # O nó novo cobre as vagas (no - (no & -no), no]: começa com as
+        # remoções que já existem nesse intervalo
+        no = len(self._arvore)
+        self._arvore.append(self._removidas_antes(no - 1) - self._removidas_antes(no - (no & -no)))
+        self._vagas[item_id] = no - 1
+
+    def remover(self, item_id):
+        # Retorna a posição atual do registro
+        vaga = self._vagas.pop(item_id)
+        posicao = vaga - self._removidas_antes(vaga)
+        no = vaga + 1
+        while no < len(self._arvore):
+            self._arvore[no] += 1
+            no += no & -no
+        self.removidas += 1
+        return posicao
+
+
+class LivroEstoque:
+    # Movimentações de uma peça em ordem cronológica (chave: (timestamp, id)),
+    # com a soma acumulada guardada a cada PASSO_CHECKPOINT_ESTOQUE posições:
+    # o saldo até um instante é o checkpoint anterior mais, no máximo, um
+    # passo de movimentações. Inserir no fim (o caso normal) só recalcula o
+    # último bloco.
+    def __init__(self):
+        self.chaves = []
+        self.deltas = []
+        self.checkpoints = [0.0]
+
+    def __len__(self):
+        return len(self.chaves)
+
+    def inserir(self, chave, delta):
+        posicao = bisect.bisect_right(self.chaves, chave)
+        self.chaves.insert(posicao, chave)
+        self.deltas.insert(posicao, delta)
+        self._refazer_checkpoints(posicao)
+
+    def remover(self, chave):
+        posicao = bisect.bisect_left(self.chaves, chave)
+        if posicao < len(self.chaves) and self.chaves[posicao] == chave:
+            del self.chaves[posicao]
+            del self.deltas[posicao]
+            self._refazer_checkpoints(posicao)
+
+    def _refazer_checkpoints(self, posicao):
+        # Só os checkpoints depois da posição alterada mudam
+        passo = PASSO_CHECKPOINT_ESTOQUE
+        bloco = posicao // passo
+        del self.checkpoints[bloco + 1:]
+        total = self.checkpoints[bloco]
+        for inicio in range(bloco * passo, len(self.deltas) - passo + 1, passo):
+            total += sum(self.deltas[inicio:inicio + passo])
+            self.checkpoints.append(total)
+
+    def posicao(self, instante):
+        # Quantas movimentações aconteceram antes do instante (ISO)
+        return bisect.bisect_left(self.chaves, (instante,))
+
+    def saldo_ate(self, posicao):
+        # Soma das 'posicao' primeiras movimentações
+        bloco = posicao // PASSO_CHECKPOINT_ESTOQUE
+        return self.checkpoints[bloco] + sum(self.deltas[bloco * PASSO_CHECKPOINT_ESTOQUE:posicao])
+
+    def total(self):
+        return self.saldo_ate(len(self.deltas))
+
+
+# --- Análises Colunares --- #
+def _data_analise(valor):
+    try:
+        return date.fromisoformat(valor[:10])
+    except (TypeError, ValueError):
+        return None
+
+def _numero_analise(valor):
+    try:
+        return float(valor)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class TabelaColunar:
+    # Linhas guardadas por coluna em array.array: o dia (ordinal da data), o
+    # mês (ano * 12 + mês - 1), as medidas em float e as dimensões codificadas
+    # como inteiros (posição do rótulo em 'rotulos'). Um registro de origem
+    # pode gerar várias linhas; a remoção move a última linha para o lugar da
+    # removida, para que as colunas continuem contíguas.
+    def __init__(self, dimensoes, medidas):
+        self.dimensoes = dimensoes
+        self.medidas = medidas
+        self.colunas = {'dia': array('l'), 'mes': array('l')}
+        self.colunas.update((medida, array('d')) for medida in medidas)
+        self.colunas.update((dimensao, array('l')) for dimensao in dimensoes)
+        self.rotulos = {dimensao: [] for dimensao in dimensoes}
+        self._codigos = {dimensao: {} for dimensao in dimensoes}
+        self._medidas = [(medida, self.colunas[medida]) for medida in medidas]
+        self._dimensoes = [(dimensao, self.colunas[dimensao], self._codigos[dimensao]) for dimensao in dimensoes]
+        self._origem = []
+        self._posicoes = {}
+        self.versao = 0
+        self._vetores = None
+
+    def __len__(self):
+        return len(self._origem)
+
+    def _codigo(self, dimensao, rotulo):
+        codigos = self._codigos[dimensao]
+        if rotulo not in codigos:
+            codigos[rotulo] = len(self.rotulos[dimensao])
+            self.rotulos[dimensao].append(rotulo)
+        return codigos[rotulo]
+
+    def inserir(self, chave, linhas):
+        # linhas: [(data, {medida: valor}, {dimensão: rótulo})]
+        posicoes = self._posicoes.setdefault(chave, [])
+        dias, meses = self.colunas['dia'], self.colunas['mes']
+        for dia, medidas, dimensoes in linhas:
+            posicoes.append(len(self._origem))
+            self._origem.append(chave)
+            dias.append(dia.toordinal())
+            meses.append(dia.year * 12 + dia.month - 1)
+            for medida, coluna in self._medidas:
+                coluna.append(medidas.get(medida, 0.0))
+            for dimensao, coluna, codigos in self._dimensoes:
+                rotulo = dimensoes.get(dimensao)
+                codigo = codigos.get(rotulo)
+                coluna.append(self._codigo(dimensao, rotulo) if codigo is None else codigo)
+        self.versao += 1
+
+    def remover(self, chave):
+        # Da maior posição para a menor: a última linha nunca é uma das que
+        # ainda faltam remover (ou é a própria linha removida)
+        for posicao in sorted(self._posicoes.pop(chave, ()), reverse=True):
+            ultima = len(self._origem) - 1
+            if posicao != ultima:
+                movida = self._origem[ultima]
+                for coluna in self.colunas.values():
+                    coluna[posicao] = coluna[ultima]
+                self._origem[posicao] = movida
+                posicoes = self._posicoes[movida]
+                posicoes[posicoes.index(ultima)] = posicao
+            for coluna in self.colunas.values():
+                coluna.pop()
+            self._origem.pop()
+        self.versao += 1
+
+    def _vetores_numpy(self):
+        # Cópias das colunas, refeitas só quando a tabela muda (uma view
+        # direta impediria os arrays de crescer enquanto existisse)
+        vetores = self._vetores
+        if vetores is None or vetores[0] != self.versao:
+            vetores = (self.versao, {nome: np.frombuffer(coluna, dtype=coluna.typecode).copy()
+                                     for nome, coluna in self.colunas.items()})
+            self._vetores = vetores
+        return vetores[1]
+
+    @staticmethod
+    def _chave_tempo(agrupamento, dia, mes):
+        if agrupamento == 'dia':
+            return dia
+        if agrupamento == 'semana':
+            # Semanas começando na segunda-feira (o ordinal 1 é uma segunda)
+            return (dia - 1) // 7
+        return mes if agrupamento == 'mes' else mes // 12
+
+    def rotulo(self, agrupamento, codigo):
+        if agrupamento == 'dia':
+            return date.fromordinal(codigo).isoformat()
+        if agrupamento == 'semana':
+            return date.fromordinal(codigo * 7 + 1).isoformat()
+        if agrupamento == 'mes':
+            return f'{codigo // 12:04d}-{codigo % 12 + 1:02d}'
+        if agrupamento == 'ano':
+            return f'{codigo:04d}'
+        return self.rotulos[agrupamento][codigo]
+
+    def agregar(self, medida, filtros, agrupar_por, inicio=None, fim=None):
+        # [(códigos do grupo, soma, linhas)], com o período em ordinais de data
+        codigos_filtro = {}
+        for dimensao, rotulo in filtros.items():
+            if rotulo not in self._codigos[dimensao]:
+                return []
+            codigos_filtro[dimensao] = self._codigos[dimensao][rotulo]
+        if np is not None:
+            return self._agregar_numpy(medida, codigos_filtro, agrupar_por, inicio, fim)
+        return self._agregar_python(medida, codigos_filtro, agrupar_por, inicio, fim)
+
+    def _agregar_numpy(self, medida, codigos_filtro, agrupar_por, inicio, fim):
+        vetores = self._vetores_numpy()
+        dia = vetores['dia']
+        mascara = np.ones(len(dia), dtype=bool)
+        if inicio is not None:
+            mascara &= dia >= inicio
+        if fim is not None:
+            mascara &= dia <= fim
+        for dimensao, codigo in codigos_filtro.items():
+            mascara &= vetores[dimensao] == codigo
+        valores = vetores[medida][mascara] if medida else None
+        if not agrupar_por:
+            total = int(mascara.sum())
+            if not total:
+                return []
+            return [((), float(valores.sum()) if medida else float(total), total)]
+
+        chaves = []
+        for agrupamento in agrupar_por:
+            if agrupamento in AGRUPAMENTOS_TEMPO:
+                chave = self._chave_tempo(agrupamento, dia, vetores['mes'])
+            else:
+                chave = vetores[agrupamento]
+            chaves.append(chave[mascara].astype(np.int64))
+        if not len(chaves[0]):
+            return []
+        # Uma única chave inteira por linha (todas as chaves são >= 0)
+        combinada = chaves[0]
+        for chave in chaves[1:]:
+            combinada = combinada * (int(chave.max()) + 1) + chave
+        _, primeiras, grupo = np.unique(combinada, return_index=True, return_inverse=True)
+        grupo = grupo.ravel()
+        linhas = np.bincount(grupo)
+        somas = np.bincount(grupo, weights=valores) if medida else linhas
+        codigos = [chave[primeiras].tolist() for chave in chaves]
+        return [(tuple(codigo[i] for codigo in codigos), float(somas[i]), int(linhas[i]))
+                for i in range(len(primeiras))]
+
+    def _agregar_python(self, medida, codigos_filtro, agrupar_por, inicio, fim):
+        dias = self.colunas['dia']
+        meses = self.colunas['mes']
+        valores = self.colunas[medida] if medida else None
+        filtros = [(self.colunas[dimensao], codigo) for dimensao, codigo in codigos_filtro.items()]
+        grupos = {}
+        for posicao, dia in enumerate(dias):
+            if (inicio is not None and dia < inicio) or (fim is not None and dia > fim):
+                continue
+            if any(coluna[posicao] != codigo for coluna, codigo in filtros):
+                continue
+            chave = tuple(self._chave_tempo(agrupamento, dia, meses[posicao]) if agrupamento in AGRUPAMENTOS_TEMPO
+                          else self.colunas[agrupamento][posicao] for agrupamento in agrupar_por)
+            acumulado = grupos.get(chave)
+            if acumulado is None:
+                acumulado = grupos[chave] = [0.0, 0]
+            acumulado[0] += valores[posicao] if medida else 1
+            acumulado[1] += 1
+        return [(chave, float(soma), linhas) for chave, (soma, linhas) in grupos.items()]
+
 
 # --- Classe de Lógica de Negócios (MecanicaGoelzer) --- #
+class RestauracaoEmAndamento(Exception):
+    pass
+
+
 class MecanicaGoelzer:
     def __init__(self):
         self.data = {
@@ -29,24 +2067,887 @@ class MecanicaGoelzer:
             'despesasGerais': [],
             'orcamentos': [],
             'movimentacoes_estoque': [],
-            'logs': [],
             'contas_a_receber': []
         }
-        self._carregar_dados()
+        # Índices em memória: id -> registro por entidade e, opcionalmente,
+        # campo -> valor (como string) -> {id: registro}. Todos são criados no
+        # primeiro uso, para não decodificar entidades do snapshot à toa.
+        self._indice_ids = {}
+        # id -> posição na lista da entidade, só para as remoções
+        self._indice_posicoes = {}
+        self._indices = {}
+        self._valores_indexados = {}
+        # Índice invertido da busca textual: entidade -> prefixo de termo ->
+        # {id: pontos}, criado na primeira busca em cada entidade
+        self._indice_busca = {}
+        self._termos_indexados = {}
+        # Tabelas colunares das análises (TABELAS_ANALISE), criadas na
+        # primeira consulta a cada uma, e os valores anteriores dos registros
+        # de catálogo alterados desde então
+        self._tabelas_analise = {}
+        self._dependencias_analise = {}
+        # Estoque: livro de movimentações por peca_id (com a chave com que cada
+        # movimentação entrou) e ids das peças no estoque mínimo ou abaixo;
+        # ambos criados no primeiro uso
+        self._livros_estoque = None
+        self._chaves_estoque = {}
+        self._pecas_em_alerta = None
+        # Totais das ordens, calculados sob demanda e guardados até a ordem ou
+        # o preço de um item dela mudar. O índice reverso (item de catálogo ->
+        # ordens que o usam) é criado no primeiro cálculo; os preços de antes
+        # das alterações ficam em _precos_alterados até a próxima consulta.
+        self._totais_ordens = None
+        self._ordens_por_item = {}
+        self._itens_por_ordem = {}
+        self._precos_alterados = {}
+        # Leituras em paralelo, escritas serializadas; os ids são alocados por
+        # contador próprio de cada entidade
+        self.trava = TravaLeituraEscrita()
+        self._lock_ids = threading.Lock()
+        self._lock_indices = threading.Lock()
+        self._proximos_ids = {}
+        # Somas de receita/despesa por mês ('AAAA-MM') e por ano ('AAAA'),
+        # mantidas a cada alteração em movimentacoes e despesasGerais depois de
+        # calculadas pela primeira vez (None enquanto ninguém consultou)
+        self._agregados = None
+        self._contribuicoes = {}
+        self._transacao = None
+        # Versões por entidade, incrementadas a cada alteração (usadas nos
+        # ETags); a geração muda quando os dados são recarregados por inteiro
+        self._versoes = {}
+        self._geracao = 0
+        self._progresso_restauracao = {'status': 'ocioso'}
+        self._lock_restauracao = threading.Lock()
+        self.feed = FeedAlteracoes(FEED_LIMITE)
+        self.auditoria = RegistroAuditoria(LOGS_DIR, LOGS_SEGMENTO_BYTES, LOGS_SEGMENTO_HORAS, LOGS_RETENCAO_DIAS,
+                                           MULTIPROCESSO)
+        self._armazenamento = criar_armazenamento(MODO_ARMAZENAMENTO)
+        self._armazenamento._obter_copia = self._copiar_dados
+        # Com vários processos, a carga também precisa da trava entre eles,
+        # para não ler o journal no meio de uma compactação
+        self._processos = None
+        if MULTIPROCESSO:
+            if not isinstance(self._armazenamento, ArmazenamentoJournal):
+                raise RuntimeError('MECANICA_MULTIPROCESSO requer MECANICA_ARMAZENAMENTO=journal')
+            self._processos = TravaProcessos(TRAVA_PROCESSOS_FILE)
+        with self._processos.travada() if self._processos is not None else contextlib.nullcontext():
+            self._carregar_dados()
 
     def _carregar_dados(self):
-        if os.path.exists(DATA_FILE):
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                self.data = json.load(f)
+        with metricas.cronometrar('mecanica_persistencia_duracao_segundos', operacao='carregar'):
+            data = self._armazenamento.carregar()
+        if data is not None:
+            self.data = data
         else:
             self._inicializar_dados_exemplo()
+        logs_antigos = self.data.pop('logs', None)
+        self._reconstruir_indices()
+        if logs_antigos is not None:
+            # Bases antigas guardavam os logs no data.json: passam para os
+            # segmentos de auditoria e saem do snapshot
+            self.auditoria.importar(logs_antigos)
+            self._salvar_dados()
         print('✅ Dados carregados com sucesso!')
 
     def _salvar_dados(self):
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(self.data, f, indent=4, ensure_ascii=False)
+        with metricas.cronometrar('mecanica_persistencia_duracao_segundos', operacao='salvar'):
+            self._armazenamento.salvar(self.data)
         print('✅ Dados salvos com sucesso!')
 
+    def _persistir(self, op, entity_name, item_id, dados=None):
+        self._versoes[entity_name] = self._versoes.get(entity_name, 0) + 1
+        registro = {'op': op, 'entidade': entity_name, 'id': item_id}
+        if dados is not None:
+            registro['dados'] = dados
+        item = self.buscar_item_por_id(entity_name, item_id) if op != 'remover' else None
+        if self._transacao is not None:
+            # Dentro de uma transação, tudo é gravado de uma vez no commit
+            self._transacao['registros'].append((registro, item))
+        else:
+            with metricas.cronometrar('mecanica_persistencia_duracao_segundos', operacao='registrar'):
+                self._armazenamento.registrar(self.data, registro, item)
+            self.feed.publicar([registro])
+
+    def versoes(self, entidades):
+        return (self._geracao, tuple(self._versoes.get(entity_name, 0) for entity_name in entidades))
+
+    def _copiar_dados(self):
+        # Cópia rasa por registro, suficiente para o snapshot em segundo plano;
+        # entidades do snapshot binário ainda não decodificadas vão como bytes
+        with self.trava.leitura():
+            if isinstance(self.data, DadosPreguicosos):
+                return self.data.copia_rasa(lambda itens: [dict(item) for item in itens] if isinstance(itens, list) else itens)
+            return {nome: [dict(item) for item in itens] if isinstance(itens, list) else itens
+                    for nome, itens in self.data.items()}
+
+    def adquirir_escrita(self):
+        if not self.trava.adquirir_escrita() or self._processos is None:
+            return
+        # Com vários processos, a escrita mais externa também pega a trava
+        # entre eles e aplica antes o que os outros gravaram
+        try:
+            self._processos.adquirir()
+        except BaseException:
+            self.trava.liberar_escrita()
+            raise
+        try:
+            self._acompanhar_processos(exclusiva=True)
+        except BaseException:
+            self._processos.liberar()
+            self.trava.liberar_escrita()
+            raise
+
+    def liberar_escrita(self):
+        if self._processos is not None and self.trava.escrita_mais_externa():
+            # A compactação troca o journal, então só acontece com a trava
+            # entre processos
+            self._armazenamento.compactar_pendente()
+            self._processos.liberar()
+        # O fsync do journal só acontece depois de liberar a trava, para que
+        # várias escritas seguidas compartilhem a mesma sincronização
+        if self.trava.liberar_escrita():
+            self._armazenamento.sincronizar_pendentes()
+
+    # --- Vários Processos --- #
+    def acompanhar_processos(self):
+        # Antes de cada requisição: se outro processo gravou no journal desde a
+        # última vez, aplica as alterações aqui também
+        if self._processos is None or not self._armazenamento.ha_alteracoes_externas():
+            return
+        self.trava.adquirir_escrita()
+        try:
+            self._acompanhar_processos(exclusiva=False)
+        finally:
+            self.trava.liberar_escrita()
+
+    def _acompanhar_processos(self, exclusiva):
+        # Chamado com a trava de escrita (e, se exclusiva, com a trava entre
+        # processos). Só as entidades e registros alterados são tocados; se o
+        # journal não permite saber o que mudou, recarrega tudo.
+        registros = self._armazenamento.alteracoes_externas(exclusiva)
+        if registros is None:
+            with contextlib.nullcontext() if exclusiva else self._processos.travada(compartilhada=True):
+                data = self._armazenamento.carregar(exclusiva)
+            self.data = data if data is not None else {}
+            self.data.pop('logs', None)
+            with self._lock_ids:
+                self._proximos_ids = {}
+            self._reconstruir_indices()
+            self.feed.publicar([{'op': 'recarregar'}])
+            return
+        for registro in registros:
+            self._aplicar_registro_externo(registro)
+        if registros:
+            self.feed.publicar(registros)
+
+    def _aplicar_registro_externo(self, registro):
+        # Mesmo caminho das alterações locais (índices, agregados e versões),
+        # mas sem gravar: o registro já está no journal
+        entity_name, item_id, op = registro['entidade'], registro['id'], registro['op']
+        if not isinstance(self.data.get(entity_name), list):
+            self.data[entity_name] = []
+            self._indice_ids.pop(entity_name, None)
+            self._indice_posicoes.pop(entity_name, None)
+        self._versoes[entity_name] = self._versoes.get(entity_name, 0) + 1
+        item = self.buscar_item_por_id(entity_name, item_id)
+        if op == 'inserir':
+            if item is None:
+                item = registro['dados']
+                self._anexar_item(entity_name, item)
+            else:
+                self._desindexar_item(entity_name, item_id)
+                item.clear()
+                item.update(registro['dados'])
+            self._indexar_item(entity_name, item)
+            with self._lock_ids:
+                if self._proximos_ids.get(entity_name, item_id + 1) <= item_id:
+                    self._proximos_ids[entity_name] = item_id + 1
+        elif op == 'atualizar' and item is not None:
+            self._desindexar_item(entity_name, item_id)
+            item.update(registro['dados'])
+            self._indexar_item(entity_name, item)
+        elif op == 'remover' and item is not None:
+            self._retirar_item(entity_name, item_id)
+            self._desindexar_item(entity_name, item_id)
+
+    @contextmanager
+    def escrita(self):
+        self.adquirir_escrita()
+        try:
+            yield
+        finally:
+            self.liberar_escrita()
+
+    # --- Transações --- #
+    @contextmanager
+    def transacao(self):
+        # Aplica as alterações em memória e grava todas de uma vez ao final.
+        # Se algo falhar, desfaz tudo e nada é gravado. Transações aninhadas
+        # fazem parte da mais externa.
+        with self.escrita():
+            if self._transacao is not None:
+                yield
+                return
+            self._transacao = {'registros': [], 'desfazer': [], 'logs': [], 'proximos_ids': dict(self._proximos_ids)}
+            try:
+                yield
+                if self._transacao['registros']:
+                    with metricas.cronometrar('mecanica_persistencia_duracao_segundos', operacao='registrar'):
+                        self._armazenamento.registrar_lote(self.data, self._transacao['registros'])
+                    self.feed.publicar([registro for registro, _ in self._transacao['registros']])
+            except BaseException:
+                transacao, self._transacao = self._transacao, None
+                self._desfazer(transacao)
+                raise
+            transacao, self._transacao = self._transacao, None
+            for log_entry in transacao['logs']:
+                self.auditoria.registrar(log_entry)
+
+    def _registrar_desfazer(self, *acao):
+        if self._transacao is not None:
+            self._transacao['desfazer'].append(acao)
+
+    def _desfazer(self, transacao):
+        for acao, entity_name, *args in reversed(transacao['desfazer']):
+            self._versoes[entity_name] = self._versoes.get(entity_name, 0) + 1
+            if acao == 'inserido':
+                item, = args
+                self._retirar_item(entity_name, item.get('id'))
+                self._desindexar_item(entity_name, item.get('id'))
+            elif acao == 'atualizado':
+                item, anterior = args
+                self._desindexar_item(entity_name, item.get('id'))
+                item.clear()
+                item.update(anterior)
+                self._indexar_item(entity_name, item)
+            elif acao == 'removido':
+                posicao, item = args
+                self._recolocar_item(entity_name, posicao, item)
+                self._indexar_item(entity_name, item)
+        with self._lock_ids:
+            self._proximos_ids = transacao['proximos_ids']
+
+    def executar_lote(self, operacoes):
+        resultados = []
+        with self.transacao():
+            for posicao, operacao in enumerate(operacoes):
+                if not isinstance(operacao, dict):
+                    raise ValueError(f"Operação {posicao}: formato inválido")
+                op = operacao.get('op')
+                entity_name = operacao.get('entidade')
+                if not isinstance(self.data.get(entity_name), list):
+                    raise ValueError(f"Operação {posicao}: entidade inválida '{entity_name}'")
+                dados = operacao.get('dados') or {}
+                if not isinstance(dados, dict):
+                    raise ValueError(f"Operação {posicao}: 'dados' deve ser um objeto")
+                if op == 'inserir':
+                    resultados.append(self.adicionar_item(entity_name, dict(dados)))
+                elif op == 'atualizar':
+                    item = self.atualizar_item(entity_name, operacao.get('id'), dados)
+                    if item is None:
+                        raise ValueError(f"Operação {posicao}: {entity_name} {operacao.get('id')} não encontrado")
+                    resultados.append(item)
+                elif op == 'remover':
+                    if not self.remover_item(entity_name, operacao.get('id')):
+                        raise ValueError(f"Operação {posicao}: {entity_name} {operacao.get('id')} não encontrado")
+                    resultados.append({'id': operacao.get('id'), 'removido': True})
+                else:
+                    raise ValueError(f"Operação {posicao}: tipo desconhecido '{op}'")
+        return resultados
+
+    # --- Índices --- #
+    def _reconstruir_indices(self):
+        # Só descarta o que havia: cada índice é recriado no primeiro uso
+        self._geracao += 1
+        self._indice_ids = {}
+        self._indice_posicoes = {}
+        self._indices = {}
+        self._valores_indexados = {}
+        self._indice_busca = {}
+        self._termos_indexados = {}
+        self._agregados = None
+        self._contribuicoes = {}
+        self._tabelas_analise = {}
+        self._dependencias_analise = {}
+        self._livros_estoque = None
+        self._chaves_estoque = {}
+        self._pecas_em_alerta = None
+        self._totais_ordens = None
+        self._ordens_por_item = {}
+        self._itens_por_ordem = {}
+        self._precos_alterados = {}
+
+    def _mapa_ids(self, entity_name):
+        mapa = self._indice_ids.get(entity_name)
+        if mapa is not None:
+            return mapa
+        # Pode ser chamado por vários leitores ao mesmo tempo
+        with self._lock_indices:
+            mapa = self._indice_ids.get(entity_name)
+            if mapa is None:
+                itens = self.data.get(entity_name)
+                mapa = {item.get('id'): item for item in itens} if isinstance(itens, list) else {}
+                self._indice_ids[entity_name] = mapa
+            return mapa
+
+    def _posicoes_ids(self, entity_name):
+        # Só usado por quem escreve (com a trava de escrita)
+        posicoes = self._indice_posicoes.get(entity_name)
+        if posicoes is None:
+            posicoes = self._indice_posicoes[entity_name] = PosicoesLista(self.data[entity_name])
+        return posicoes
+
+    def _anexar_item(self, entity_name, item):
+        if entity_name in self._indice_posicoes:
+            self._indice_posicoes[entity_name].anexar(item.get('id'))
+        self.data[entity_name].append(item)
+
+    def _retirar_item(self, entity_name, item_id):
+        # Mantém a ordem de inserção (a mesma que o journal reconstrói ao
+        # carregar): a posição vem de PosicoesLista e o del só desloca os
+        # ponteiros seguintes. Retorna a posição que o registro ocupava.
+        lista = self.data[entity_name]
+        posicoes = self._posicoes_ids(entity_name)
+        posicao = posicoes.remover(item_id)
+        del lista[posicao]
+        if posicoes.removidas > len(lista):
+            posicoes.renumerar(lista)
+        return posicao
+
+    def _recolocar_item(self, entity_name, posicao, item):
+        # Desfaz uma remoção (as ações são desfeitas em ordem inversa, então
+        # a lista está como logo depois dela). Raro: as posições são
+        # recalculadas na próxima remoção.
+        self.data[entity_name].insert(posicao, item)
+        self._indice_posicoes.pop(entity_name, None)
+
+    def _chaves_indice(self, entity_name, campo, item):
+        if entity_name == 'ordens' and campo == 'servico_id':
+            return {str(s) for s in item.get('servicos_ids', [])}
+        return {str(item.get(campo))}
+
+    def _criar_indice(self, entity_name, campo):
+        indice = {}
+        valores = self._valores_indexados.setdefault(entity_name, {})
+        for item in self.data.get(entity_name, []):
+            chaves = self._chaves_indice(entity_name, campo, item)
+            for chave in chaves:
+                indice.setdefault(chave, {})[item.get('id')] = item
+            valores.setdefault(item.get('id'), {})[campo] = chaves
+        self._indices.setdefault(entity_name, {})[campo] = indice
+        return indice
+
+    def _obter_indice(self, entity_name, campo):
+        indices = self._indices.get(entity_name, {})
+        if campo in indices:
+            return indices[campo]
+        if campo in CAMPOS_INDEXADOS and isinstance(self.data.get(entity_name), list):
+            # Pode ser chamado por vários leitores ao mesmo tempo
+            with self._lock_indices:
+                indices = self._indices.get(entity_name, {})
+                if campo in indices:
+                    return indices[campo]
+                return self._criar_indice(entity_name, campo)
+        return None
+
+    def _indexar_item(self, entity_name, item):
+        item_id = item.get('id')
+        if entity_name in self._indice_ids:
+            self._indice_ids[entity_name][item_id] = item
+        self._acumular_financeiro(entity_name, item)
+        if self._tabelas_analise:
+            self._indexar_analise(entity_name, item)
+        if entity_name in ('pecas', 'movimentacoes_estoque'):
+            self._indexar_estoque(entity_name, item)
+        if self._totais_ordens is not None:
+            self._indexar_totais(entity_name, item)
+        if entity_name in self._indice_busca:
+            self._indexar_busca(entity_name, item)
+        indices = self._indices.get(entity_name)
+        if not indices:
+            return
+        valores = self._valores_indexados.setdefault(entity_name, {}).setdefault(item_id, {})
+        for campo, indice in indices.items():
+            chaves = self._chaves_indice(entity_name, campo, item)
+            for chave in chaves:
+                indice.setdefault(chave, {})[item_id] = item
+            valores[campo] = chaves
+
+    def _desindexar_item(self, entity_name, item_id):
+        if self._tabelas_analise:
+            self._desindexar_analise(entity_name, item_id)
+        if self._totais_ordens is not None:
+            self._desindexar_totais(entity_name, item_id)
+        if entity_name in self._indice_ids:
+            self._indice_ids[entity_name].pop(item_id, None)
+        self._estornar_financeiro(entity_name, item_id)
+        if entity_name in ('pecas', 'movimentacoes_estoque'):
+            self._desindexar_estoque(entity_name, item_id)
+        if entity_name in self._indice_busca:
+            self._desindexar_busca(entity_name, item_id)
+        # Usa os valores guardados na indexação, pois o registro pode já ter
+        # sido alterado no lugar
+        valores = self._valores_indexados.get(entity_name, {}).pop(item_id, {})
+        for campo, chaves in valores.items():
+            indice = self._indices[entity_name][campo]
+            for chave in chaves:
+                bucket = indice.get(chave)
+                if bucket is not None:
+                    bucket.pop(item_id, None)
+                    if not bucket:
+                        del indice[chave]
+
+    # --- Busca Textual --- #
+    def _termos_busca_item(self, entity_name, item):
+        # Cada prefixo de cada termo aponta para o registro; o termo completo
+        # vale o dobro, e campos listados antes em CAMPOS_BUSCA valem mais
+        campos = CAMPOS_BUSCA[entity_name]
+        pontos_por_prefixo = {}
+        for posicao, campo in enumerate(campos):
+            valor = item.get(campo)
+            if valor is None or valor == '':
+                continue
+            peso = len(campos) - posicao
+            for termo in termos_texto(valor, compactar=True):
+                for tamanho in range(1, len(termo) + 1):
+                    prefixo = termo[:tamanho]
+                    pontos = peso * 2 if tamanho == len(termo) else peso
+                    if pontos > pontos_por_prefixo.get(prefixo, 0):
+                        pontos_por_prefixo[prefixo] = pontos
+        return pontos_por_prefixo
+
+    def _indexar_busca(self, entity_name, item):
+        item_id = item.get('id')
+        indice = self._indice_busca[entity_name]
+        pontos_por_prefixo = self._termos_busca_item(entity_name, item)
+        for prefixo, pontos in pontos_por_prefixo.items():
+            indice.setdefault(prefixo, {})[item_id] = pontos
+        self._termos_indexados[entity_name][item_id] = pontos_por_prefixo
+
+    def _desindexar_busca(self, entity_name, item_id):
+        indice = self._indice_busca[entity_name]
+        for prefixo in self._termos_indexados[entity_name].pop(item_id, {}):
+            bucket = indice.get(prefixo)
+            if bucket is not None:
+                bucket.pop(item_id, None)
+                if not bucket:
+                    del indice[prefixo]
+
+    def _criar_indice_busca(self, entity_name):
+        # Montado à parte e só publicado pronto: _obter_indice_busca devolve o
+        # índice sem o lock, então ninguém pode ver um índice pela metade
+        indice = {}
+        termos_indexados = {}
+        for item in self.data.get(entity_name, []):
+            item_id = item.get('id')
+            pontos_por_prefixo = self._termos_busca_item(entity_name, item)
+            for prefixo, pontos in pontos_por_prefixo.items():
+                indice.setdefault(prefixo, {})[item_id] = pontos
+            termos_indexados[item_id] = pontos_por_prefixo
+        self._termos_indexados[entity_name] = termos_indexados
+        self._indice_busca[entity_name] = indice
+        return indice
+
+    def _obter_indice_busca(self, entity_name):
+        indice = self._indice_busca.get(entity_name)
+        if indice is not None:
+            return indice
+        with self._lock_indices:
+            indice = self._indice_busca.get(entity_name)
+            if indice is not None:
+                return indice
+            return self._criar_indice_busca(entity_name)
+
+    def buscar_texto(self, consulta, entidades=None, limite=20):
+        # Todos os termos da consulta precisam casar (como termo inteiro ou
+        # prefixo); a pontuação é a soma dos pontos de cada termo
+        termos = list(dict.fromkeys(termos_texto(consulta)))
+        if not termos:
+            return []
+        candidatos = []
+        for entity_name in entidades or CAMPOS_BUSCA:
+            indice = self._obter_indice_busca(entity_name)
+            buckets = [indice.get(termo) for termo in termos]
+            if not all(buckets):
+                continue
+            # Começa pelo termo mais seletivo
+            buckets.sort(key=len)
+            pontuacao = buckets[0]
+            for bucket in buckets[1:]:
+                pontuacao = {item_id: pontos + bucket[item_id] for item_id, pontos in pontuacao.items() if item_id in bucket}
+                if not pontuacao:
+                    break
+            melhores_entidade = heapq.nsmallest(limite, pontuacao.items(), key=lambda par: (-par[1], par[0]))
+            candidatos.extend((pontos, entity_name, item_id) for item_id, pontos in melhores_entidade)
+
+        melhores = sorted(candidatos, key=lambda c: (-c[0], c[1], c[2]))[:limite]
+        return [{'entidade': entity_name, 'id': item_id, 'pontuacao': pontos,
+                 'registro': self._mapa_ids(entity_name)[item_id]}
+                for pontos, entity_name, item_id in melhores]
+
+    # --- Análises Colunares --- #
+    def _linhas_analise(self, nome_tabela, entity_name, item):
+        if nome_tabela == 'financeiro':
+            contribuicao = self._contribuicao_financeira(entity_name, item)
+            dia = _data_analise(item.get('data'))
+            if contribuicao is None or dia is None:
+                return []
+            _, _, tipo, valor = contribuicao
+            categoria = item.get('categoria')
+            if entity_name == 'despesasGerais':
+                categoria = categoria or item.get('tipo')
+            return [(dia, {'valor': valor, 'saldo': valor if tipo == 'receita' else -valor},
+                     {'tipo': tipo, 'categoria': categoria, 'forma_pagamento': item.get('forma_pagamento'),
+                      'origem': entity_name})]
+
+        # linhas_ordem: uma linha por serviço e por peça, com o valor atual do catálogo
+        dia = _data_analise(item.get('data_abertura'))
+        if dia is None:
+            return []
+        comuns = {'status': item.get('status'), 'forma_pagamento': item.get('forma_pagamento')}
+        linhas = []
+        for servico_id in item.get('servicos_ids', []):
+            servico = self.buscar_item_por_id('servicos', servico_id)
+            if servico:
+                linhas.append((dia, {'valor': _numero_analise(servico.get('valorMaoObra')), 'quantidade': 1.0},
+                               dict(comuns, linha='servico', item=servico.get('descricao'),
+                                    categoria=servico.get('categoria'))))
+        for peca_info in item.get('pecas_usadas', []):
+            peca = self.buscar_item_por_id('pecas', peca_info.get('peca_id'))
+            if peca:
+                quantidade = _numero_analise(peca_info.get('quantidade'))
+                linhas.append((dia, {'valor': _numero_analise(peca.get('precoVenda')) * quantidade,
+                                     'quantidade': quantidade},
+                               dict(comuns, linha='peca', item=peca.get('descricao'), categoria='Peças')))
+        return linhas
+
+    def _dependencias_mudaram(self, nome_tabela):
+        campos_por_entidade = TABELAS_ANALISE[nome_tabela]['dependencias']
+        for (entity_name, item_id), antes in self._dependencias_analise.pop(nome_tabela, {}).items():
+            item = self._indice_ids.get(entity_name, {}).get(item_id)
+            if (tuple(item.get(campo) for campo in campos_por_entidade[entity_name]) if item else None) != antes:
+                return True
+        return False
+
+    def _obter_tabela_analise(self, nome_tabela):
+        tabela = self._tabelas_analise.get(nome_tabela)
+        if tabela is not None and not self._dependencias_analise.get(nome_tabela):
+            return tabela
+        definicao = TABELAS_ANALISE[nome_tabela]
+        # Os mapas de id usam a mesma trava, então são criados antes
+        for entity_name in definicao['dependencias']:
+            self._mapa_ids(entity_name)
+        with self._lock_indices:
+            tabela = self._tabelas_analise.get(nome_tabela)
+            if tabela is not None and self._dependencias_mudaram(nome_tabela):
+                tabela = None
+            if tabela is None:
+                self._dependencias_analise.pop(nome_tabela, None)
+                tabela = TabelaColunar(definicao['dimensoes'], definicao['medidas'])
+                for entity_name in definicao['origens']:
+                    for item in self.data.get(entity_name, []):
+                        tabela.inserir((entity_name, item.get('id')),
+                                       self._linhas_analise(nome_tabela, entity_name, item))
+                self._tabelas_analise[nome_tabela] = tabela
+            return tabela
+
+    def _indexar_analise(self, entity_name, item):
+        for nome_tabela, tabela in self._tabelas_analise.items():
+            if entity_name in TABELAS_ANALISE[nome_tabela]['origens']:
+                tabela.inserir((entity_name, item.get('id')), self._linhas_analise(nome_tabela, entity_name, item))
+
+    def _desindexar_analise(self, entity_name, item_id):
+        for nome_tabela, tabela in self._tabelas_analise.items():
+            definicao = TABELAS_ANALISE[nome_tabela]
+            campos = definicao['dependencias'].get(entity_name)
+            if campos is not None:
+                # Guarda os valores de antes da primeira alteração; a consulta
+                # seguinte compara com os atuais (mudar só o estoque de uma
+                # peça, por exemplo, não refaz a tabela)
+                item = self._indice_ids.get(entity_name, {}).get(item_id)
+                alterados = self._dependencias_analise.setdefault(nome_tabela, {})
+                alterados.setdefault((entity_name, item_id), tuple(item.get(campo) for campo in campos) if item else None)
+            elif entity_name in definicao['origens']:
+                tabela.remover((entity_name, item_id))
+
+    def analisar(self, metrica, agrupar_por=(), inicio=None, fim=None):
+        # Soma (ou contagem) da métrica no período [inicio, fim] (datas),
+        # agrupada por até três chaves entre AGRUPAMENTOS_TEMPO e as dimensões
+        # da tabela da métrica
+        if metrica not in METRICAS_ANALISE:
+            raise ValueError(f"Métrica desconhecida: '{metrica}'")
+        nome_tabela, medida, filtros = METRICAS_ANALISE[metrica]
+        validos = AGRUPAMENTOS_TEMPO + TABELAS_ANALISE[nome_tabela]['dimensoes']
+        invalidos = [agrupamento for agrupamento in agrupar_por if agrupamento not in validos]
+        if invalidos:
+            raise ValueError(f"Agrupamento inválido para '{metrica}': {', '.join(invalidos)}")
+        if len(agrupar_por) > 3 or len(set(agrupar_por)) != len(agrupar_por):
+            raise ValueError('Informe até três agrupamentos diferentes')
+
+        tabela = self._obter_tabela_analise(nome_tabela)
+        resultado = tabela.agregar(medida, filtros or {}, agrupar_por,
+                                   inicio.toordinal() if inicio else None, fim.toordinal() if fim else None)
+        resultado.sort(key=lambda grupo: tuple(
+            (codigo if agrupamento in AGRUPAMENTOS_TEMPO else str(tabela.rotulo(agrupamento, codigo)))
+            for agrupamento, codigo in zip(agrupar_por, grupo[0])))
+        grupos = []
+        for codigos, soma, linhas in resultado:
+            grupo = {agrupamento: tabela.rotulo(agrupamento, codigo) for agrupamento, codigo in zip(agrupar_por, codigos)}
+            grupo['valor'] = round(soma, 2)
+            grupo['registros'] = linhas
+            grupos.append(grupo)
+        return {
+            'metrica': metrica,
+            'agrupar_por': list(agrupar_por),
+            'de': inicio.isoformat() if inicio else None,
+            'ate': fim.isoformat() if fim else None,
+            'total': round(sum(soma for _, soma, _ in resultado), 2),
+            'registros': sum(linhas for _, _, linhas in resultado),
+            'grupos': grupos,
+            'motor': 'numpy' if np is not None else 'python',
+        }
+
+    # --- Estoque --- #
+    @staticmethod
+    def _abaixo_do_minimo(peca):
+        try:
+            return float(peca.get('quantidadeEstoque') or 0) <= float(peca.get('estoqueMinimo') or 0)
+        except (TypeError, ValueError):
+            return False
+
+    def _inserir_no_livro(self, livros, movimentacao):
+        # Movimentações antigas sem horário ficam antes de todas as outras
+        instante = movimentacao.get('timestamp') or movimentacao.get('data') or ''
+        chave = (str(instante), movimentacao.get('id'))
+        peca_id = movimentacao.get('peca_id')
+        livros.setdefault(peca_id, LivroEstoque()).inserir(chave, _delta_estoque(movimentacao))
+        self._chaves_estoque[movimentacao.get('id')] = (peca_id, chave)
+
+    def _obter_livros_estoque(self):
+        if self._livros_estoque is not None:
+            return self._livros_estoque
+        with self._lock_indices:
+            if self._livros_estoque is None:
+                livros = {}
+                self._chaves_estoque = {}
+                # Em ordem cronológica, para que cada inserção caia no fim do livro
+                movimentacoes = sorted(self.data.get('movimentacoes_estoque', []),
+                                       key=lambda m: (str(m.get('timestamp') or m.get('data') or ''), m.get('id')))
+                for movimentacao in movimentacoes:
+                    self._inserir_no_livro(livros, movimentacao)
+                self._livros_estoque = livros
+            return self._livros_estoque
+
+    def _obter_pecas_em_alerta(self):
+        if self._pecas_em_alerta is not None:
+            return self._pecas_em_alerta
+        with self._lock_indices:
+            if self._pecas_em_alerta is None:
+                self._pecas_em_alerta = {peca.get('id') for peca in self.data.get('pecas', []) if self._abaixo_do_minimo(peca)}
+            return self._pecas_em_alerta
+
+    def _indexar_estoque(self, entity_name, item):
+        if entity_name == 'pecas':
+            if self._pecas_em_alerta is not None and self._abaixo_do_minimo(item):
+                self._pecas_em_alerta.add(item.get('id'))
+        elif self._livros_estoque is not None:
+            self._inserir_no_livro(self._livros_estoque, item)
+
+    def _desindexar_estoque(self, entity_name, item_id):
+        if entity_name == 'pecas':
+            if self._pecas_em_alerta is not None:
+                self._pecas_em_alerta.discard(item_id)
+        elif self._livros_estoque is not None and item_id in self._chaves_estoque:
+            peca_id, chave = self._chaves_estoque.pop(item_id)
+            self._livros_estoque[peca_id].remover(chave)
+
+    def pecas_em_alerta(self):
+        # Peças com quantidadeEstoque <= estoqueMinimo, da mais para a menos crítica
+        pecas = [self.buscar_item_por_id('pecas', peca_id) for peca_id in self._obter_pecas_em_alerta()]
+        alertas = []
+        for peca in pecas:
+            quantidade = float(peca.get('quantidadeEstoque') or 0)
+            minimo = float(peca.get('estoqueMinimo') or 0)
+            alertas.append(dict(peca, falta=round(minimo - quantidade, 3)))
+        alertas.sort(key=lambda peca: (-peca['falta'], peca.get('id')))
+        return alertas
+
+    def estoque_em(self, peca_id, instante):
+        # Estoque da peça imediatamente antes do instante (ISO): o estoque
+        # atual menos tudo o que foi movimentado a partir dele
+        peca = self.buscar_item_por_id('pecas', peca_id)
+        if peca is None:
+            return None
+        livro = self._obter_livros_estoque().get(peca_id)
+        atual = float(peca.get('quantidadeEstoque') or 0)
+        if livro is None:
+            return atual
+        return atual - (livro.total() - livro.saldo_ate(livro.posicao(instante)))
+
+    def historico_estoque(self, peca_id, desde=None, ate=None, limite=100):
+        # Movimentações da peça no intervalo [desde, ate) (instantes ISO), da
+        # mais recente para a mais antiga, com o estoque logo após cada uma
+        peca = self.buscar_item_por_id('pecas', peca_id)
+        if peca is None:
+            return None
+        livro = self._obter_livros_estoque().get(peca_id) or LivroEstoque()
+        atual = float(peca.get('quantidadeEstoque') or 0)
+        total = livro.total()
+        inicio = livro.posicao(desde) if desde else 0
+        fim = livro.posicao(ate) if ate else len(livro)
+        inicio = max(inicio, fim - limite)
+        saldo = atual - total + livro.saldo_ate(inicio)
+        movimentacoes = self._mapa_ids('movimentacoes_estoque')
+        historico = []
+        for posicao in range(inicio, fim):
+            saldo += livro.deltas[posicao]
+            historico.append(dict(movimentacoes.get(livro.chaves[posicao][1], {}), estoque_apos=round(saldo, 3)))
+        historico.reverse()
+        return {
+            'peca_id': peca_id,
+            'estoque_atual': atual,
+            'estoque_inicial': round(atual - total, 3),
+            'total_movimentacoes': len(livro),
+            'movimentacoes': historico,
+        }
+
+    # --- Totais das Ordens --- #
+    @staticmethod
+    def _itens_da_ordem(ordem):
+        chaves = {('servicos', servico_id) for servico_id in ordem.get('servicos_ids', [])}
+        chaves.update(('pecas', peca_info.get('peca_id')) for peca_info in ordem.get('pecas_usadas', []))
+        return chaves
+
+    def _obter_totais_ordens(self):
+        if self._totais_ordens is not None and not self._precos_alterados:
+            return self._totais_ordens
+        with self._lock_indices:
+            if self._totais_ordens is None:
+                ordens_por_item = {}
+                itens_por_ordem = {}
+                for ordem in self.data.get('ordens', []):
+                    chaves = self._itens_da_ordem(ordem)
+                    itens_por_ordem[ordem.get('id')] = chaves
+                    for chave in chaves:
+                        ordens_por_item.setdefault(chave, set()).add(ordem.get('id'))
+                self._ordens_por_item = ordens_por_item
+                self._itens_por_ordem = itens_por_ordem
+                self._precos_alterados = {}
+                self._totais_ordens = {}
+            elif self._precos_alterados:
+                # Só as ordens que usam um item cujo preço de fato mudou (ou
+                # que foi removido ou criado) perdem o total guardado
+                for (entity_name, item_id), antes in self._precos_alterados.items():
+                    item = self._indice_ids.get(entity_name, {}).get(item_id)
+                    if (item.get(CAMPOS_PRECO[entity_name]) if item else None) != antes:
+                        for ordem_id in self._ordens_por_item.get((entity_name, item_id), ()):
+                            self._totais_ordens.pop(ordem_id, None)
+                self._precos_alterados = {}
+            return self._totais_ordens
+
+    def _indexar_totais(self, entity_name, item):
+        item_id = item.get('id')
+        if entity_name == 'ordens':
+            chaves = self._itens_da_ordem(item)
+            self._itens_por_ordem[item_id] = chaves
+            for chave in chaves:
+                self._ordens_por_item.setdefault(chave, set()).add(item_id)
+        elif (entity_name, item_id) in self._ordens_por_item:
+            # Item de catálogo criado com um id que as ordens já citavam
+            self._precos_alterados.setdefault((entity_name, item_id), None)
+
+    def _desindexar_totais(self, entity_name, item_id):
+        if entity_name == 'ordens':
+            self._totais_ordens.pop(item_id, None)
+            for chave in self._itens_por_ordem.pop(item_id, ()):
+                ordens = self._ordens_por_item.get(chave)
+                if ordens is not None:
+                    ordens.discard(item_id)
+                    if not ordens:
+                        del self._ordens_por_item[chave]
+        elif entity_name in CAMPOS_PRECO and (entity_name, item_id) in self._ordens_por_item:
+            # Guarda o preço de antes da primeira alteração; mudar só o
+            # estoque de uma peça, por exemplo, não invalida nada
+            item = self._indice_ids.get(entity_name, {}).get(item_id)
+            self._precos_alterados.setdefault((entity_name, item_id),
+                                              item.get(CAMPOS_PRECO[entity_name]) if item else None)
+
+    def calcular_totais_ordens(self, ordem_ids):
+        # {id: total} das ordens existentes entre as pedidas
+        return {ordem_id: self.calcular_total_ordem(ordem_id) for ordem_id in ordem_ids
+                if self.buscar_item_por_id('ordens', ordem_id) is not None}
+
+    # --- Agregados Financeiros --- #
+    def _contribuicao_financeira(self, entity_name, item):
+        if entity_name == 'movimentacoes':
+            tipo = item.get('tipo')
+            if tipo not in ('receita', 'despesa'):
+                return None
+        elif entity_name == 'despesasGerais':
+            tipo = 'despesa'
+        else:
+            return None
+        data = item.get('data') or ''
+        try:
+            valor = float(item.get('valor'))
+        except (TypeError, ValueError):
+            return None
+        if not isinstance(data, str):
+            return None
+        return (data[:7], data[:4], tipo, valor)
+
+    @staticmethod
+    def _aplicar_contribuicao(agregados, contribuicao, sinal):
+        mes, ano, tipo, valor = contribuicao
+        for periodo, chave in (('mes', mes), ('ano', ano)):
+            totais = agregados[periodo].setdefault(chave, {'receita': 0.0, 'despesa': 0.0, 'registros': 0})
+            totais[tipo] += sinal * valor
+            totais['registros'] += sinal
+            if totais['registros'] == 0:
+                # Sem registros no período: descarta o resíduo de ponto flutuante
+                del agregados[periodo][chave]
+
+    def _acumular_financeiro(self, entity_name, item):
+        if self._agregados is None:
+            return
+        contribuicao = self._contribuicao_financeira(entity_name, item)
+        if contribuicao is None:
+            return
+        self._contribuicoes.setdefault(entity_name, {})[item.get('id')] = contribuicao
+        self._aplicar_contribuicao(self._agregados, contribuicao, 1)
+
+    def _estornar_financeiro(self, entity_name, item_id):
+        if self._agregados is None:
+            return
+        contribuicao = self._contribuicoes.get(entity_name, {}).pop(item_id, None)
+        if contribuicao is not None:
+            self._aplicar_contribuicao(self._agregados, contribuicao, -1)
+
+    def _obter_agregados(self):
+        if self._agregados is not None:
+            return self._agregados
+        with self._lock_indices:
+            if self._agregados is None:
+                # Montado à parte e publicado só no fim, pois outros leitores
+                # consultam self._agregados sem a trava
+                agregados = {'mes': {}, 'ano': {}}
+                contribuicoes = {}
+                for entity_name in ('movimentacoes', 'despesasGerais'):
+                    for item in self.data.get(entity_name, []):
+                        contribuicao = self._contribuicao_financeira(entity_name, item)
+                        if contribuicao is not None:
+                            contribuicoes.setdefault(entity_name, {})[item.get('id')] = contribuicao
+                            self._aplicar_contribuicao(agregados, contribuicao, 1)
+                self._contribuicoes = contribuicoes
+                self._agregados = agregados
+            return self._agregados
+
+    def _totais_financeiros(self, periodo, chave):
+        totais = self._obter_agregados()[periodo].get(chave)
+        if not totais:
+            return 0.0, 0.0
+        return round(totais['receita'], 2), round(totais['despesa'], 2)
+
     def _inicializar_dados_exemplo(self):
         self.data['servicos'] = [
             {'id': 1, 'descricao': 'Troca de Óleo', 'categoria': 'Manutenção', 'valorMaoObra': 50.00, 'tempoEstimado': '30 min'},
@@ -64,47 +2965,97 @@ class MecanicaGoelzer:
         self._salvar_dados()
 
     def _get_next_id(self, entity_name):
-        # Garante que a lista exista e não esteja vazia
-        if not self.data.get(entity_name):
-            return 1
-        return max([item.get('id', 0) for item in self.data[entity_name]] + [0]) + 1
+        # Contador monotônico por entidade, inicializado com o maior id existente
+        with self._lock_ids:
+            if entity_name not in self._proximos_ids:
+                self._proximos_ids[entity_name] = max([item.get('id', 0) for item in self.data.get(entity_name, [])] + [0]) + 1
+            proximo_id = self._proximos_ids[entity_name]
+            self._proximos_ids[entity_name] += 1
+            return proximo_id
 
+    @_com_escrita
     def adicionar_item(self, entity_name, item):
         item['id'] = self._get_next_id(entity_name)
-        self.data[entity_name].append(item)
-        self._salvar_dados()
+        if entity_name == 'movimentacoes_estoque':
+            # O livro de estoque ordena as movimentações pelo horário
+            item.setdefault('timestamp', datetime.now().isoformat())
+        self._anexar_item(entity_name, item)
+        self._indexar_item(entity_name, item)
+        self._registrar_desfazer('inserido', entity_name, item)
+        self._persistir('inserir', entity_name, item['id'], item)
         return item
 
+    def _consulta_direta(self, entity_name):
+        # No SQLite, leituras de uma entidade ainda não carregada vão direto ao
+        # banco. Quem escreve sempre usa (e carrega) a lista em memória.
+        return (isinstance(self.data, DadosSQLite) and self.data.pendente(entity_name)
+                and not self.trava.escrevendo())
+
     def listar_itens(self, entity_name, filters=None):
+        if filters and self._consulta_direta(entity_name):
+            itens = self._armazenamento.filtrar(entity_name, {key: str(value) for key, value in filters.items()})
+            if itens is not None:
+                return itens
         itens = self.data.get(entity_name, [])
-        if filters:
-            for key, value in filters.items():
-                itens = [item for item in itens if str(item.get(key)) == str(value)]
-        return itens
+        if not filters:
+            return itens
+
+        # Parte do menor bucket entre os campos indexados e aplica o resto dos
+        # filtros só sobre ele
+        filtros = {key: str(value) for key, value in filters.items()}
+        candidatos = None
+        campo_usado = None
+        for key, value in filtros.items():
+            indice = self._obter_indice(entity_name, key)
+            if indice is None:
+                continue
+            bucket = indice.get(value, {})
+            if candidatos is None or len(bucket) < len(candidatos):
+                candidatos = bucket
+                campo_usado = key
+        if candidatos is None:
+            candidatos = itens
+        else:
+            candidatos = sorted(candidatos.values(), key=lambda item: item.get('id', 0))
+            del filtros[campo_usado]
+        for key, value in filtros.items():
+            candidatos = [item for item in candidatos if value in self._chaves_indice(entity_name, key, item)]
+        return candidatos
 
     def buscar_item_por_id(self, entity_name, item_id):
-        for item in self.data.get(entity_name, []):
-            if item.get('id') == item_id:
-                return item
-        return None
+        if self._consulta_direta(entity_name):
+            return self._armazenamento.buscar(entity_name, item_id)
+        return self._mapa_ids(entity_name).get(item_id)
 
+    @_com_escrita
     def atualizar_item(self, entity_name, item_id, novos_dados):
-        for i, item in enumerate(self.data.get(entity_name, [])):
-            if item.get('id') == item_id:
-                self.data[entity_name][i].update(novos_dados)
-                self._salvar_dados()
-                return self.data[entity_name][i]
-        return None
+        item = self.buscar_item_por_id(entity_name, item_id)
+        if item is None:
+            return None
+        if self._transacao is not None:
+            self._registrar_desfazer('atualizado', entity_name, item, copy.deepcopy(item))
+        self._desindexar_item(entity_name, item_id)
+        item.update(novos_dados)
+        self._indexar_item(entity_name, item)
+        self._persistir('atualizar', entity_name, item_id, novos_dados)
+        return item
 
+    @_com_escrita
     def remover_item(self, entity_name, item_id):
-        initial_len = len(self.data.get(entity_name, []))
-        self.data[entity_name] = [item for item in self.data.get(entity_name, []) if item.get('id') != item_id]
-        if len(self.data[entity_name]) < initial_len:
-            self._salvar_dados()
-            return True
-        return False
+        item = self.buscar_item_por_id(entity_name, item_id)
+        if item is None:
+            return False
+        posicao = self._retirar_item(entity_name, item_id)
+        self._registrar_desfazer('removido', entity_name, posicao, item)
+        self._desindexar_item(entity_name, item_id)
+        self._persistir('remover', entity_name, item_id)
+        return True
 
     def calcular_total_ordem(self, ordem_id):
+        totais = self._obter_totais_ordens()
+        total = totais.get(ordem_id)
+        if total is not None:
+            return total
         ordem = self.buscar_item_por_id('ordens', ordem_id)
         if not ordem:
             return 0.0
@@ -123,32 +3074,20 @@ class MecanicaGoelzer:
         desconto = ordem.get('desconto', 0.0)
         total -= desconto
 
-        return max(0.0, total)
+        totais[ordem_id] = max(0.0, total)
+        return totais[ordem_id]
 
     def atualizar_dashboard(self):
         total_clientes = len(self.data['clientes'])
         total_veiculos = len(self.data['veiculos'])
-        os_abertas = len([os for os in self.data['ordens'] if os['status'] in ['Aberta', 'Em Execução']])
+        por_status = self._obter_indice('ordens', 'status')
+        os_abertas = sum(len(por_status.get(status, {})) for status in ['Aberta', 'Em Execução'])
 
         hoje = datetime.now()
         mes_atual_str = hoje.strftime('%Y-%m')
-        ano_atual_str = hoje.strftime('%Y')
 
-        receita_mensal = 0.0
-        despesa_mensal = 0.0
-
-        for mov in self.data['movimentacoes']:
-            if mov.get('data', '').startswith(mes_atual_str):
-                if mov['tipo'] == 'receita':
-                    receita_mensal += mov['valor']
-                elif mov['tipo'] == 'despesa':
-                    despesa_mensal += mov['valor']
-        
-        for despesa in self.data['despesasGerais']:
-            if despesa.get('data', '').startswith(mes_atual_str):
-                despesa_mensal += despesa['valor']
-
-        lucro_mensal = receita_mensal - despesa_mensal
+        receita_mensal, despesa_mensal = self._totais_financeiros('mes', mes_atual_str)
+        lucro_mensal = round(receita_mensal - despesa_mensal, 2)
 
         dashboard_data = {
             'totalClientes': total_clientes,
@@ -172,21 +3111,8 @@ class MecanicaGoelzer:
         return margem
     
     def gerar_relatorio_financeiro_anual(self, ano):
-        receita_anual = 0.0
-        despesa_anual = 0.0
-
-        for mov in self.data['movimentacoes']:
-            if mov.get('data', '').startswith(str(ano)):
-                if mov['tipo'] == 'receita':
-                    receita_anual += mov['valor']
-                elif mov['tipo'] == 'despesa':
-                    despesa_anual += mov['valor']
-        
-        for despesa in self.data['despesasGerais']:
-            if despesa.get('data', '').startswith(str(ano)):
-                despesa_anual += despesa['valor']
-
-        lucro_anual = receita_anual - despesa_anual
+        receita_anual, despesa_anual = self._totais_financeiros('ano', str(ano))
+        lucro_anual = round(receita_anual - despesa_anual, 2)
 
         relatorio = {
             'ano': ano,
@@ -197,22 +3123,9 @@ class MecanicaGoelzer:
         return relatorio
 
     def gerar_relatorio_financeiro_mensal(self, ano, mes):
-        receita_mensal = 0.0
-        despesa_mensal = 0.0
         mes_str = f"{ano}-{str(mes).zfill(2)}"
-
-        for mov in self.data['movimentacoes']:
-            if mov.get('data', '').startswith(mes_str):
-                if mov['tipo'] == 'receita':
-                    receita_mensal += mov['valor']
-                elif mov['tipo'] == 'despesa':
-                    despesa_mensal += mov['valor']
-        
-        for despesa in self.data['despesasGerais']:
-            if despesa.get('data', '').startswith(mes_str):
-                despesa_mensal += despesa['valor']
-
-        lucro_mensal = receita_mensal - despesa_mensal
+        receita_mensal, despesa_mensal = self._totais_financeiros('mes', mes_str)
+        lucro_mensal = round(receita_mensal - despesa_mensal, 2)
 
         relatorio = {
             'ano': ano,
@@ -236,16 +3149,20 @@ class MecanicaGoelzer:
         return f"ORC-{ano_atual}-{str(proximo_numero).zfill(4)}"
 
     def registrar_log(self, acao, detalhes):
+        # Não passa pela trava nem pelo armazenamento principal: o log vai
+        # para a fila do RegistroAuditoria. Dentro de uma transação, só é
+        # enfileirado se ela for confirmada.
         log_entry = {
-            'id': self._get_next_id('logs'),
             'timestamp': datetime.now().isoformat(),
             'acao': acao,
             'detalhes': detalhes
         }
-        self.data['logs'].append(log_entry)
-        self._salvar_dados()
-        return log_entry
+        if self._transacao is not None and self.trava.escrevendo():
+            self._transacao['logs'].append(log_entry)
+            return log_entry
+        return self.auditoria.registrar(log_entry)
 
+    @_em_transacao
     def atualizar_estoque_automatico(self, ordem_id):
         ordem = self.buscar_item_por_id('ordens', ordem_id)
         if not ordem or not ordem.get('pecas_usadas'):
@@ -254,8 +3171,7 @@ class MecanicaGoelzer:
         for p_usada in ordem['pecas_usadas']:
             peca = self.buscar_item_por_id('pecas', p_usada['peca_id'])
             if peca:
-                peca['quantidadeEstoque'] -= p_usada['quantidade']
-                self.atualizar_item('pecas', peca['id'], peca)
+                self.atualizar_item('pecas', peca['id'], {'quantidadeEstoque': peca['quantidadeEstoque'] - p_usada['quantidade']})
                 self.adicionar_item('movimentacoes_estoque', {
                     'peca_id': peca['id'],
                     'quantidade': p_usada['quantidade'],
@@ -263,9 +3179,9 @@ class MecanicaGoelzer:
                     'motivo': f"OS {ordem_id}",
                     'timestamp': datetime.now().isoformat()
                 })
-        self._salvar_dados()
         return True
 
+    @_em_transacao
     def registrar_movimentacao_financeira(self, ordem_id, tipo):
         ordem = self.buscar_item_por_id('ordens', ordem_id)
         if not ordem:
@@ -294,9 +3210,9 @@ class MecanicaGoelzer:
                         'data': ordem.get('data_fechamento', datetime.now().isoformat().split('T')[0]),
                         'ordem_id': ordem['id']
                     })
-        self._salvar_dados()
         return True
     
+    @_com_escrita
     def adicionar_conta_receber(self, ordem_id):
         ordem = self.buscar_item_por_id('ordens', ordem_id)
         if not ordem or not ordem.get('forma_pagamento') or 'prazo' not in ordem['forma_pagamento'].lower():
@@ -314,41 +3230,458 @@ class MecanicaGoelzer:
         }
         return self.adicionar_item('contas_a_receber', nova_conta)
 
+    @_com_escrita
     def registrar_pagamento_conta(self, conta_id, valor_pago):
         conta = self.buscar_item_por_id('contas_a_receber', conta_id)
         if not conta:
             return False
         
-        conta['valor_pago'] += valor_pago
-        if conta['valor_pago'] >= conta['valor_total']:
-            conta['status'] = 'Pago'
-        else:
-            conta['status'] = 'Parcial'
-        
-        conta['parcelas'].append({
-            'valor': valor_pago,
-            'data': datetime.now().isoformat().split('T')[0],
-            'forma_pagamento': 'Dinheiro' # Assumindo dinheiro por enquanto
+        total_pago = conta['valor_pago'] + valor_pago
+        self.atualizar_item('contas_a_receber', conta_id, {
+            'valor_pago': total_pago,
+            'status': 'Pago' if total_pago >= conta['valor_total'] else 'Parcial',
+            'parcelas': conta['parcelas'] + [{
+                'valor': valor_pago,
+                'data': datetime.now().isoformat().split('T')[0],
+                'forma_pagamento': 'Dinheiro' # Assumindo dinheiro por enquanto
+            }]
         })
-        self.atualizar_item('contas_a_receber', conta_id, conta)
         return True
 
+    @_em_transacao
+    def fechar_ordem(self, ordem_id, dados=None):
+        # Fechamento completo da OS (status, estoque, financeiro, conta a
+        # receber e log) em uma única transação
+        ordem = self.buscar_item_por_id('ordens', ordem_id)
+        if not ordem:
+            return None
+
+        alteracoes = dict(dados or {})
+        alteracoes.setdefault('status', 'Concluída')
+        alteracoes.setdefault('data_fechamento', datetime.now().isoformat().split('T')[0])
+        self.atualizar_item('ordens', ordem_id, alteracoes)
+        if 'valor_total' not in alteracoes:
+            self.atualizar_item('ordens', ordem_id, {'valor_total': self.calcular_total_ordem(ordem_id)})
+
+        self.atualizar_estoque_automatico(ordem_id)
+        self.registrar_movimentacao_financeira(ordem_id, 'receita')
+        self.registrar_movimentacao_financeira(ordem_id, 'despesa')
+        self.adicionar_conta_receber(ordem_id)
+        self.registrar_log('Fechamento de OS', {'ordem_id': ordem_id, 'valor_total': ordem['valor_total']})
+        return ordem
+
     def backup_data(self):
         return self.data
 
+    def exportar_backup(self, formato='json'):
+        # Gera o backup aos poucos, entidade por entidade e em lotes de
+        # registros, sem montar o banco inteiro em uma string. A trava de
+        # leitura só é segurada enquanto cada lote é serializado.
+        ndjson = formato == 'ndjson'
+        dumps = functools.partial(json.dumps, ensure_ascii=False)
+        with self.trava.leitura():
+            if isinstance(self.data, DadosPreguicosos):
+                entidades = self.data.entidades()
+            else:
+                entidades = [nome for nome, itens in self.data.items() if isinstance(itens, list)]
+        yield dumps({'backup': 'mecanica-goelzer', 'versao': 1, 'entidades': entidades}) + '\n' if ndjson else '{'
+        for posicao, entity_name in enumerate(entidades):
+            if not ndjson:
+                yield (', ' if posicao else '') + dumps(entity_name) + ': ['
+            with self.trava.leitura():
+                # Cópia só das referências: a lista sai como estava neste
+                # momento. Tabelas do SQLite ainda não carregadas são lidas só
+                # para o backup, sem ficar na memória.
+                if self._consulta_direta(entity_name):
+                    itens = self._armazenamento.ler_tabela(entity_name)
+                else:
+                    itens = list(self.data.get(entity_name, []))
+            for inicio in range(0, len(itens), BACKUP_REGISTROS_POR_LOTE):
+                with self.trava.leitura():
+                    lote = itens[inicio:inicio + BACKUP_REGISTROS_POR_LOTE]
+                    if ndjson:
+                        parte = ''.join(dumps({'entidade': entity_name, 'registro': item}) + '\n' for item in lote)
+                    else:
+                        parte = (', ' if inicio else '') + ', '.join(dumps(item) for item in lote)
+                yield parte
+            if not ndjson:
+                yield ']'
+        if not ndjson:
+            yield '}'
+
+    @contextmanager
+    def _restauracao_exclusiva(self):
+        # Uma restauração por vez: a segunda é recusada, em vez de apagar os
+        # dados temporários e o progresso da que está em andamento
+        if not self._lock_restauracao.acquire(blocking=False):
+            raise RestauracaoEmAndamento('Já existe uma restauração em andamento')
+        try:
+            yield
+        finally:
+            self._lock_restauracao.release()
+
+    def importar_backup_ndjson(self, linhas, total_bytes=None):
+        with self._restauracao_exclusiva():
+            return self._importar_backup_ndjson(linhas, total_bytes)
+
+    def _importar_backup_ndjson(self, linhas, total_bytes):
+        # Lê o backup linha a linha validando cada registro e gravando em lotes
+        # pelo armazenamento, fora da trava de escrita; os dados atuais só são
+        # substituídos se o arquivo inteiro for válido
+        progresso = {'status': 'lendo', 'registros': 0, 'bytes': 0, 'total_bytes': total_bytes, 'entidade': None}
+        self._progresso_restauracao = progresso
+        restauracao = self._armazenamento.iniciar_restauracao()
+        lotes = {}
+        ids_vistos = {}
+        try:
+            for numero, linha in enumerate(linhas, 1):
+                progresso['bytes'] += len(linha)
+                linha = linha.strip()
+                if not linha:
+                    continue
+                try:
+                    registro = json.loads(linha)
+                except ValueError:
+                    raise ValueError(f"Linha {numero}: JSON inválido")
+                if not isinstance(registro, dict):
+                    raise ValueError(f"Linha {numero}: esperado um objeto JSON")
+                if 'backup' in registro:
+                    for entity_name in registro.get('entidades', []):
+                        if entity_name != 'logs' and entity_name not in lotes:
+                            restauracao.adicionar(entity_name, [])
+                            lotes[entity_name] = []
+                    continue
+
+                entity_name = registro.get('entidade')
+                item = registro.get('registro')
+                if not isinstance(entity_name, str) or not isinstance(item, dict):
+                    raise ValueError(f"Linha {numero}: esperado {{'entidade': ..., 'registro': {{...}}}}")
+                item_id = item.get('id')
+                if not isinstance(item_id, int) or isinstance(item_id, bool):
+                    raise ValueError(f"Linha {numero}: registro de {entity_name} sem id numérico")
+                if item_id in ids_vistos.setdefault(entity_name, set()):
+                    raise ValueError(f"Linha {numero}: id {item_id} repetido em {entity_name}")
+                ids_vistos[entity_name].add(item_id)
+                progresso['registros'] += 1
+                progresso['entidade'] = entity_name
+                # Os logs de auditoria não fazem parte do backup dos dados
+                if entity_name == 'logs':
+                    continue
+                lote = lotes.setdefault(entity_name, [])
+                lote.append(item)
+                if len(lote) >= BACKUP_REGISTROS_POR_LOTE:
+                    restauracao.adicionar(entity_name, lote)
+                    lotes[entity_name] = []
+
+            for entity_name, lote in lotes.items():
+                restauracao.adicionar(entity_name, lote)
+            del lotes
+            if not all(key in restauracao.entidades() for key in ENTIDADES_OBRIGATORIAS_BACKUP):
+                raise ValueError("Dados de backup inválidos: chaves essenciais faltando.")
+            progresso['status'] = 'gravando'
+            restauracao.preparar()
+            self._concluir_restauracao(restauracao)
+            progresso['status'] = 'concluido'
+        except Exception as e:
+            progresso['status'] = 'erro'
+            progresso['erro'] = str(e)
+            raise
+        finally:
+            restauracao.descartar()
+        return progresso
+
+    @_com_escrita
+    def _concluir_restauracao(self, restauracao):
+        with metricas.cronometrar('mecanica_persistencia_duracao_segundos', operacao='salvar'):
+            data = self._armazenamento.concluir_restauracao(restauracao, self.data)
+        self.data = data
+        with self._lock_ids:
+            self._proximos_ids = {}
+        self._reconstruir_indices()
+        self.feed.publicar([{'op': 'recarregar'}])
+
+    def progresso_restauracao(self):
+        return dict(self._progresso_restauracao)
+
+    @_com_escrita
     def restore_data(self, backup_data):
-        # Validação básica da estrutura do backup
-        required_keys = ['clientes', 'veiculos', 'servicos', 'pecas', 'ordens']
-        if not all(key in backup_data for key in required_keys):
-            raise ValueError("Dados de backup inválidos: chaves essenciais faltando.")
-        
-        self.data.update(backup_data)
-        self._salvar_dados()
-        return True
+        with self._restauracao_exclusiva():
+            # Validação básica da estrutura do backup
+            if not all(key in backup_data for key in ENTIDADES_OBRIGATORIAS_BACKUP):
+                raise ValueError("Dados de backup inválidos: chaves essenciais faltando.")
+
+            # Os logs de auditoria não fazem parte do backup dos dados
+            self.data.update({chave: valor for chave, valor in backup_data.items() if chave != 'logs'})
+            with self._lock_ids:
+                self._proximos_ids = {}
+            self._reconstruir_indices()
+            self._salvar_dados()
+            # Quem acompanha o feed precisa recarregar tudo
+            self.feed.publicar([{'op': 'recarregar'}])
+            return True
 
 
 # --- Instância da Lógica de Negócios --- #
 sistema_mecanica = MecanicaGoelzer()
+atexit.register(sistema_mecanica._armazenamento.fechar)
+atexit.register(sistema_mecanica.auditoria.fechar)
+
+# --- Métricas das Requisições --- #
+# Registrado antes da trava das requisições, para que a latência inclua a espera por ela
+def _tamanhos_entidades():
+    data = sistema_mecanica.data
+    if isinstance(data, DadosPreguicosos):
+        # Sem decodificar as entidades que ainda estão só no snapshot
+        return data.tamanhos()
+    return {nome: len(itens) for nome, itens in list(data.items()) if isinstance(itens, list)}
+
+
+metricas.registrar_medidor('mecanica_entidade_registros', lambda: [
+    ({'entidade': nome}, total) for nome, total in _tamanhos_entidades().items()
+])
+
+@app.before_request
+def iniciar_medicao_requisicao():
+    g.inicio_requisicao = time.perf_counter()
+    if PERFIL_LIMITE_MS is not None and random.random() < PERFIL_AMOSTRAGEM:
+        perfil = cProfile.Profile()
+        try:
+            perfil.enable()
+        except ValueError:
+            # Outro profiler já ativo (no Python 3.12+ ele vale para o processo todo)
+            return
+        g.perfil = perfil
+
+@app.after_request
+def registrar_status_requisicao(response):
+    g.status_requisicao = response.status_code
+    return response
+
+@app.teardown_request
+def finalizar_medicao_requisicao(exc):
+    inicio = g.pop('inicio_requisicao', None)
+    if inicio is None:
+        return
+    duracao = time.perf_counter() - inicio
+    rota = request.url_rule.rule if request.url_rule else 'nao_encontrada'
+    status = g.pop('status_requisicao', 500)
+    metricas.incrementar('mecanica_http_requisicoes_total', rota=rota, metodo=request.method, status=status)
+    metricas.observar('mecanica_http_duracao_segundos', duracao, rota=rota, metodo=request.method)
+
+    perfil = g.pop('perfil', None)
+    if perfil is None:
+        return
+    perfil.disable()
+    if duracao * 1000 >= PERFIL_LIMITE_MS:
+        os.makedirs(PERFIL_DIR, exist_ok=True)
+        nome_rota = re.sub(r'[^A-Za-z0-9]+', '_', request.path).strip('_') or 'raiz'
+        nome = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{request.method}-{nome_rota[:60]}-{int(duracao * 1000)}ms.prof"
+        perfil.dump_stats(os.path.join(PERFIL_DIR, nome))
+        metricas.incrementar('mecanica_perfis_gravados_total')
+
+@app.route('/metrics', methods=['GET'])
+def get_metricas():
+    return app.response_class(metricas.texto(), mimetype='text/plain; version=0.0.4')
+
+# --- Controle de Concorrência das Requisições --- #
+# A restauração lê o upload inteiro antes de trocar os dados, então só trava
+# na troca (restore_data); o progresso precisa responder enquanto isso. Os
+# logs de auditoria têm armazenamento próprio, e o feed de alterações fica
+# aberto por minutos sem ler os dados.
+ROTAS_COM_TRAVA_PROPRIA = {'/api/restore', '/api/restore/progresso', '/api/logs', '/api/changes'}
+# POSTs que só leem (o corpo é grande demais para a query string)
+ROTAS_SOMENTE_LEITURA = {'/api/ordens/totais'}
+
+@app.before_request
+def adquirir_trava_requisicao():
+    # GETs da API rodam em paralelo; as demais requisições da API são serializadas
+    if not request.path.startswith('/api/') or request.path in ROTAS_COM_TRAVA_PROPRIA:
+        return
+    if request.method in ('GET', 'HEAD', 'OPTIONS') or request.path in ROTAS_SOMENTE_LEITURA:
+        # As escritas já fazem isso ao pegar a trava entre processos
+        sistema_mecanica.acompanhar_processos()
+        sistema_mecanica.trava.adquirir_leitura()
+        g.trava = 'leitura'
+    else:
+        sistema_mecanica.adquirir_escrita()
+        g.trava = 'escrita'
+
+@app.teardown_request
+def liberar_trava_requisicao(exc):
+    trava = g.pop('trava', None)
+    if trava == 'leitura':
+        sistema_mecanica.trava.liberar_leitura()
+    elif trava == 'escrita':
+        sistema_mecanica.liberar_escrita()
+
+# --- Cache HTTP (ETag e Arquivos Estáticos) --- #
+# Muda a cada início do processo, para que ETags de uma execução anterior
+# (com contadores de versão zerados) nunca sejam confundidos com os atuais
+EPOCA_CACHE = uuid.uuid4().hex[:8]
+CACHE_RESPOSTAS_MAX = 256
+CACHE_RESPOSTA_MAX_BYTES = 4 * 1024 * 1024
+CACHE_ESTATICOS_MAX_AGE = 365 * 24 * 3600
+
+_cache_respostas = OrderedDict()
+_lock_cache_respostas = threading.Lock()
+_impressoes_estaticos = {}
+
+def impressao_estatico(filename):
+    # Hash do conteúdo do arquivo, recalculado só quando o arquivo muda
+    caminho = os.path.join(app.static_folder, filename)
+    try:
+        mtime = os.path.getmtime(caminho)
+    except OSError:
+        return None
+    atual = _impressoes_estaticos.get(filename)
+    if atual and atual[0] == mtime:
+        return atual[1]
+    with open(caminho, 'rb') as f:
+        impressao = hashlib.sha256(f.read()).hexdigest()[:12]
+    _impressoes_estaticos[filename] = (mtime, impressao)
+    return impressao
+
+@app.template_global()
+def static_url(filename):
+    impressao = impressao_estatico(filename)
+    if impressao is None:
+        return f'/static/{filename}'
+    return f'/static/{filename}?v={impressao}'
+
+def com_etag(dependencias):
+    # Gera um ETag forte a partir da rota, da query e das versões das entidades
+    # de que a resposta depende; responde 304 se o cliente já tem essa versão e
+    # reaproveita o corpo já serializado quando nada mudou
+    def decorador(view):
+        @functools.wraps(view)
+        def envoltorio(**kwargs):
+            entidades = dependencias(**kwargs) if callable(dependencias) else dependencias
+            chave = (request.path, request.query_string, datetime.now().strftime('%Y-%m'),
+                     sistema_mecanica.versoes(entidades))
+            etag = hashlib.sha1(repr((EPOCA_CACHE, chave)).encode('utf-8')).hexdigest()
+            if request.if_none_match.contains(etag):
+                resposta = app.response_class(status=304)
+            else:
+                with _lock_cache_respostas:
+                    em_cache = _cache_respostas.get(chave)
+                    if em_cache is not None:
+                        _cache_respostas.move_to_end(chave)
+                if em_cache is not None:
+                    corpo, headers = em_cache
+                    resposta = app.response_class(corpo, status=200, headers=headers)
+                else:
+                    resposta = app.make_response(view(**kwargs))
+                    if resposta.status_code != 200:
+                        return resposta
+                    corpo = resposta.get_data()
+                    if len(corpo) <= CACHE_RESPOSTA_MAX_BYTES:
+                        with _lock_cache_respostas:
+                            _cache_respostas[chave] = (corpo, list(resposta.headers))
+                            while len(_cache_respostas) > CACHE_RESPOSTAS_MAX:
+                                _cache_respostas.popitem(last=False)
+            resposta.set_etag(etag)
+            resposta.headers['Cache-Control'] = 'no-cache'
+            return resposta
+        return envoltorio
+    return decorador
+
+# --- Bundles de Arquivos Estáticos --- #
+# Montados na inicialização (e de novo se algum arquivo de origem mudar), com
+# nome baseado no hash do conteúdo e versões gzip/brotli já comprimidas
+_bundles = {}
+_bundles_origem = {}
+_lock_bundles = threading.Lock()
+
+def minificar_js(codigo):
+    # Minificação conservadora: remove linhas vazias, indentação e linhas que
+    # são só comentário. As quebras de linha ficam, para não mudar a inserção
+    # automática de ponto e vírgula.
+    linhas = []
+    em_comentario = False
+    for linha in codigo.splitlines():
+        linha = linha.strip()
+        if em_comentario:
+            if '*/' in linha:
+                em_comentario = False
+                linha = linha.split('*/', 1)[1].strip()
+            else:
+                continue
+        if linha.startswith('/*'):
+            if '*/' not in linha:
+                em_comentario = True
+                continue
+            if linha.endswith('*/'):
+                continue
+        if not linha or linha.startswith('//'):
+            continue
+        linhas.append(linha)
+    return '\n'.join(linhas)
+
+def minificar_css(codigo):
+    codigo = re.sub(r'/\*.*?\*/', '', codigo, flags=re.S)
+    return '\n'.join(linha.strip() for linha in codigo.splitlines() if linha.strip())
+
+def _juntar_estilos(partes):
+    return '\n'.join(f'/* {arquivo} */\n{codigo}' for arquivo, codigo in partes)
+
+def _juntar_scripts(partes):
+    # Cada arquivo vira um <script> próprio, inserido (e executado) na mesma
+    # ordem das tags separadas: um erro em um arquivo não impede os
+    # seguintes, as declarações de nível superior (function, let, const,
+    # class) continuam globais e compartilhadas entre os arquivos, e uma
+    # função declarada em dois arquivos é substituída pela do último só
+    # quando ele roda, como antes.
+    arquivos = json.dumps([[arquivo, f'{codigo}\n//# sourceURL={arquivo}'] for arquivo, codigo in partes],
+                          ensure_ascii=False)
+    arquivos = arquivos.replace('\u2028', '\\u2028').replace('\u2029', '\\u2029')
+    return ('(function (arquivos) {\n'
+            'arquivos.forEach(function (arquivo) {\n'
+            'var script = document.createElement("script");\n'
+            'script.textContent = arquivo[1];\n'
+            'document.head.appendChild(script);\n'
+            '});\n'
+            f'}})({arquivos});\n')
+
+def _montar_bundle(arquivos, minificar, juntar, extensao, mimetype):
+    partes = []
+    for arquivo in arquivos:
+        with open(os.path.join(app.static_folder, arquivo), 'r', encoding='utf-8') as f:
+            partes.append((arquivo, minificar(f.read())))
+    conteudo = juntar(partes).encode('utf-8')
+    nome = f"bundle.{hashlib.sha256(conteudo).hexdigest()[:12]}.{extensao}"
+    variantes = {'identity': conteudo, 'gzip': gzip.compress(conteudo, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variantes['br'] = brotli.compress(conteudo)
+    return nome, {'mimetype': mimetype, 'variantes': variantes}
+
+def obter_bundles():
+    arquivos = SCRIPTS_PAGINA + ESTILOS_PAGINA
+    origem = {arquivo: os.path.getmtime(os.path.join(app.static_folder, arquivo)) for arquivo in arquivos}
+    with _lock_bundles:
+        if origem != _bundles_origem:
+            nome_js, bundle_js = _montar_bundle(SCRIPTS_PAGINA, minificar_js, _juntar_scripts, 'js', 'text/javascript')
+            nome_css, bundle_css = _montar_bundle(ESTILOS_PAGINA, minificar_css, _juntar_estilos, 'css', 'text/css')
+            _bundles.clear()
+            _bundles.update({nome_js: bundle_js, nome_css: bundle_css})
+            _bundles['_nomes'] = {'js': nome_js, 'css': nome_css}
+            _bundles_origem.clear()
+            _bundles_origem.update(origem)
+        return dict(_bundles)
+
+@app.template_global()
+def scripts_pagina():
+    if USAR_BUNDLES:
+        return [f"/bundles/{obter_bundles()['_nomes']['js']}"]
+    return [static_url(arquivo) for arquivo in SCRIPTS_PAGINA]
+
+@app.template_global()
+def estilos_pagina():
+    if USAR_BUNDLES:
+        return [f"/bundles/{obter_bundles()['_nomes']['css']}"]
+    return [static_url(arquivo) for arquivo in ESTILOS_PAGINA]
+
+ENTIDADES_DASHBOARD = ['clientes', 'veiculos', 'ordens', 'movimentacoes', 'despesasGerais']
+ENTIDADES_FINANCEIRAS = ['movimentacoes', 'despesasGerais']
 
 # --- Rotas do Frontend --- #
 @app.route('/')
@@ -357,12 +3690,185 @@ def index():
 
 @app.route('/static/<path:filename>')
 def static_files(filename):
-    return send_from_directory(app.static_folder, filename)
+    response = send_from_directory(app.static_folder, filename)
+    # Com a impressão digital correta na URL, o arquivo nunca muda: cache longo
+    versao = request.args.get('v')
+    if versao and versao == impressao_estatico(filename):
+        response.cache_control.public = True
+        response.cache_control.max_age = CACHE_ESTATICOS_MAX_AGE
+        response.cache_control.immutable = True
+        response.cache_control.no_cache = None
+    return response
+
+@app.route('/bundles/<nome>')
+def servir_bundle(nome):
+    bundle = obter_bundles().get(nome)
+    if nome.startswith('_') or bundle is None:
+        return jsonify({'message': 'Bundle não encontrado'}), 404
+    # Escolhe a melhor compressão aceita pelo cliente
+    codificacao = 'identity'
+    for candidata in ('br', 'gzip'):
+        if candidata in bundle['variantes'] and request.accept_encodings[candidata]:
+            codificacao = candidata
+            break
+    response = app.response_class(bundle['variantes'][codificacao], mimetype=bundle['mimetype'])
+    if codificacao != 'identity':
+        response.headers['Content-Encoding'] = codificacao
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(nome)
+    response.cache_control.public = True
+    response.cache_control.max_age = CACHE_ESTATICOS_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+# --- Paginação, Ordenação e Projeção --- #
+PARAMETROS_PAGINACAO = ['limit', 'offset', 'cursor', 'sort', 'fields']
+
+def _chave_ordenacao(campo):
+    # Mesma regra do frontend: nulos viram '' e textos são comparados em minúsculas;
+    # números vêm antes de textos para não misturar tipos na comparação
+    def chave(item):
+        valor = item.get(campo)
+        if valor is None:
+            valor = ''
+        if isinstance(valor, str):
+            return (1, valor.lower())
+        if isinstance(valor, (int, float)):
+            return (0, valor)
+        return (1, str(valor).lower())
+    return chave
+
+def aplicar_paginacao(itens, args):
+    # Retorna (página, cabeçalhos). Sem nenhum parâmetro, devolve a lista inteira.
+    headers = {}
+    if not any(parametro in args for parametro in PARAMETROS_PAGINACAO):
+        return itens, headers
+    headers['X-Total-Count'] = str(len(itens))
+
+    if args.get('sort'):
+        # Ordenações estáveis aplicadas do último campo para o primeiro
+        itens = list(itens)
+        for campo in reversed(args['sort'].split(',')):
+            campo = campo.strip()
+            descendente = campo.startswith('-')
+            campo = campo.lstrip('-+')
+            if campo:
+                itens.sort(key=_chave_ordenacao(campo), reverse=descendente)
+
+    limit = int(args['limit']) if args.get('limit') else None
+    if limit is not None and limit < 0:
+        raise ValueError("'limit' deve ser maior ou igual a zero")
+    if args.get('cursor'):
+        # Cursor = último id visto; a página segue a ordem crescente de id
+        if args.get('sort') or args.get('offset'):
+            raise ValueError("'cursor' não pode ser combinado com 'sort' ou 'offset'")
+        cursor = int(args['cursor'])
+        itens = sorted((item for item in itens if item.get('id', 0) > cursor), key=lambda item: item.get('id', 0))
+        pagina = itens[:limit] if limit is not None else itens
+        if limit is not None and len(itens) > limit and pagina:
+            headers['X-Next-Cursor'] = str(pagina[-1]['id'])
+    else:
+        offset = int(args.get('offset') or 0)
+        if offset < 0:
+            raise ValueError("'offset' deve ser maior ou igual a zero")
+        pagina = itens[offset:offset + limit] if limit is not None else itens[offset:]
+        if limit is not None and offset + limit < len(itens):
+            headers['X-Next-Offset'] = str(offset + limit)
+
+    if args.get('fields'):
+        campos = ['id'] + [campo.strip() for campo in args['fields'].split(',') if campo.strip() and campo.strip() != 'id']
+        pagina = [{campo: item[campo] for campo in campos if campo in item} for item in pagina]
+    return pagina, headers
+
+# --- Busca Textual --- #
+@app.route('/api/search', methods=['GET'])
+@com_etag(list(CAMPOS_BUSCA))
+def buscar_texto():
+    consulta = request.args.get('q', '')
+    entidades = [nome.strip() for nome in request.args.get('entity', '').split(',') if nome.strip()]
+    invalidas = [nome for nome in entidades if nome not in CAMPOS_BUSCA]
+    if invalidas:
+        return jsonify({'message': f"Entidade sem busca textual: {', '.join(invalidas)}"}), 400
+    try:
+        limite = int(request.args.get('limit', 20))
+        if limite < 1:
+            raise ValueError
+    except ValueError:
+        return jsonify({'message': "Parâmetro 'limit' inválido"}), 400
+    return jsonify(sistema_mecanica.buscar_texto(consulta, entidades, min(limite, 500)))
+
+# --- Feed de Alterações (SSE) --- #
+def _versao_feed(valor, feed):
+    # Aceita 'epoca.versao' (o id dos eventos) ou só a versão; versões de
+    # outra execução do servidor valem como -1, o que força a recarga
+    if '.' in valor:
+        epoca, valor = valor.split('.', 1)
+        if epoca != feed.epoca:
+            return -1
+    return int(valor)
+
+_conexoes_feed = threading.BoundedSemaphore(FEED_MAX_CONEXOES)
+
+@app.route('/api/changes', methods=['GET'])
+def get_changes():
+    feed = sistema_mecanica.feed
+    # Ao reconectar, o navegador repete a URL original: o Last-Event-ID é mais recente
+    desde = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        versao = _versao_feed(desde, feed) if desde else feed.versao
+    except ValueError:
+        return jsonify({'message': "Parâmetro 'since' inválido"}), 400
+
+    if request.args.get('modo') == 'consulta':
+        # Sem conexão aberta: responde na hora com o que veio depois de 'since'
+        sistema_mecanica.acompanhar_processos()
+        eventos, completo, atual = feed.desde(versao)
+        cabecalho = json.dumps({'epoca': feed.epoca, 'versao': eventos[-1][0] if eventos else atual,
+                                'completo': completo})
+        texto = cabecalho[:-1] + ', "eventos": [' + ','.join(evento for _, evento in eventos) + ']}'
+        return app.response_class(texto, mimetype='application/json', headers={'Cache-Control': 'no-cache'})
+
+    if not _conexoes_feed.acquire(blocking=False):
+        # Todas as vagas ocupadas: o cliente passa a consultar (modo=consulta)
+        corpo = (f'retry: {FEED_DURACAO_CONEXAO * 1000}\n\nid: {feed.epoca}.{versao}\nevent: lotado\n'
+                 f'data: {json.dumps({"versao": versao, "intervalo": FEED_INTERVALO_CONSULTA})}\n\n')
+        return app.response_class(corpo, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    def gerar(versao):
+        yield 'retry: 3000\n\n'
+        yield f'id: {feed.epoca}.{versao}\nevent: inicio\ndata: {json.dumps({"versao": versao})}\n\n'
+        fim = time.monotonic() + FEED_DURACAO_CONEXAO
+        ultimo_envio = time.monotonic()
+        while time.monotonic() < fim:
+            if MULTIPROCESSO:
+                # O que os outros processos gravam só chega a este feed quando
+                # ele acompanha o journal
+                sistema_mecanica.acompanhar_processos()
+                eventos, completo, atual = feed.aguardar(versao, FEED_INTERVALO_PROCESSOS)
+                if completo and not eventos and time.monotonic() - ultimo_envio < FEED_INTERVALO_PING:
+                    continue
+            else:
+                eventos, completo, atual = feed.aguardar(versao, FEED_INTERVALO_PING)
+            ultimo_envio = time.monotonic()
+            if not completo:
+                versao = atual
+                yield f'id: {feed.epoca}.{versao}\nevent: resync\ndata: {json.dumps({"versao": versao})}\n\n'
+            elif eventos:
+                yield ''.join(f'id: {feed.epoca}.{numero}\nevent: change\ndata: {evento}\n\n' for numero, evento in eventos)
+                versao = eventos[-1][0]
+            else:
+                yield ': ping\n\n'
+
+    resposta = app.response_class(gerar(versao), mimetype='text/event-stream',
+                                  headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    resposta.call_on_close(_conexoes_feed.release)
+    return resposta
 
 # --- Rotas da API (CRUD Genérico) --- #
 @app.route('/api/<entity_name>', methods=['GET'])
+@com_etag(lambda entity_name: [entity_name])
 def listar_entidade(entity_name):
-    filters = {k: v for k, v in request.args.items() if k not in ['mes', 'ano', 'data_abertura', 'servico_id']}
+    filters = {k: v for k, v in request.args.items() if k not in ['mes', 'ano', 'data_abertura', 'servico_id'] + PARAMETROS_PAGINACAO}
     
     # Filtros específicos para ordens
     if entity_name == 'ordens':
@@ -377,15 +3883,22 @@ def listar_entidade(entity_name):
             itens = [item for item in sistema_mecanica.data.get(entity_name, []) if item.get('data_abertura', '') == data_str]
         elif 'servico_id' in request.args:
             servico_id = int(request.args['servico_id'])
-            itens = [item for item in sistema_mecanica.data.get(entity_name, []) if servico_id in item.get('servicos_ids', [])]
+            itens = sistema_mecanica.listar_itens(entity_name, {'servico_id': servico_id})
         else:
             itens = sistema_mecanica.listar_itens(entity_name, filters)
     else:
         itens = sistema_mecanica.listar_itens(entity_name, filters)
 
-    return jsonify(itens)
+    try:
+        pagina, headers = aplicar_paginacao(itens, request.args)
+    except ValueError as e:
+        return jsonify({'message': f'Parâmetro de paginação inválido: {e}'}), 400
+    response = jsonify(pagina)
+    response.headers.update(headers)
+    return response
 
 @app.route('/api/<entity_name>/<int:item_id>', methods=['GET'])
+@com_etag(lambda entity_name, item_id: [entity_name])
 def buscar_entidade(entity_name, item_id):
     item = sistema_mecanica.buscar_item_por_id(entity_name, item_id)
     if item:
@@ -412,32 +3925,136 @@ def remover_entidade(entity_name, item_id):
         return jsonify({'message': f'{entity_name.capitalize()} removido com sucesso'}), 204
     return jsonify({'message': f'{entity_name.capitalize()} não encontrado'}), 404
 
+@app.route('/api/_batch', methods=['POST'])
+def executar_lote():
+    operacoes = (request.json or {}).get('operacoes')
+    if not isinstance(operacoes, list):
+        return jsonify({'message': "Envie as operações em uma lista 'operacoes'"}), 400
+    try:
+        resultados = sistema_mecanica.executar_lote(operacoes)
+        return jsonify(resultados), 200
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    except Exception as e:
+        return jsonify({'message': f'Erro interno ao executar lote: {str(e)}'}), 500
+
 # --- Rotas da API (Cálculos e Relatórios) --- #
+def _limite_periodo(texto, fim):
+    # 'AAAA', 'AAAA-MM' ou 'AAAA-MM-DD'; no fim do período, vale o último dia
+    if not texto:
+        return None
+    partes = texto.split('-')
+    try:
+        if len(partes) > 3 or not all(parte.isdigit() for parte in partes):
+            raise ValueError
+        ano = int(partes[0])
+        if len(partes) == 3:
+            return date(ano, int(partes[1]), int(partes[2]))
+        mes = int(partes[1]) if len(partes) == 2 else (12 if fim else 1)
+        inicio = date(ano, mes, 1)
+        if not fim:
+            return inicio
+        return date(ano + mes // 12, mes % 12 + 1, 1) - timedelta(days=1)
+    except ValueError:
+        raise ValueError(f"Data inválida: '{texto}'") from None
+
 @app.route('/api/dashboard', methods=['GET'])
+@com_etag(ENTIDADES_DASHBOARD)
 def get_dashboard_data():
     data = sistema_mecanica.atualizar_dashboard()
     return jsonify(data)
 
 @app.route('/api/ordens/<int:ordem_id>/total', methods=['GET'])
+@com_etag(['ordens', 'servicos', 'pecas'])
 def get_total_ordem(ordem_id):
     total = sistema_mecanica.calcular_total_ordem(ordem_id)
     return jsonify({'total': total})
 
+@app.route('/api/ordens/totais', methods=['POST'])
+def get_totais_ordens():
+    # {"ids": [1, 2, 3]} -> totais de várias ordens em uma só requisição
+    dados = request.get_json(silent=True)
+    ids = dados.get('ids') if isinstance(dados, dict) else None
+    if not isinstance(ids, list) or not all(isinstance(ordem_id, int) and not isinstance(ordem_id, bool) for ordem_id in ids):
+        return jsonify({'message': "Envie {'ids': [...]} com ids numéricos"}), 400
+    if len(ids) > 5000:
+        return jsonify({'message': 'No máximo 5000 ordens por requisição'}), 400
+    totais = sistema_mecanica.calcular_totais_ordens(ids)
+    return jsonify({
+        'totais': [{'id': ordem_id, 'total': total} for ordem_id, total in totais.items()],
+        'nao_encontradas': [ordem_id for ordem_id in dict.fromkeys(ids) if ordem_id not in totais],
+    })
+
 @app.route('/api/pecas/<int:peca_id>/margem-lucro', methods=['GET'])
+@com_etag(['pecas'])
 def get_margem_lucro_peca(peca_id):
     margem = sistema_mecanica.calcular_margem_lucro(peca_id)
     return jsonify({'margemLucro': margem})
 
+def _instante_estoque(texto, fim_do_dia):
+    # 'AAAA-MM-DD' ou data e hora ISO; uma data sozinha como limite final
+    # inclui o dia inteiro
+    try:
+        instante = datetime.fromisoformat(texto)
+    except ValueError:
+        raise ValueError(f"Data inválida: '{texto}'") from None
+    if fim_do_dia and len(texto) == 10:
+        instante += timedelta(days=1)
+    return instante.isoformat()
+
+@app.route('/api/pecas/alertas', methods=['GET'])
+@com_etag(['pecas'])
+def get_alertas_estoque():
+    return jsonify(sistema_mecanica.pecas_em_alerta())
+
+@app.route('/api/pecas/<int:peca_id>/historico', methods=['GET'])
+@com_etag(['pecas', 'movimentacoes_estoque'])
+def get_historico_estoque(peca_id):
+    # ?em= dá o estoque na data; desde/ate limitam as movimentações listadas
+    try:
+        limite = int(request.args.get('limit', 100))
+        if limite < 0:
+            raise ValueError
+    except ValueError:
+        return jsonify({'message': "Parâmetro 'limit' inválido"}), 400
+    try:
+        desde = _instante_estoque(request.args['desde'], False) if request.args.get('desde') else None
+        ate = _instante_estoque(request.args['ate'], True) if request.args.get('ate') else None
+        em = _instante_estoque(request.args['em'], True) if request.args.get('em') else None
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    historico = sistema_mecanica.historico_estoque(peca_id, desde, ate, min(limite, 5000))
+    if historico is None:
+        return jsonify({'message': 'Peça não encontrada'}), 404
+    if em is not None:
+        historico['em'] = request.args['em']
+        historico['estoque_em'] = sistema_mecanica.estoque_em(peca_id, em)
+    return jsonify(historico)
+
 @app.route('/api/relatorios/financeiro-anual/<int:ano>', methods=['GET'])
+@com_etag(ENTIDADES_FINANCEIRAS)
 def get_relatorio_financeiro_anual(ano):
     relatorio = sistema_mecanica.gerar_relatorio_financeiro_anual(ano)
     return jsonify(relatorio)
 
 @app.route('/api/relatorios/financeiro-mensal/<int:ano>/<int:mes>', methods=['GET'])
+@com_etag(ENTIDADES_FINANCEIRAS)
 def get_relatorio_financeiro_mensal(ano, mes):
     relatorio = sistema_mecanica.gerar_relatorio_financeiro_mensal(ano, mes)
     return jsonify(relatorio)
 
+@app.route('/api/analytics', methods=['GET'])
+@com_etag(ENTIDADES_FINANCEIRAS + ['ordens', 'servicos', 'pecas'])
+def get_analytics():
+    agrupar_por = tuple(campo.strip() for campo in request.args.get('group_by', '').split(',') if campo.strip())
+    try:
+        inicio = _limite_periodo(request.args.get('from'), fim=False)
+        fim = _limite_periodo(request.args.get('to'), fim=True)
+        resultado = sistema_mecanica.analisar(request.args.get('metric', ''), agrupar_por, inicio, fim)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    return jsonify(resultado)
+
 @app.route('/api/ordens/proximo_numero', methods=['GET'])
 def get_proximo_numero_os():
     proximo_numero = sistema_mecanica.gerar_proximo_numero_os()
@@ -454,6 +4071,27 @@ def add_log():
     log_entry = sistema_mecanica.registrar_log(log_data.get('acao'), log_data.get('detalhes'))
     return jsonify(log_entry), 201
 
+@app.route('/api/logs', methods=['GET'])
+def get_logs():
+    # ?desde=&ate= (datas ISO), ?acao=, ?limit= (padrão 100) e ?ordem=asc
+    try:
+        limite = int(request.args.get('limit', 100))
+        if limite < 1:
+            raise ValueError
+    except ValueError:
+        return jsonify({'message': "Parâmetro 'limit' inválido"}), 400
+    for parametro in ('desde', 'ate'):
+        valor = request.args.get(parametro)
+        if valor:
+            try:
+                datetime.fromisoformat(valor)
+            except ValueError:
+                return jsonify({'message': f"Data inválida em '{parametro}'"}), 400
+    logs = sistema_mecanica.auditoria.consultar(
+        desde=request.args.get('desde'), ate=request.args.get('ate'), acao=request.args.get('acao'),
+        limite=min(limite, 5000), crescente=request.args.get('ordem') == 'asc')
+    return jsonify(logs)
+
 @app.route('/api/movimentacoes_estoque', methods=['POST'])
 def add_movimentacao_estoque():
     data = request.json
@@ -474,6 +4112,16 @@ def api_registrar_movimentacao_financeira(ordem_id, tipo):
         return jsonify({'message': f'Movimentação financeira de {tipo} registrada com sucesso'}), 200
     return jsonify({'message': 'Erro ao registrar movimentação financeira ou ordem não encontrada'}), 404
 
+@app.route('/api/ordens/<int:ordem_id>/fechar', methods=['POST'])
+def api_fechar_ordem(ordem_id):
+    try:
+        ordem = sistema_mecanica.fechar_ordem(ordem_id, request.get_json(silent=True))
+    except Exception as e:
+        return jsonify({'message': f'Erro ao fechar ordem, nenhuma alteração foi gravada: {str(e)}'}), 500
+    if ordem:
+        return jsonify(ordem), 200
+    return jsonify({'message': 'Ordem não encontrada'}), 404
+
 @app.route('/api/contas_a_receber', methods=['POST'])
 def adicionar_conta_receber_api():
     data = request.json
@@ -495,15 +4143,32 @@ def registrar_pagamento_conta_api(conta_id):
 
 @app.route('/api/backup', methods=['GET'])
 def get_backup():
-    backup_data = sistema_mecanica.backup_data()
-    return jsonify(backup_data)
+    # ?formato=ndjson gera uma linha por registro; o padrão mantém o JSON único
+    formato = request.args.get('formato', 'json')
+    if formato not in ('json', 'ndjson'):
+        return jsonify({'message': "Formato de backup inválido (use 'json' ou 'ndjson')"}), 400
+    mimetype = 'application/x-ndjson' if formato == 'ndjson' else 'application/json'
+    response = app.response_class(sistema_mecanica.exportar_backup(formato), mimetype=mimetype)
+    if formato == 'ndjson':
+        response.headers['Content-Disposition'] = 'attachment; filename=backup.ndjson'
+    return response
+
+@app.route('/api/restore/progresso', methods=['GET'])
+def get_progresso_restauracao():
+    return jsonify(sistema_mecanica.progresso_restauracao())
 
 @app.route('/api/restore', methods=['POST'])
 def post_restore():
-    backup_data = request.json
     try:
+        if request.mimetype == 'application/x-ndjson':
+            progresso = sistema_mecanica.importar_backup_ndjson(
+                iter(request.stream.readline, b''), request.content_length)
+            return jsonify({'message': 'Dados restaurados com sucesso', 'registros': progresso['registros']}), 200
+        backup_data = request.json
         sistema_mecanica.restore_data(backup_data)
         return jsonify({'message': 'Dados restaurados com sucesso'}), 200
+    except RestauracaoEmAndamento as e:
+        return jsonify({'message': str(e)}), 409
     except ValueError as e:
         return jsonify({'message': str(e)}), 400
     except Exception as e:
@@ -511,5 +4176,27 @@ def post_restore():
 
 # --- Execução do Servidor --- #
 if __name__ == '__main__':
-    from datetime import timedelta # Importar timedelta aqui para evitar circular import
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrar-sqlite':
+        for nome, total in migrar_json_para_sqlite().items():
+            print(f'{nome}: {total} registro(s)')
+        print(f'✅ Dados migrados para {SQLITE_FILE}')
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'exportar-json':
+        destino = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(DATA_FILE)[0] + '_exportado.json'
+        for nome, total in exportar_snapshot_json(destino).items():
+            print(f'{nome}: {total} registro(s)')
+        print(f'✅ Dados exportados para {destino}')
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'importar-json':
+        origem = sys.argv[2] if len(sys.argv) > 2 else DATA_FILE
+        for nome, total in importar_json_para_snapshot(origem).items():
+            print(f'{nome}: {total} registro(s)')
+        print(f'✅ Dados de {origem} importados para o snapshot')
+        sys.exit(0)
+    try:
+        from waitress import serve
+    except ImportError:
+        # Sem waitress, usa o servidor do Flask com uma thread por requisição
+        app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
+    else:
+        serve(app, host='0.0.0.0', port=5000, threads=THREADS_SERVIDOR)
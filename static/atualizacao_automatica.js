@@ -316,5 +316,122 @@ setTimeout(function() {
     
 }, 2000);
 
+// ========== FEED DE ALTERAÇÕES DO SERVIDOR (SSE) ==========
+// Em vez de baixar as listas inteiras de novo, aplica em `dados` só o que
+// mudou no servidor (inclusive em outros terminais). Se o feed pedir recarga
+// ('resync' ou 'recarregar'), busca de novo as listas da API. Se o servidor
+// não tiver vaga para mais uma conexão aberta ('lotado'), consulta o feed
+// periodicamente e, de tempos em tempos, tenta conectar de novo.
+
+const FEED_TENTAR_CONEXAO_SEGUNDOS = 60;
+
+const feedAlteracoes = {
+    fonte: null,
+    renderizacaoPendente: null,
+    ultimoId: null
+};
+
+function agendarRenderizacaoFeed() {
+    // Várias alterações seguidas viram uma única renderização
+    if (feedAlteracoes.renderizacaoPendente) return;
+    feedAlteracoes.renderizacaoPendente = setTimeout(() => {
+        feedAlteracoes.renderizacaoPendente = null;
+        if (typeof renderizarTudo === 'function') renderizarTudo();
+        if (typeof atualizarDashboard === 'function') atualizarDashboard();
+    }, 200);
+}
+
+function aplicarAlteracaoFeed(alteracao) {
+    const lista = dados[alteracao.entidade];
+    if (!Array.isArray(lista)) return;
+    const indice = lista.findIndex(item => item.id === alteracao.id);
+    if (alteracao.op === 'inserir') {
+        if (indice === -1) lista.push(alteracao.dados);
+        else lista[indice] = alteracao.dados;
+    } else if (alteracao.op === 'atualizar' && indice !== -1) {
+        Object.assign(lista[indice], alteracao.dados);
+    } else if (alteracao.op === 'remover' && indice !== -1) {
+        lista.splice(indice, 1);
+    }
+    agendarRenderizacaoFeed();
+}
+
+async function recarregarDadosFeed() {
+    const entidades = Object.keys(dados).filter(entidade => Array.isArray(dados[entidade]));
+    await Promise.all(entidades.map(async entidade => {
+        try {
+            const response = await fetch(`/api/${entidade}`);
+            if (response.ok) dados[entidade] = await response.json();
+        } catch (e) {
+            console.error(`Erro ao recarregar ${entidade}:`, e);
+        }
+    }));
+    agendarRenderizacaoFeed();
+}
+
+function aplicarEventoFeed(alteracao) {
+    if (alteracao.op === 'recarregar') recarregarDadosFeed();
+    else aplicarAlteracaoFeed(alteracao);
+}
+
+async function consultarFeed() {
+    const params = new URLSearchParams({ modo: 'consulta' });
+    if (feedAlteracoes.ultimoId) params.set('since', feedAlteracoes.ultimoId);
+    const response = await fetch(`/api/changes?${params.toString()}`);
+    if (!response.ok) return;
+    const resposta = await response.json();
+    if (!resposta.completo) recarregarDadosFeed();
+    else resposta.eventos.forEach(aplicarEventoFeed);
+    feedAlteracoes.ultimoId = `${resposta.epoca}.${resposta.versao}`;
+}
+
+function consultarFeedPeriodicamente(intervalo) {
+    let decorrido = 0;
+    const proxima = async () => {
+        try {
+            await consultarFeed();
+        } catch (e) {
+            console.error('Erro ao consultar o feed de alterações:', e);
+        }
+        decorrido += intervalo;
+        if (decorrido >= FEED_TENTAR_CONEXAO_SEGUNDOS) {
+            iniciarFeedAlteracoes();
+            return;
+        }
+        setTimeout(proxima, intervalo * 1000);
+    };
+    setTimeout(proxima, intervalo * 1000);
+}
+
+function iniciarFeedAlteracoes() {
+    if (!window.EventSource || feedAlteracoes.fonte) return;
+    // O navegador reconecta sozinho, enviando o id do último evento recebido
+    const url = feedAlteracoes.ultimoId
+        ? `/api/changes?since=${encodeURIComponent(feedAlteracoes.ultimoId)}`
+        : '/api/changes';
+    const fonte = new EventSource(url);
+    const guardarId = e => { if (e.lastEventId) feedAlteracoes.ultimoId = e.lastEventId; };
+    fonte.addEventListener('inicio', guardarId);
+    fonte.addEventListener('change', e => {
+        guardarId(e);
+        aplicarEventoFeed(JSON.parse(e.data));
+    });
+    fonte.addEventListener('resync', e => {
+        guardarId(e);
+        recarregarDadosFeed();
+    });
+    fonte.addEventListener('lotado', e => {
+        guardarId(e);
+        fonte.close();
+        feedAlteracoes.fonte = null;
+        consultarFeedPeriodicamente(JSON.parse(e.data).intervalo);
+        console.log('ℹ️ Servidor sem vagas no feed: consultando periodicamente');
+    });
+    feedAlteracoes.fonte = fonte;
+    console.log('✅ Feed de alterações conectado');
+}
+
+document.addEventListener('DOMContentLoaded', iniciarFeedAlteracoes);
+
 console.log('✅ Sistema de atualização automática inicializado!');
 
@@ -7,6 +7,36 @@ console.log("🧮 Sistema de cálculos carregado e adaptado para API!");
 // A função calcularTotalOrdem agora deve ser chamada via API
 // O frontend deve enviar os dados da ordem para o backend calcular
 
+/**
+ * Busca os totais de várias ordens em uma única requisição (ou uma a cada
+ * 5000 ordens, o limite do servidor).
+ * Retorna um objeto { id: total }; ordens inexistentes ficam de fora.
+ */
+async function buscarTotaisOrdens(ids) {
+    const totais = {};
+    if (!ids || ids.length === 0) return totais;
+    for (let inicio = 0; inicio < ids.length; inicio += 5000) {
+        const resposta = await apiRequest("/api/ordens/totais", "POST", { ids: ids.slice(inicio, inicio + 5000) });
+        resposta.totais.forEach(item => { totais[item.id] = item.total; });
+    }
+    return totais;
+}
+
+/**
+ * O valor_total só é gravado na ordem quando ela é fechada. Para as demais,
+ * preenche com o total calculado no servidor, numa única busca.
+ */
+async function completarTotaisOrdens(ordens) {
+    const pendentes = ordens
+        .filter(o => Number.isInteger(o.id) && (o.valor_total === undefined || o.valor_total === null))
+        .map(o => o.id);
+    const totais = await buscarTotaisOrdens(pendentes);
+    ordens.forEach(o => {
+        if (o.id in totais) o.valor_total = totais[o.id];
+    });
+    return ordens;
+}
+
 // ========== CÁLCULO DE DASHBOARD ==========
 
 /**
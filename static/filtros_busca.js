@@ -6,6 +6,33 @@ console.log("🔍 Sistema de filtros e busca carregado e adaptado para API!");
 
 // ========== FUNÇÕES DE BUSCA ==========
 
+// Cada entidade guarda o número da última busca, para descartar respostas
+// que chegarem fora de ordem enquanto o usuário digita
+const ultimaBuscaServidor = {};
+
+/**
+ * Busca no índice do servidor (/api/search). Em caso de erro, usa o filtro local.
+ * @param {string} entidade - clientes, veiculos, servicos ou pecas.
+ * @param {string} termo - O termo de busca.
+ * @param {Function} filtroLocal - Filtro usado se a API não responder.
+ * @returns {Promise<Array|null>} Registros encontrados, ou null se a busca ficou obsoleta.
+ */
+async function buscarNoServidor(entidade, termo, filtroLocal) {
+    const numero = (ultimaBuscaServidor[entidade] || 0) + 1;
+    ultimaBuscaServidor[entidade] = numero;
+    let encontrados;
+    try {
+        const params = new URLSearchParams({ q: termo, entity: entidade, limit: 500 });
+        const response = await fetch(`/api/search?${params.toString()}`);
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        encontrados = (await response.json()).map(r => r.registro);
+    } catch (error) {
+        console.warn(`Busca no servidor indisponível, filtrando localmente: ${error.message}`);
+        encontrados = dados[entidade].filter(filtroLocal);
+    }
+    return ultimaBuscaServidor[entidade] === numero ? encontrados : null;
+}
+
 /**
  * Busca clientes com base em um termo e renderiza a tabela.
  * @param {string} termo - O termo de busca.
@@ -15,12 +42,13 @@ window.buscarClientes = async function(termo) {
     let clientesFiltrados = dados.clientes; // Usa o cache local de dados
 
     if (termo) {
-        clientesFiltrados = clientesFiltrados.filter(c => 
+        clientesFiltrados = await buscarNoServidor("clientes", termo, c => 
             (c.nome && c.nome.toLowerCase().includes(termo)) ||
             (c.cpfCnpj && c.cpfCnpj.includes(termo)) ||
             (c.telefone && c.telefone.includes(termo)) ||
             (c.email && c.email.toLowerCase().includes(termo))
         );
+        if (clientesFiltrados === null) return; // Já existe uma busca mais recente
     }
     
     renderizarTabela("clientes", "clientesBody", criarLinhaCliente, false, clientesFiltrados);
@@ -36,12 +64,13 @@ window.buscarVeiculos = async function(termo) {
     let veiculosFiltrados = dados.veiculos; // Usa o cache local de dados
 
     if (termo) {
-        veiculosFiltrados = veiculosFiltrados.filter(v => 
+        veiculosFiltrados = await buscarNoServidor("veiculos", termo, v => 
             (v.placa && v.placa.toLowerCase().includes(termo)) ||
             (v.marca && v.marca.toLowerCase().includes(termo)) ||
             (v.modelo && v.modelo.toLowerCase().includes(termo)) ||
             (v.cor && v.cor.toLowerCase().includes(termo))
         );
+        if (veiculosFiltrados === null) return; // Já existe uma busca mais recente
     }
     
     renderizarTabela("veiculos", "veiculosBody", criarLinhaVeiculo, false, veiculosFiltrados);
@@ -57,10 +86,11 @@ window.buscarServicos = async function(termo) {
     let servicosFiltrados = dados.servicos; // Usa o cache local de dados
 
     if (termo) {
-        servicosFiltrados = servicosFiltrados.filter(s => 
+        servicosFiltrados = await buscarNoServidor("servicos", termo, s => 
             (s.descricao && s.descricao.toLowerCase().includes(termo)) ||
             (s.categoria && s.categoria.toLowerCase().includes(termo))
         );
+        if (servicosFiltrados === null) return; // Já existe uma busca mais recente
     }
     
     renderizarTabela("servicos", "servicosTable", criarLinhaServico, true, servicosFiltrados);
@@ -76,11 +106,12 @@ window.buscarPecas = async function(termo) {
     let pecasFiltradas = dados.pecas; // Usa o cache local de dados
 
     if (termo) {
-        pecasFiltradas = pecasFiltradas.filter(p => 
+        pecasFiltradas = await buscarNoServidor("pecas", termo, p => 
             (p.codigo && p.codigo.toLowerCase().includes(termo)) ||
             (p.descricao && p.descricao.toLowerCase().includes(termo)) ||
             (p.fornecedor && p.fornecedor.toLowerCase().includes(termo))
         );
+        if (pecasFiltradas === null) return; // Já existe uma busca mais recente
     }
     
     renderizarTabela("pecas", "pecasTable", criarLinhaPeca, true, pecasFiltradas);
@@ -26,6 +26,29 @@ async function inicializarGraficos() {
 
 // ========== GRÁFICO DE RECEITAS X DESPESAS ==========
 
+// Soma de uma métrica de /api/analytics por mês, na ordem de `chavesMes` (YYYY-MM)
+async function buscarAnaliseMensal(metrica, chavesMes) {
+    const params = new URLSearchParams({
+        metric: metrica,
+        group_by: "mes",
+        from: chavesMes[0],
+        to: chavesMes[chavesMes.length - 1]
+    });
+    const response = await fetch(`/api/analytics?${params.toString()}`);
+    if (!response.ok) {
+        throw new Error(`Erro ao buscar análise ${metrica}: ${response.status}`);
+    }
+    const resultado = await response.json();
+    const porMes = {};
+    resultado.grupos.forEach(grupo => { porMes[grupo.mes] = grupo.valor; });
+    return chavesMes.map(mesAno => porMes[mesAno] || 0);
+}
+
+function somarMesLocal(lista, mesAno) {
+    return (lista || []).reduce((soma, item) =>
+        soma + (item.data && item.data.startsWith(mesAno) ? parseFloat(item.valor) || 0 : 0), 0);
+}
+
 window.criarGraficoReceitasDespesas = async function() {
     const canvas = document.getElementById("graficoFinanceiro"); // ID do canvas no index.html
     if (!canvas) {
@@ -33,45 +56,32 @@ window.criarGraficoReceitasDespesas = async function() {
         return;
     }
     
-    // Os dados para este gráfico virão da função atualizarDashboard, que já busca da API
-    // Para este gráfico, vamos precisar de dados mensais dos últimos 6 meses.
-    // A API do backend precisa fornecer um endpoint para isso.
-    // Por enquanto, vamos simular com os dados locais `dados.movimentacoes` e `dados.despesasGerais`
-    // Se houver um endpoint específico para isso no futuro, será adaptado.
-
+    // Totais mensais dos últimos 6 meses calculados no servidor (/api/analytics);
+    // sem resposta da API, soma localmente `dados.movimentacoes` e `dados.despesasGerais`
     const meses = [];
-    const receitas = [];
-    const despesas = [];
-    
+    const chavesMes = [];
+
     for (let i = 5; i >= 0; i--) {
         const data = new Date();
+        data.setDate(1);
         data.setMonth(data.getMonth() - i);
-        const mesAno = data.toISOString().substring(0, 7); // YYYY-MM
-        const mesNome = data.toLocaleDateString("pt-BR", { month: "short", year: "2-digit" });
-        
-        meses.push(mesNome);
-        
-        let receitaMes = 0;
-        let despesaMes = 0;
-        
-        dados.movimentacoes.forEach(m => {
-            if (m.data && m.data.startsWith(mesAno)) {
-                if (m.tipo === "receita") {
-                    receitaMes += parseFloat(m.valor) || 0;
-                } else if (m.tipo === "despesa") {
-                    despesaMes += parseFloat(m.valor) || 0;
-                }
-            }
-        });
+        chavesMes.push(data.toISOString().substring(0, 7)); // YYYY-MM
+        meses.push(data.toLocaleDateString("pt-BR", { month: "short", year: "2-digit" }));
+    }
 
-        dados.despesasGerais.forEach(d => {
-            if (d.data && d.data.startsWith(mesAno)) {
-                despesaMes += parseFloat(d.valor) || 0;
-            }
-        });
-        
-        receitas.push(receitaMes);
-        despesas.push(despesaMes);
+    let receitas;
+    let despesas;
+    try {
+        [receitas, despesas] = await Promise.all(
+            ["receita", "despesa"].map(metrica => buscarAnaliseMensal(metrica, chavesMes))
+        );
+    } catch (error) {
+        console.warn("Análise no servidor indisponível, calculando localmente:", error);
+        receitas = chavesMes.map(mesAno => somarMesLocal(dados.movimentacoes.filter(m => m.tipo === "receita"), mesAno));
+        despesas = chavesMes.map(mesAno =>
+            somarMesLocal(dados.movimentacoes.filter(m => m.tipo === "despesa"), mesAno) +
+            somarMesLocal(dados.despesasGerais, mesAno)
+        );
     }
     
     // Destruir gráfico anterior se existir
@@ -207,18 +217,32 @@ window.criarGraficoServicosMaisRealizados = async function() {
         return;
     }
     
-    // Contar quantas vezes cada serviço foi usado
+    // Contar quantas vezes cada serviço foi usado (agrupado no servidor; sem
+    // resposta da API, conta localmente sobre `dados.ordens`)
     const servicosCount = {};
     
-    dados.ordens.forEach(os => {
-        (os.servicos_ids || []).forEach(servico_id => {
-            const servico = dados.servicos.find(s => s.id === servico_id);
-            if (servico) {
-                const descricao = servico.descricao || "Serviço sem descrição";
-                servicosCount[descricao] = (servicosCount[descricao] || 0) + 1;
-            }
+    try {
+        const response = await fetch("/api/analytics?metric=servicos&group_by=item");
+        if (!response.ok) {
+            throw new Error(`Erro ao buscar análise de serviços: ${response.status}`);
+        }
+        const resultado = await response.json();
+        resultado.grupos.forEach(grupo => {
+            const descricao = grupo.item || "Serviço sem descrição";
+            servicosCount[descricao] = (servicosCount[descricao] || 0) + grupo.registros;
         });
-    });
+    } catch (error) {
+        console.warn("Análise no servidor indisponível, contando localmente:", error);
+        dados.ordens.forEach(os => {
+            (os.servicos_ids || []).forEach(servico_id => {
+                const servico = dados.servicos.find(s => s.id === servico_id);
+                if (servico) {
+                    const descricao = servico.descricao || "Serviço sem descrição";
+                    servicosCount[descricao] = (servicosCount[descricao] || 0) + 1;
+                }
+            });
+        });
+    }
     
     // Ordenar e pegar top 5
     const servicosOrdenados = Object.entries(servicosCount)
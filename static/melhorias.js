@@ -6,33 +6,47 @@
 async function atualizarEstoqueAutomatico(ordem) {
     if (!ordem.pecas || ordem.pecas.length === 0) return;
     
-    for (const p of ordem.pecas) {
-        try {
-            const peca = await apiRequest(`/api/pecas/${p.peca_id}`);
-            if (peca) {
-                // Deduzir quantidade do estoque
-                const novaQuantidade = peca.quantidadeEstoque - p.quantidade;
-                await apiRequest(`/api/pecas/${peca.id}`, "PUT", { quantidadeEstoque: novaQuantidade });
-                
-                // Alertar se estoque baixo (ainda no frontend)
-                if (novaQuantidade <= peca.estoqueMinimo) {
-                    notificarAlerta(
-                        `⚠️ Estoque baixo: ${peca.descricao} - Restam ${novaQuantidade} unidades`
-                    );
-                }
-                
-                // Registrar movimentação de estoque (nova API endpoint)
-                await apiRequest("/api/movimentacoes_estoque", "POST", {
+    try {
+        const pecas = await Promise.all(ordem.pecas.map(p => apiRequest(`/api/pecas/${p.peca_id}`)));
+        
+        // Todas as baixas e movimentações vão em um único lote: ou tudo é
+        // gravado, ou nada (se alguma operação falhar)
+        const operacoes = [];
+        const alertas = [];
+        ordem.pecas.forEach((p, i) => {
+            const peca = pecas[i];
+            if (!peca) return;
+            
+            // Deduzir quantidade do estoque
+            const novaQuantidade = peca.quantidadeEstoque - p.quantidade;
+            operacoes.push({ op: "atualizar", entidade: "pecas", id: peca.id, dados: { quantidadeEstoque: novaQuantidade } });
+            
+            // Registrar movimentação de estoque
+            operacoes.push({
+                op: "inserir",
+                entidade: "movimentacoes_estoque",
+                dados: {
                     peca_id: peca.id,
                     quantidade: p.quantidade,
                     tipo: "saida",
                     motivo: `OS ${ordem.id}`,
                     ordem_id: ordem.id
-                });
+                }
+            });
+            
+            if (novaQuantidade <= peca.estoqueMinimo) {
+                alertas.push(`⚠️ Estoque baixo: ${peca.descricao} - Restam ${novaQuantidade} unidades`);
             }
-        } catch (error) {
-            console.error("Erro ao atualizar estoque ou registrar movimentação para peça:", p.peca_id, error);
+        });
+        
+        if (operacoes.length > 0) {
+            await apiRequest("/api/_batch", "POST", { operacoes });
         }
+        
+        // Alertar se estoque baixo (ainda no frontend)
+        alertas.forEach(alerta => notificarAlerta(alerta));
+    } catch (error) {
+        console.error("Erro ao atualizar estoque ou registrar movimentações da OS:", ordem.id, error);
     }
 }
 
@@ -53,19 +67,27 @@ async function registrarMovimentacaoFinanceira(ordem, tipo) {
         }
         
         if (tipo === "despesa" && ordem.pecas_usadas) {
+            const operacoes = [];
             for (const p of ordem.pecas_usadas) {
                 const peca = dados.pecas.find(pc => pc.id === p.peca_id);
                 if (peca) {
-                    await apiRequest("/api/movimentacoes", "POST", {
-                        tipo: "despesa",
-                        descricao: `Peça: ${peca.descricao} - OS ${ordem.id}`,
-                        valor: peca.custo_unitario * p.quantidade,
-                        categoria: "Peças",
-                        data: ordem.data_fechamento || new Date().toISOString().split("T")[0],
-                        ordem_id: ordem.id
+                    operacoes.push({
+                        op: "inserir",
+                        entidade: "movimentacoes",
+                        dados: {
+                            tipo: "despesa",
+                            descricao: `Peça: ${peca.descricao} - OS ${ordem.id}`,
+                            valor: peca.custo_unitario * p.quantidade,
+                            categoria: "Peças",
+                            data: ordem.data_fechamento || new Date().toISOString().split("T")[0],
+                            ordem_id: ordem.id
+                        }
                     });
                 }
             }
+            if (operacoes.length > 0) {
+                await apiRequest("/api/_batch", "POST", { operacoes });
+            }
         }
         atualizarDashboard(); // Atualiza o dashboard após a movimentação
     } catch (error) {
@@ -236,8 +236,8 @@ window.adicionarIconesOrdenacao = function() {
 
 // ========== CSS PARA PAGINAÇÃO ==========
 
-const style = document.createElement("style");
-style.textContent = `
+const estiloPaginacao = document.createElement("style");
+estiloPaginacao.textContent = `
 .paginacao {
     display: flex;
     align-items: center;
@@ -289,7 +289,7 @@ th[data-sortable]:hover {
     background: rgba(0,0,0,0.05);
 }
 `;
-document.head.appendChild(style);
+document.head.appendChild(estiloPaginacao);
 
 // ========== INICIALIZAÇÃO ==========
 
@@ -22,7 +22,7 @@ async function gerarRelatorioPorCliente() {
             return;
         }
         
-        const ordensCliente = await apiRequest(`/api/ordens?cliente_id=${clienteId}`);
+        const ordensCliente = await completarTotaisOrdens(await apiRequest(`/api/ordens?cliente_id=${clienteId}`));
         const veiculosCliente = await apiRequest(`/api/veiculos?cliente_id=${clienteId}`);
         
         // Calcular totais
@@ -140,7 +140,7 @@ async function gerarRelatorioPorDia() {
     }
     
     try {
-        const ordensData = await apiRequest(`/api/ordens?data_abertura=${data}`);
+        const ordensData = await completarTotaisOrdens(await apiRequest(`/api/ordens?data_abertura=${data}`));
         const movimentacoesData = await apiRequest(`/api/movimentacoes?data=${data}`);
         const despesasData = await apiRequest(`/api/despesasGerais?data=${data}`);
 
@@ -275,7 +275,7 @@ async function gerarRelatorioPorMes() {
     
     try {
         const relatorioMensal = await apiRequest(`/api/relatorios/financeiro-mensal/${ano}/${mes}`);
-        const ordensMes = await apiRequest(`/api/ordens?mes=${mes}&ano=${ano}`);
+        const ordensMes = await completarTotaisOrdens(await apiRequest(`/api/ordens?mes=${mes}&ano=${ano}`));
 
         const totalFaturado = ordensMes.reduce((sum, o) => sum + (o.valor_total || 0), 0);
         const totalServicos = ordensMes.length;
@@ -369,7 +369,7 @@ async function gerarRelatorioPorAno() {
     
     try {
         const relatorioAnual = await apiRequest(`/api/relatorios/financeiro-anual/${ano}`);
-        const ordensAno = await apiRequest(`/api/ordens?ano=${ano}`);
+        const ordensAno = await completarTotaisOrdens(await apiRequest(`/api/ordens?ano=${ano}`));
 
         const totalServicos = ordensAno.length;
         
@@ -464,7 +464,7 @@ async function gerarRelatorioPorServico() {
             return;
         }
         
-        const ordensComServico = await apiRequest(`/api/ordens?servico_id=${servicoId}`);
+        const ordensComServico = await completarTotaisOrdens(await apiRequest(`/api/ordens?servico_id=${servicoId}`));
         
         const totalVezesUsado = ordensComServico.length;
         const totalFaturadoServico = ordensComServico.reduce((sum, o) => {
@@ -548,8 +548,8 @@ async function gerarRelatorioPorServico() {
 // ========== RELATÓRIO DE ESTOQUE BAIXO ==========
 async function gerarRelatorioEstoqueBaixo() {
     try {
-        const pecas = await apiRequest("/api/pecas");
-        const pecasBaixoEstoque = pecas.filter(p => p.quantidadeEstoque <= p.estoqueMinimo);
+        // Lista mantida pelo servidor, já ordenada da mais para a menos crítica
+        const pecasBaixoEstoque = await apiRequest("/api/pecas/alertas");
 
         let html = `
             <div class="relatorio-estoque-baixo">